@@ -1,5 +1,7 @@
 #!/usr/bin/env python3
-import serial, time, argparse, threading, sys
+import serial, time, argparse, threading, sys, heapq
+from collections import deque
+from concurrent.futures import Future
 
 # Colori terminale
 class Colors:
@@ -8,58 +10,435 @@ class Colors:
     AUTO_OFF = '\033[93m'  # Giallo
     END = '\033[0m'
 
-class KMTronicRelay:
-    def __init__(self, port='/dev/ttyS4', baudrate=9600, board_id=1, timeout=1):
+class AutoOffScheduler:
+    """Un solo thread per tutti gli spegnimenti automatici di un bus.
+
+    I canali sono identificati da una chiave, (board_id, channel) per
+    RS485Bus. Le scadenze stanno in uno heap (deadline, seq, channel); ogni
+    canale ha al più uno spegnimento pendente: schedule() lo riprogramma,
+    cancel() lo annulla (le voci superate restano nello heap e vengono scartate).
+    I canali che scadono insieme (entro slack s) vengono passati insieme a
+    target._auto_off(), che li spegne con una write() per scheda.
+    Ogni schedule()/cancel() incrementa la generazione del canale: lo
+    spegnimento viene scritto solo se la generazione è ancora quella della
+    voce scaduta (current()), così un comando manuale arrivato nel frattempo
+    non viene sovrascritto.
+    """
+    def __init__(self, target, slack=0.02):
+        self.target = target
+        self.slack = slack
+        self._heap = []
+        self._pending = {}   # channel -> (deadline, seq, callback)
+        self._gen = {}       # channel -> generazione, +1 a ogni schedule()/cancel()
+        self._seq = 0
+        self._cond = threading.Condition()
+        self._thread = None
+        self._running = True
+        self._busy = False
+
+    def schedule(self, channel, delay, callback=None):
+        with self._cond:
+            self._seq += 1
+            self._gen[channel] = self._gen.get(channel, 0) + 1
+            deadline = time.monotonic() + delay
+            self._pending[channel] = (deadline, self._seq, callback)
+            heapq.heappush(self._heap, (deadline, self._seq, channel))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="kmt-auto-off", daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+
+    def cancel(self, channel):
+        with self._cond:
+            self._gen[channel] = self._gen.get(channel, 0) + 1
+            if self._pending.pop(channel, None) is not None:
+                self._cond.notify_all()
+
+    def current(self, channel, gen):
+        """True if nothing rescheduled or cancelled channel since generation gen."""
+        with self._cond:
+            return self._gen.get(channel, 0) == gen
+
+    def pending(self):
+        """{channel: seconds left} of the scheduled auto-offs."""
+        now = time.monotonic()
+        with self._cond:
+            return {ch: max(deadline - now, 0) for ch, (deadline, _, _) in self._pending.items()}
+
+    def join(self):
+        """Wait until no auto-off is pending."""
+        with self._cond:
+            while (self._pending or self._busy) and self._running:
+                self._cond.wait()
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(1)
+
+    def _due(self):
+        # scarta le voci annullate/riprogrammate, ritorna i canali scaduti
+        due = []
+        now = time.monotonic() + self.slack
+        while self._heap:
+            deadline, seq, ch = self._heap[0]
+            entry = self._pending.get(ch)
+            if entry is None or entry[1] != seq:
+                heapq.heappop(self._heap)
+            elif deadline <= now:
+                heapq.heappop(self._heap)
+                due.append((ch, self._gen.get(ch, 0), self._pending.pop(ch)[2]))
+            else:
+                break
+        return due
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._running:
+                    due = self._due()
+                    if due:
+                        self._busy = True
+                        break
+                    self._cond.wait(self._heap[0][0] - time.monotonic() if self._heap else None)
+                if not self._running:
+                    return
+            try:
+                self.target._auto_off(due)
+            except Exception as e:
+                print("Auto-off error:", e, file=sys.stderr)
+            with self._cond:
+                self._busy = False
+                self._cond.notify_all()
+
+
+class RS485Bus:
+    """Porta RS485 condivisa da più schede KMTronic.
+
+    Un solo thread possiede la porta ed esegue le transazioni (write e
+    lettura della risposta) una alla volta. Ogni scheda ha la sua coda e
+    le code sono servite a turno (round-robin), così una scheda con molti
+    comandi non blocca le altre.
+    Gli spegnimenti automatici di tutte le schede stanno in un solo
+    AutoOffScheduler, con chiave (board_id, channel).
+    """
+    def __init__(self, port='/dev/ttyS4', baudrate=9600, timeout=1):
         self.ser = serial.Serial(port, baudrate, bytesize=8, parity='N', stopbits=1, timeout=timeout)
+        self.scheduler = AutoOffScheduler(self)
+        self._relays = {}        # board_id -> KMTronicRelay
+        self._queues = {}        # board_id -> deque di (data, nread, future)
+        self._turn = deque()     # schede con richieste pendenti, in ordine di servizio
+        self._cond = threading.Condition()
+        self._running = True
+        self.requests = {}       # board_id -> transazioni eseguite
+        self._thread = threading.Thread(target=self._run, name="rs485-bus", daemon=True)
+        self._thread.start()
+
+    def board(self, board_id):
+        """KMTronicRelay for board_id on this bus (one per board)."""
+        relay = self._relays.get(board_id)
+        if relay is None:
+            relay = KMTronicRelay(board_id=board_id, bus=self)
+        return relay
+
+    def submit(self, board_id, data, nread=0):
+        """Queue a transaction; the Future gets the nread bytes answered."""
+        fut = Future()
+        with self._cond:
+            if not self._running:
+                raise IOError('RS485 bus closed')
+            queue = self._queues.setdefault(board_id, deque())
+            if not queue:
+                self._turn.append(board_id)
+            queue.append((data, nread, fut))
+            self._cond.notify()
+        return fut
+
+    def transact(self, board_id, data, nread=0):
+        return self.submit(board_id, data, nread).result()
+
+    def close(self):
+        self.scheduler.stop()
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        self._thread.join(2)
+        self.ser.close()
+
+    def _auto_off(self, due):
+        # chiamato dal thread di AutoOffScheduler con [((board_id, channel), gen, callback), ...]
+        boards = {}
+        for (board_id, ch), gen, cb in due:
+            boards.setdefault(board_id, []).append((ch, gen, cb))
+        for board_id, entries in boards.items():
+            relay = self._relays.get(board_id)
+            if relay is None:
+                continue
+            try:
+                relay._auto_off(entries)
+            except Exception as e:
+                print("Auto-off error:", e, file=sys.stderr)
+
+    def _next(self):
+        # prossima richiesta: una per scheda a turno
+        board_id = self._turn.popleft()
+        queue = self._queues[board_id]
+        request = queue.popleft()
+        if queue:
+            self._turn.append(board_id)
+        return board_id, request
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._running and not self._turn:
+                    self._cond.wait()
+                if not self._turn:
+                    return
+                board_id, (data, nread, fut) = self._next()
+            if not fut.set_running_or_notify_cancel():
+                continue
+            try:
+                if nread:
+                    self.ser.reset_input_buffer()
+                self.ser.write(data)
+                self.ser.flush()
+                resp = self.ser.read(nread) if nread else b''
+            except Exception as e:
+                fut.set_exception(e)
+                continue
+            self.requests[board_id] = self.requests.get(board_id, 0) + 1
+            fut.set_result(resp)
+
+
+class KMTronicRelay:
+    STATUS_BACKOFF_MAX = 0.05   # s, attesa massima tra due letture di wait_status()
+
+    def __init__(self, port='/dev/ttyS4', baudrate=9600, board_id=1, timeout=1, bus=None):
+        # senza bus la scheda apre la porta per conto suo (bus con una sola scheda)
+        self._own_bus = bus is None
+        self.bus = RS485Bus(port, baudrate, timeout) if bus is None else bus
         self.board_id = board_id
-        self.lock = threading.Lock()
         self.auto_off_channels = set()  # tiene traccia dei relè spenti automaticamente
+        # lo scheduler è del bus, condiviso dalle schede: chiavi (board_id, channel)
+        self.scheduler = self.bus.scheduler
+        self.bus._relays[board_id] = self
+        # serializza i comandi manuali e gli spegnimenti automatici della scheda
+        self._write_lock = threading.Lock()
+        # cache dello stato, aggiornata dai comandi e dalle letture
+        self.last_status = None     # {1..8: bool}, None = mai letto
+        self.status_time = None     # monotonic dell'ultima lettura dalla scheda
+        self._status_lock = threading.Lock()
+        self._subscribers = []
+        self._poller = None
 
     def _cmd_bytes(self, channel, on=True):
         if not (1 <= channel <= 8):
             raise ValueError('Channel must be 1-8')
-        return bytes([0xFF, channel, 0x01 if on else 0x00])
+        # la scheda con ID n risponde ai relè (n-1)*8+1 .. (n-1)*8+8
+        return bytes([0xFF, (self.board_id - 1) * 8 + channel, 0x01 if on else 0x00])
+
+    def _frames(self, channels, on):
+        # un frame da 3 byte per canale, inviati con una sola write()
+        return b''.join(self._cmd_bytes(ch, on) for ch in channels)
+
+    def set_relay(self, channels, on=True, duration=None, status_callback=None,
+                  verify=False, verify_timeout=0.5):
+        """Switch channels with a single write().
 
-    def set_relay(self, channels, on=True, duration=None, timers_list=None, status_callback=None):
+        Any pending auto-off of the channels is cancelled; with on=True and
+        duration (s) a new one is scheduled. status_callback(status, auto_off=True)
+        is called after the auto-off.
+        verify=True reads the status back until every channel is in the
+        requested state (or verify_timeout expires) and returns it;
+        otherwise returns None without waiting.
+        """
         if isinstance(channels, int):
             channels = [channels]
-        with self.lock:
+        frames = self._frames(channels, on)
+        with self._write_lock:
             for ch in channels:
-                self.ser.write(self._cmd_bytes(ch, on))
-                if not on and ch in self.auto_off_channels:
-                    self.auto_off_channels.discard(ch)
-        time.sleep(0.1)
+                self.scheduler.cancel((self.board_id, ch))
+            self.bus.transact(self.board_id, frames)
+        if not on:
+            self.auto_off_channels.difference_update(channels)
+        self._commanded(channels, on, 'write')
 
         if duration is not None and on:
-            t = threading.Thread(target=self._timer_off, args=(channels, duration, status_callback))
-            t.start()
-            if timers_list is not None:
-                timers_list.append(t)
-
-    def _timer_off(self, channels, duration, status_callback):
-        time.sleep(duration)
-        with self.lock:
             for ch in channels:
-                self.ser.write(self._cmd_bytes(ch, False))
-                self.auto_off_channels.add(ch)
-        if status_callback is not None:
+                self.scheduler.schedule((self.board_id, ch), duration, status_callback)
+
+        if verify:
+            return self.wait_status(channels, on, verify_timeout)
+
+    def wait_status(self, channels, on, timeout=0.5):
+        """Poll get_status() until channels are all on/off; return the last status.
+
+        Between two reads waits one frame time, doubling up to STATUS_BACKOFF_MAX,
+        so a slow board does not get a status request back to back.
+        """
+        deadline = time.monotonic() + timeout
+        # un frame da 3 byte, 10 bit per byte: ~3 ms a 9600 baud
+        delay = 30.0 / self.bus.ser.baudrate
+        while True:
+            st = self._read_status()
+            now = time.monotonic()
+            if all(st[ch] == on for ch in channels) or now >= deadline:
+                # solo il risultato finale aggiorna la cache
+                self._update_status(st, 'read', read=True)
+                return st
+            time.sleep(min(delay, deadline - now))
+            delay = min(delay * 2, self.STATUS_BACKOFF_MAX)
+
+    def _auto_off(self, due):
+        # chiamato da RS485Bus._auto_off() con [(channel, gen, callback), ...] della scheda
+        with self._write_lock:
+            # un set_relay() dopo la scadenza ha cambiato la generazione: niente OFF
+            due = [(ch, cb) for ch, gen, cb in due if self.scheduler.current((self.board_id, ch), gen)]
+            if not due:
+                return
+            channels = [ch for ch, _ in due]
+            self.bus.transact(self.board_id, self._frames(channels, False))
+        callbacks = {cb for _, cb in due if cb is not None}
+        self.auto_off_channels.update(channels)
+        self._commanded(channels, False, 'auto_off')
+        if callbacks:
             try:
                 st = self.get_status()
-                status_callback(st, auto_off=True)
+                for callback in callbacks:
+                    callback(st, auto_off=True)
             except:
                 pass
 
-    def get_status(self):
+    def get_status(self, source='read'):
+        st = self._read_status()
+        self._update_status(st, source, read=True)
+        return st
+
+    def _read_status(self):
         cmd = bytes([0xFF, 0xA1 + (self.board_id - 1), 0x00])
-        with self.lock:
-            self.ser.write(cmd)
-            resp = self.ser.read(8)
+        resp = self.bus.transact(self.board_id, cmd, 8)
         if len(resp) != 8:
             raise IOError('Read incomplete status: got %d bytes' % len(resp))
         return {i+1: (resp[i] == 1) for i in range(8)}
 
+    # -------------------- status cache --------------------
+    def status(self, max_age=None):
+        """Cached status; read from the board if never read or older than max_age s."""
+        with self._status_lock:
+            st, t = self.last_status, self.status_time
+        if st is None or t is None or (max_age is not None and time.monotonic() - t > max_age):
+            return self.get_status()
+        return dict(st)
+
+    def subscribe(self, callback):
+        """callback(status, changed, source) on every change of the cached status.
+
+        changed is the set of channels that changed, source one of
+        'write', 'auto_off' (commanded state) or 'read', 'poll' (board).
+        """
+        self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        self._subscribers.remove(callback)
+
+    def _commanded(self, channels, on, source):
+        with self._status_lock:
+            if self.last_status is None:
+                return
+            st = dict(self.last_status)
+        st.update({ch: on for ch in channels})
+        self._update_status(st, source)
+
+    def _update_status(self, st, source, read=False):
+        with self._status_lock:
+            old = self.last_status
+            self.last_status = st
+            if read:
+                self.status_time = time.monotonic()
+        changed = {ch for ch in st if old is None or old.get(ch) != st[ch]}
+        if changed:
+            for callback in list(self._subscribers):
+                try:
+                    callback(dict(st), changed, source)
+                except Exception as e:
+                    print("Status subscriber error:", e, file=sys.stderr)
+        if self._poller is not None and (changed or source in ('write', 'auto_off')):
+            self._poller.activity()
+
+    def start_poller(self, min_interval=1.0, max_interval=16.0):
+        """Start the (single) adaptive status poller."""
+        if self._poller is None:
+            self._poller = StatusPoller(self, min_interval, max_interval)
+        return self._poller
+
     def close(self):
-        self.ser.close()
+        # annulla gli spegnimenti pendenti della scheda, non quelli delle altre
+        for board_id, ch in list(self.scheduler.pending()):
+            if board_id == self.board_id:
+                self.scheduler.cancel((board_id, ch))
+        if self.bus._relays.get(self.board_id) is self:
+            del self.bus._relays[self.board_id]
+        if self._poller is not None:
+            self._poller.stop()
+        if self._own_bus:
+            self.bus.close()
+
+
+class StatusPoller:
+    """Polling adattivo dello stato della scheda.
+
+    Dopo un comando o un cambiamento interroga ogni min_interval s, poi
+    raddoppia l'intervallo fino a max_interval finché lo stato non cambia.
+    Se la cache è stata appena aggiornata da un'altra lettura il poll
+    viene saltato: il bus resta libero per i comandi.
+    """
+    def __init__(self, relay, min_interval=1.0, max_interval=16.0):
+        self.relay = relay
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        self.polls = 0
+        self._kicked = False
+        self._wake = threading.Event()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="kmt-poller", daemon=True)
+        self._thread.start()
+
+    def activity(self):
+        """Back to the fastest polling rate (next poll in min_interval s)."""
+        self.interval = self.min_interval
+        self._kicked = True
+        self._wake.set()
+
+    def stop(self):
+        self._running = False
+        self._wake.set()
+        self._thread.join(1)
+
+    def _run(self):
+        while self._running:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            if not self._running:
+                return
+            if self._kicked:
+                # riparte il conteggio: la scheda ha appena ricevuto un comando
+                self._kicked = False
+                continue
+            t = self.relay.status_time
+            if t is not None and time.monotonic() - t < self.interval:
+                continue
+            before = self.relay.last_status
+            try:
+                st = self.relay.get_status('poll')
+            except Exception:
+                continue
+            self.polls += 1
+            if st == before:
+                self.interval = min(self.interval * 2, self.max_interval)
 
 def format_status(st, use_color=True, auto_off_channels=set()):
     parts = []
@@ -85,16 +464,12 @@ def parse_channels(ch_str):
     return [int(x) for x in ch_str.split(',')]
 
 
-def status_updater(relay, use_color):
-    while True:
-        try:
-            st = relay.get_status()
-            if st != relay.last_status:
-                print("\n[Auto Status] " + format_status(st, use_color))
-                relay.last_status = st
-        except:
-            pass
-        time.sleep(1)  # Controlla ogni secondo
+def status_printer(use_color):
+    """Subscriber that prints the changes not caused by our own commands."""
+    def callback(st, changed, source):
+        if source == 'poll':
+            print("\n[Auto Status] " + format_status(st, use_color))
+    return callback
 
 
 def main():
@@ -108,15 +483,14 @@ def main():
 
     relay = KMTronicRelay(port=args.port, board_id=args.id)
     use_color = not args.nocolor
-    timers_list = []
 
     def show_status(st, auto_off=False):
         print(format_status(st, use_color, relay.auto_off_channels))
     
-    # Thread di aggiornamento automatico dello status in interattivo
+    # Aggiornamento automatico dello status in interattivo
     if sys.stdin.isatty():
-        t = threading.Thread(target=status_updater, args=(relay, use_color), daemon=True)
-        t.start()
+        relay.subscribe(status_printer(use_color))
+        relay.start_poller()
 
     try:
         while True:
@@ -157,20 +531,20 @@ def main():
                     except:
                         print("Invalid -t value")
                         continue
-                relay.set_relay(channels, on=(action=='ON'), duration=duration, timers_list=timers_list,
-                                status_callback=show_status if (args.verbose or sys.stdin.isatty()) else None)
-                if args.verbose or sys.stdin.isatty():
-                    try:
-                        st = relay.get_status()
-                        print(format_status(st, use_color, relay.auto_off_channels))
-                    except:
-                        pass
+                show = args.verbose or sys.stdin.isatty()
+                try:
+                    st = relay.set_relay(channels, on=(action=='ON'), duration=duration,
+                                         status_callback=show_status if show else None, verify=show)
+                except Exception as e:
+                    print("RS485 error:", e)
+                    continue
+                if show:
+                    print(format_status(st, use_color, relay.auto_off_channels))
             else:
                 print("Unknown command. Type HELP.")
 
-        # Se input da pipe, attendi tutti i timer
-        for t in timers_list:
-            t.join()
+        # Se input da pipe, attendi tutti gli spegnimenti programmati
+        relay.scheduler.join()
 
     finally:
         relay.close()
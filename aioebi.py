@@ -0,0 +1,371 @@
+#!/usr/bin/python3
+
+"""asyncio front-end for the EBI library.
+
+AsyncEBI exposes the same commands as EBI (device_state, operating_channel,
+send_dataLW, ...) as coroutines. The serial port is read by the event loop
+(add_reader on the port fd) and every frame is dispatched:
+
+- answers are matched to the pending request by echoed opcode (cmd | 0x80)
+- everything else (0xE0 received data, 0x84 boot/state banner, ...) goes to
+  the AsyncEBI.events queue
+
+Request encoding and answer decoding are the ones of EBI: each command runs
+EBI's method in a single worker thread, whose send() hands the frame back to
+the event loop and waits for the matching answer. The single worker also
+keeps commands strictly sequential, as the module expects.
+"""
+
+import sys
+import os
+import asyncio
+import functools
+import inspect
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import serial
+
+from ebi import EBI
+from ebiframe import FrameEncoder, FrameDecoder
+
+logger = logging.getLogger("ebi")
+
+
+class AsyncEBI(EBI):
+    # comandi di EBI esposti come coroutine
+    COMMANDS = (
+        'device_info', 'device_state', 'firmware_version',
+        'uart', 'output_power', 'operating_channel', 'energy_save', 'region',
+        'network_address', 'network_identifier', 'network_preference',
+        'network_stop', 'network_start',
+        'send_data', 'send_dataLW',
+        'ieee_address', 'physical_address',
+        'app_key', 'app_Skey', 'nwk_Skey',
+        'apply_profile',
+    )
+    def __init__(self, dev, debug=False, queue_size=32):
+        # EBI.__init__ non viene chiamato: la porta si apre con open()
+        self.debug = debug
+        self.dev = dev
+        self.ser = None
+        self.state = {'state': None}
+        self.cache = True
+        self._cache = {}
+        self._encoder = FrameEncoder()
+        self._decoder = FrameDecoder()
+        self._queue_size = queue_size
+        self._loop = None
+        self._pending = {}
+        self._lock = None
+        self._gap_timer = None     # scarta un frame incompleto dopo FRAME_GAP s
+        self._port_error = None    # la porta non dà più dati (EOF o errore)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="aioebi")
+        self.events = None
+
+    async def open(self):
+        if self.debug:
+            print("---Start Init")
+        self._loop = asyncio.get_running_loop()
+        self.events = asyncio.Queue(self._queue_size)
+        self._lock = asyncio.Lock()
+        self.ser = serial.Serial(self.dev, baudrate=9600, timeout=0)
+        self._loop.add_reader(self.ser.fileno(), self._on_readable)
+        await self.device_state()
+        for ret in (await self.device_info(), await self.firmware_version()):
+            if isinstance(ret, dict):
+                self.state.update(ret)
+        if self.debug:
+            print("Init End---")
+        return self
+
+    async def close(self):
+        if self._gap_timer is not None:
+            self._gap_timer.cancel()
+            self._gap_timer = None
+        if self.ser is not None:
+            self._loop.remove_reader(self.ser.fileno())
+            self.ser.close()
+            self.ser = None
+        for fut in self._pending.values():
+            fut.cancel()
+        self._pending.clear()
+        self._executor.shutdown(wait=False)
+
+    def __del__(self):
+        try:
+            if self.ser is not None:
+                self.ser.close()
+        except Exception:
+            pass
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    # -------------------- I/O --------------------
+    def _on_readable(self):
+        try:
+            data = os.read(self.ser.fileno(), 4096)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self._port_lost(e)
+            return
+        if not data:
+            self._port_lost("end of file")
+            return
+        self._decoder.feed(data)
+        bcc_errors = self._decoder.bcc_errors
+        for frame in self._decoder:
+            if self.debug:
+                print('   ans <-', self.hex(frame))
+            if not frame:
+                self.metrics.inc('ebi_dropped_frames_total', reason='empty')
+                continue
+            try:
+                self._dispatch(frame)
+            except Exception as e:
+                logger.error(f"read(): frame {self.hex(frame)} dropped: {e!r}")
+                self.metrics.inc('ebi_dropped_frames_total', reason='dispatch')
+        if self._decoder.bcc_errors != bcc_errors:
+            self.metrics.inc('ebi_bcc_errors_total', self._decoder.bcc_errors - bcc_errors)
+        # un frame arriva senza pause: come EBI._read_loop, un frame parziale
+        # seguito da FRAME_GAP s di silenzio viene scartato
+        if self._gap_timer is not None:
+            self._gap_timer.cancel()
+            self._gap_timer = None
+        if self._decoder.pending:
+            self._gap_timer = self._loop.call_later(self.FRAME_GAP, self._frame_gap)
+
+    def _frame_gap(self):
+        self._gap_timer = None
+        if self._decoder.pending:
+            logger.error(f"read(): incomplete frame dropped ({self._decoder.pending} bytes)")
+            self.metrics.inc('ebi_dropped_frames_total', reason='incomplete')
+            self._decoder.reset()
+
+    def _port_lost(self, reason):
+        # EOF o errore di lettura: la porta non darà altri dati, il reader
+        # viene tolto (altrimenti il loop lo richiamerebbe all'infinito) e le
+        # richieste in attesa falliscono subito
+        logger.error(f"AsyncEBI: serial port lost: {reason}")
+        self._port_error = ConnectionError(f"serial port lost: {reason}")
+        self._loop.remove_reader(self.ser.fileno())
+        for fut in self._pending.values():
+            if not fut.done():
+                fut.set_exception(self._port_error)
+        self._pending.clear()
+
+    def _dispatch(self, frame):
+        fut = self._pending.pop(frame[0], None)
+        if fut is not None and not fut.done():
+            fut.set_result(frame)
+            return
+        if frame[0] == 0x84 and len(frame) >= 2:
+            self._set_state(frame[1])
+            if frame[1] in self.BOOT_STATES:
+                self.invalidate()
+        elif frame[0] != 0xE0:
+            self.metrics.inc('ebi_unexpected_frames_total', opcode=f"0x{frame[0]:02X}")
+        if self.events.full():
+            dropped = self.events.get_nowait()
+            logger.error(f"AsyncEBI: event queue full, dropping frame 0x{dropped[0]:02X}")
+            self.metrics.inc('ebi_dropped_frames_total', reason='queue_full')
+        self.events.put_nowait(frame)
+
+    def _expect(self, opcode):
+        if opcode in self._pending:
+            raise RuntimeError(f"answer 0x{opcode:02X} already awaited")
+        fut = self._loop.create_future()
+        self._pending[opcode] = fut
+        return fut
+
+    async def _wait(self, opcode, fut, timeout):
+        try:
+            return await asyncio.wait_for(fut, timeout)
+        except (asyncio.TimeoutError, ConnectionError):
+            return None
+        finally:
+            if self._pending.get(opcode) is fut:
+                del self._pending[opcode]
+
+    def _write(self, command):
+        packet = self._encoder.encode(command)
+        if self.debug:
+            print('   cmd ->', self.hex(packet))
+        self.ser.write(packet)
+
+    async def request(self, command, timeout=None):
+        """Send command and return the answer (without echoed opcode), or None."""
+        if timeout is None:
+            timeout = self.TIMEOUT.get(command[0], self.DEFAULT_TIMEOUT)
+        expected = (command[0] | 0x80) & 0xFF
+        opcode = f"0x{command[0]:02X}"
+        self.metrics.inc('ebi_commands_total', opcode=opcode)
+        async with self._lock:
+            if self._port_error is not None:
+                logger.error(f"send() exception: {self._port_error}")
+                self.metrics.inc('ebi_no_response_total', opcode=opcode, reason='closed')
+                return None
+            fut = self._expect(expected)
+            start = self._loop.time()
+            try:
+                self._write(command)
+            except Exception as e:
+                self._pending.pop(expected, None)
+                logger.error(f"send() exception: {e}")
+                self.metrics.inc('ebi_no_response_total', opcode=opcode, reason='write')
+                return None
+            ans = await self._wait(expected, fut, timeout)
+        if ans is None:
+            logger.error(f"send(): no answer from module to {opcode}")
+            self.metrics.inc('ebi_no_response_total', opcode=opcode,
+                             reason='closed' if self._port_error is not None else 'timeout')
+            return None
+        self.metrics.observe('ebi_command_seconds', self._loop.time() - start, opcode=opcode)
+        return ans[1:]
+
+    def send(self, command, timeout=None):
+        # chiamato dai metodi di EBI nel thread worker
+        if self._loop is None:
+            raise RuntimeError("AsyncEBI not opened")
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self._loop:
+            raise RuntimeError("blocking EBI call from the event loop, use the coroutine")
+        return asyncio.run_coroutine_threadsafe(self.request(command, timeout), self._loop).result()
+
+    def read(self, timeout=None):
+        raise RuntimeError("AsyncEBI frames are read by the event loop, use events/receive()")
+
+    # -------------------- Comandi con frame non sollecitati --------------------
+    async def reset(self):
+        async with self._lock:
+            return await self._reset()
+
+    async def _reset(self):
+        if self.debug:
+            print("---Start Reset")
+        self.invalidate()
+        answer = self._expect(0x85)
+        boot = self._expect(0x84)
+        try:
+            self._write([0x05])
+        except Exception as e:
+            logger.error(f"send() exception: {e}")
+        ans = await self._wait(0x85, answer, self.TIMEOUT[0x05])
+        if not ans or len(ans) < 2:
+            self._pending.pop(0x84, None)
+            logger.error("reset(): no response to reset command")
+            self._set_state(None)
+            return {'status': 'NoResponse'}
+        status = EBI.STATUS.get(ans[1], ans[1])
+        boot = await self._wait(0x84, boot, self.BOOT_TIMEOUT)
+        if not boot or len(boot) < 2:
+            logger.error("reset(): invalid/absent boot banner")
+            self._set_state(None)
+            return {'status': status, 'boot_state': None}
+        self._set_state(boot[1])
+        if self.debug:
+            print('      Status  : ', status)
+            print('      BOOT    : ', self.state['state'])
+            print("END Reset---")
+        return {'status': status, 'boot_state': self.state['state']}
+
+    async def current_state(self):
+        """Device state from the local mirror; the module is queried only if it is unknown."""
+        if self.state.get('state') is None:
+            await self.refresh()
+        return self.state.get('state')
+
+    async def refresh(self):
+        """Re-read the device state from the module and return it."""
+        await self.device_state()
+        return self.state.get('state')
+
+    async def next_event(self, timeout=None):
+        """Return the next unsolicited frame (opcode + params), or None on timeout."""
+        try:
+            return await asyncio.wait_for(self.events.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    async def receive(self, protocol=0, timeout=None):
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while True:
+            remaining = None if deadline is None else max(deadline - loop.time(), 0)
+            ans = await self.next_event(remaining)
+            if ans is None or ans[0] == 0xE0:
+                return self.parse_received(ans, protocol)
+            logger.error(f"receive(): unexpected header 0x{ans[0]:02X}")
+
+
+class _SyncView:
+    """An AsyncEBI seen with EBI's blocking methods, for the worker thread.
+
+    EBI's composite commands (apply_profile) call other commands on self:
+    through the view they get the blocking EBI method instead of the
+    AsyncEBI coroutine. Attributes are read and written on the AsyncEBI.
+    """
+    def __init__(self, ebi):
+        object.__setattr__(self, '_ebi', ebi)
+
+    def __getattr__(self, name):
+        ebi = object.__getattribute__(self, '_ebi')
+        attr = getattr(type(ebi), name, None)
+        if asyncio.iscoroutinefunction(attr) and hasattr(EBI, name):
+            return getattr(EBI, name).__get__(self)
+        if inspect.isfunction(attr) and not asyncio.iscoroutinefunction(attr):
+            return attr.__get__(self)
+        return getattr(ebi, name)
+
+    def __setattr__(self, name, value):
+        setattr(object.__getattribute__(self, '_ebi'), name, value)
+
+
+def _command(name):
+    method = getattr(EBI, name)
+
+    async def command(self, *args, **kwargs):
+        return await self._loop.run_in_executor(
+            self._executor, functools.partial(method, _SyncView(self), *args, **kwargs))
+
+    command.__name__ = name
+    command.__qualname__ = 'AsyncEBI.' + name
+    command.__doc__ = method.__doc__
+    return command
+
+
+for _name in AsyncEBI.COMMANDS:
+    setattr(AsyncEBI, _name, _command(_name))
+
+
+if __name__ == "__main__":
+    # Esempio: python3 aioebi.py /dev/ttyS6
+    from logsetup import setup_logging
+    setup_logging()
+    # stampa lo stato e poi tutti i frame non sollecitati ricevuti
+    dev = "/dev/ttyS6"
+    try:
+        dev = sys.argv[1]
+    except Exception:
+        pass
+
+    async def main():
+        async with AsyncEBI(dev) as e:
+            print("DEVICE STATE", e.state)
+            print("OPERATING CHANNEL:", await e.operating_channel())
+            while True:
+                frame = await e.next_event()
+                print("EVENT", e.hex(frame))
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,272 @@
+#!/usr/bin/python3
+
+"""Benchmark suite for the EBI stack, against the ebiemu.py emulator.
+
+    python3 bench.py [-n N] [--only codec,roundtrip,read,e2e] [--json FILE]
+                     [--compare OLD.json] [--threshold 0.2]
+
+- codec:     ebiframe encode/decode throughput
+- roundtrip: EBI.send() round trip per opcode (emulator with no latency)
+- read:      EBI.read() throughput of unsolicited 0xE0 frames
+- e2e:       0xE0 downlink written by the module -> DeviceController.deviceSet
+             done and feedback queued, through the event loop of the auto
+             mode (EmbitShell._on_frames on the EBI event fd; embitshell on
+             Hardware.mock(): GPIO and RS485 in memory, no gpiod or
+             config.py needed)
+
+Results are printed and, with --json, written as
+{"meta": {...}, "results": {bench: {metric: value}}}. Times are in
+microseconds (*_us, lower is better), throughputs in frames/s (*_per_s,
+higher is better). --compare reports the change of every metric against a
+previous run (max_us excluded) and exits with 1 if one got worse by more
+than --threshold.
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+
+from ebiframe import FrameEncoder, FrameDecoder
+from ebiemu import EmbitEmulator
+
+
+def timings(samples):
+    """Summary of a list of durations in seconds, in microseconds."""
+    samples = sorted(samples)
+    n = len(samples)
+    return {
+        'n': n,
+        'mean_us': round(sum(samples) / n * 1e6, 1),
+        'p50_us': round(samples[n // 2] * 1e6, 1),
+        'p95_us': round(samples[min(n - 1, int(n * 0.95))] * 1e6, 1),
+        'max_us': round(samples[-1] * 1e6, 1),
+    }
+
+
+# -------------------- codec --------------------
+def bench_codec(n):
+    command = [0x50, 0x0D, 0x00, 0x06] + list(b'T:R;N:1;S:ON')
+    encoder = FrameEncoder()
+    frame = bytes(encoder.encode(command))
+    stream = frame * 16
+    decoder = FrameDecoder()
+
+    t = time.perf_counter()
+    for _ in range(n):
+        encoder.encode(command)
+    encode = time.perf_counter() - t
+
+    t = time.perf_counter()
+    for _ in range(n):
+        decoder.feed(frame)
+        decoder.pop()
+    decode = time.perf_counter() - t
+
+    chunks = max(n // 16, 1)
+    t = time.perf_counter()
+    for _ in range(chunks):
+        decoder.feed(stream)
+        for _ in decoder:
+            pass
+    decode_stream = time.perf_counter() - t
+
+    return {
+        'codec': {
+            'encode_per_s': round(n / encode),
+            'decode_per_s': round(n / decode),
+            'decode_stream_per_s': round(chunks * 16 / decode_stream),
+        }
+    }
+
+
+# -------------------- EBI round trip --------------------
+ROUNDTRIP = {
+    'device_state': [0x04],
+    'firmware_version': [0x06],
+    'output_power': [0x10],
+    'operating_channel': [0x11],
+    'physical_address': [0x20],
+    'send_dataLW': [0x50, 0x0D, 0x00, 0x06] + list(b'T:R;N:1;S:ON'),
+}
+
+
+def _ebi(emu):
+    from ebi import EBI
+    return EBI(emu.port, cache=False)
+
+
+def bench_roundtrip(n):
+    results = {}
+    with EmbitEmulator(state=0x30) as emu:
+        e = _ebi(emu)
+        try:
+            for name, command in ROUNDTRIP.items():
+                samples = []
+                for _ in range(n):
+                    t = time.perf_counter()
+                    ans = e.send(command)
+                    samples.append(time.perf_counter() - t)
+                    if ans is None:
+                        raise RuntimeError(f"no answer to {name}")
+                results['roundtrip_' + name] = timings(samples)
+        finally:
+            e.close()
+    return results
+
+
+def bench_read(n):
+    with EmbitEmulator() as emu:
+        e = _ebi(emu)
+        try:
+            t = time.perf_counter()
+            for i in range(n):
+                emu.inject(b'T:R;N:1;S:ON', port=1)
+                # il lettore non deve perdere frame per coda piena
+                if e.read(1) is None:
+                    raise RuntimeError("downlink lost")
+            elapsed = time.perf_counter() - t
+        finally:
+            e.close()
+    return {'read': {'frames_per_s': round(n / elapsed)}}
+
+
+# -------------------- end-to-end --------------------
+def bench_e2e(n):
+    try:
+        import embitshell
+    except Exception as e:
+        return {'e2e': {'skipped': f"embitshell not importable: {e!r}"}}
+
+    results = {}
+    with EmbitEmulator(latency=0.001) as emu:
+        shell = embitshell.EmbitShell(emu.port, hardware=embitshell.Hardware.mock(emu))
+        done = threading.Event()
+        stamps = {}
+        feedback = shell.feedback
+        deviceSet = shell.controller.deviceSet
+
+        def timed_feedback(message, port=None):
+            feedback(message, port)
+            stamps['queued'] = time.perf_counter()
+            done.set()
+
+        def timed_deviceSet(*args):
+            t = time.perf_counter()
+            ret = deviceSet(*args)
+            stamps['actuation'] = time.perf_counter() - t
+            return ret
+
+        shell.feedback = timed_feedback
+        shell.controller.deviceSet = timed_deviceSet
+
+        # lo stesso loop di do_auto: i frame arrivano a _on_frames dal fd degli eventi EBI
+        shell.loop = shell._event_loop()
+        thread = threading.Thread(target=shell.loop.run, daemon=True)
+        thread.start()
+        try:
+            for label, commands in (('text', [(b'L:g:ON', 1), (b'L:g:OFF', 1)]),
+                                    ('binary', [(bytes([0x01, 0x51]), embitshell.binaryFPort),
+                                                (bytes([0x01, 0x41]), embitshell.binaryFPort)])):
+                latency, actuation = [], []
+                for i in range(n):
+                    data, fport = commands[i % 2]
+                    done.clear()
+                    t = time.perf_counter()
+                    emu.inject(data, fport)
+                    if not done.wait(5):
+                        raise RuntimeError("no feedback for downlink %r" % data)
+                    latency.append(stamps['queued'] - t)
+                    actuation.append(stamps.get('actuation', 0.0))
+                results['e2e_' + label] = timings(latency)
+                if label == 'text':
+                    results['e2e_deviceSet'] = timings(actuation)
+        finally:
+            shell.loop.stop()
+            thread.join(5)
+            if shell._control is not None:
+                shell._control.close()
+            shell.loop.close()
+            shell.loop = None
+            shell.uplink.close(5)
+            shell._e.close()
+    return results
+
+
+BENCHES = {
+    'codec': (bench_codec, 100000),
+    'roundtrip': (bench_roundtrip, 200),
+    'read': (bench_read, 2000),
+    'e2e': (bench_e2e, 200),
+}
+
+
+def meta():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except Exception:
+        commit = None
+    return {
+        'time': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'commit': commit,
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'node': platform.node(),
+    }
+
+
+def compare(old, new, threshold):
+    """Print the change of every metric; return the list of regressions."""
+    regressions = []
+    for bench, metrics in new.items():
+        for metric, value in metrics.items():
+            before = old.get(bench, {}).get(metric)
+            if not isinstance(value, (int, float)) or not isinstance(before, (int, float)) or not before:
+                continue
+            if metric.startswith('max'):
+                continue                              # un solo campione, troppo rumoroso
+            if metric.endswith('_us'):
+                change = value / before - 1          # più alto = peggio
+            elif metric.endswith('_per_s'):
+                change = before / value - 1 if value else float('inf')
+            else:
+                continue
+            flag = ''
+            if change > threshold:
+                flag = '  REGRESSION'
+                regressions.append((bench, metric))
+            print('%-28s %-20s %12s -> %12s  %+6.1f%%%s' % (bench, metric, before, value, change * 100, flag))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='EBI benchmark suite')
+    parser.add_argument('-n', type=int, help='iterations (default per benchmark)')
+    parser.add_argument('--only', default=','.join(BENCHES), help='comma separated benchmarks')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--compare', help='previous results to compare with')
+    parser.add_argument('--threshold', type=float, default=0.2, help='regression threshold (0.2 = 20%%)')
+    args = parser.parse_args()
+
+    results = {}
+    for name in args.only.split(','):
+        fn, n = BENCHES[name]
+        results.update(fn(args.n or n))
+    report = {'meta': meta(), 'results': results}
+
+    for bench, metrics in results.items():
+        print('%-28s %s' % (bench, ' '.join('%s=%s' % kv for kv in metrics.items())))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        print()
+        if compare(old.get('results', {}), results, args.threshold):
+            sys.exit(1)
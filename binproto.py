@@ -0,0 +1,161 @@
+#!/usr/bin/python3
+
+"""Compact binary command format for downlinks.
+
+Binary downlinks travel on their own FPort (config.binaryFPort) next to the
+text commands ("R:1:ON"). A frame is one opcode byte followed by its args:
+
+OP_SET  (0x01): one byte per command
+    bit 7-5  device type  (R=0, X=1, L=2, D=3, A=4)
+    bit 4    state        (1 = ON)
+    bit 3-0  index        position in INDEXES[type], 0xF = all ('A')
+
+OP_MASK (0x02): three bytes per device type
+    type, select mask, state mask
+    bit i of the masks refers to INDEXES[type][i]
+
+e.g. RS485 relays 1-8 ON and GPIO relays 1 ON / 2 OFF:
+    02 01 FF FF 00 03 01
+
+OP_SNAPSHOT (0x03): as downlink (no args) asks for a state snapshot; the
+node answers on config.snapshotFPort with
+    03 SEQ R X L D IN
+    R, X, L, D  bit i = INDEXES[type][i] is ON (LEDs: lit)
+    IN          bit 0 = DIG_IN1, bit 1 = DIG_IN2
+
+FLAG_SEQ (0x80) on a downlink opcode: the next byte is a sequence number
+chosen by the sender, the args follow. A repeated (sequence, frame) is
+executed only once (see split_seq):
+    81 11 51    sequence 0x11, green LED ON
+"""
+
+OP_SET = 0x01
+OP_MASK = 0x02
+OP_SNAPSHOT = 0x03
+FLAG_SEQ = 0x80
+
+TYPES = ('R', 'X', 'L', 'D', 'A')
+INDEXES = {
+    'R': ('1', '2'),
+    'X': ('1', '2', '3', '4', '5', '6', '7', '8'),
+    'L': ('r', 'g', 'R', 'G', 'B'),
+    'D': ('P', '1', '2'),
+    'A': (),
+}
+ALL = 0x0F
+SNAPSHOT_TYPES = ('R', 'X', 'L', 'D')
+INPUTS = ('1', '2')
+
+
+def _index(devType, devNum):
+    if devNum == 'A':
+        return ALL
+    try:
+        return INDEXES[devType].index(devNum)
+    except ValueError:
+        raise ValueError("invalid index %r for type %s" % (devNum, devType))
+
+
+def encode_command(devType, devNum, devStatus):
+    """Single OP_SET command byte."""
+    if devType not in INDEXES:
+        raise ValueError("invalid device type %r" % devType)
+    state = 0x10 if devStatus == 'ON' else 0x00
+    return (TYPES.index(devType) << 5) | state | _index(devType, devNum)
+
+
+def _with_seq(frame, seq):
+    if seq is None:
+        return bytes(frame)
+    return bytes([frame[0] | FLAG_SEQ, seq & 0xFF] + list(frame[1:]))
+
+
+def split_seq(data):
+    """Return (seq, frame without the sequence number); seq is None if absent."""
+    if data and data[0] & FLAG_SEQ:
+        if len(data) < 2:
+            raise ValueError("truncated sequence number")
+        return data[1], bytes([data[0] & ~FLAG_SEQ]) + bytes(data[2:])
+    return None, bytes(data)
+
+
+def encode_set(commands, seq=None):
+    """OP_SET frame for a list of (devType, devNum, devStatus)."""
+    return _with_seq([OP_SET] + [encode_command(*c) for c in commands], seq)
+
+
+def encode_mask(states, seq=None):
+    """OP_MASK frame for {devType: {devNum: devStatus}}."""
+    frame = [OP_MASK]
+    for devType, channels in states.items():
+        select = value = 0
+        for devNum, devStatus in channels.items():
+            bit = 1 << _index(devType, devNum)
+            select |= bit
+            if devStatus == 'ON':
+                value |= bit
+        frame += [TYPES.index(devType), select, value]
+    return _with_seq(frame, seq)
+
+
+def decode(data):
+    """Return the list of (devType, devNum, devStatus) carried by a binary downlink."""
+    if not data:
+        raise ValueError("empty binary downlink")
+    data = split_seq(data)[1]
+    op, args = data[0], data[1:]
+    commands = []
+    if op == OP_SET:
+        for b in args:
+            code = b >> 5
+            if code >= len(TYPES):
+                raise ValueError("invalid device type code %d" % code)
+            devType = TYPES[code]
+            idx = b & 0x0F
+            if idx == ALL:
+                devNum = 'A'
+            elif idx < len(INDEXES[devType]):
+                devNum = INDEXES[devType][idx]
+            else:
+                raise ValueError("invalid index %d for type %s" % (idx, devType))
+            commands.append((devType, devNum, 'ON' if b & 0x10 else 'OFF'))
+    elif op == OP_MASK:
+        if len(args) % 3:
+            raise ValueError("truncated OP_MASK frame")
+        for i in range(0, len(args), 3):
+            code, select, value = args[i:i + 3]
+            if code >= len(TYPES):
+                raise ValueError("invalid device type code %d" % code)
+            devType = TYPES[code]
+            for bit, devNum in enumerate(INDEXES[devType]):
+                if select & (1 << bit):
+                    commands.append((devType, devNum, 'ON' if value & (1 << bit) else 'OFF'))
+    else:
+        raise ValueError("unknown binary opcode 0x%02X" % op)
+    return commands
+
+
+def encode_snapshot(seq, outputs, inputs):
+    """OP_SNAPSHOT uplink.
+
+    outputs: {devType: {devNum: bool}} for SNAPSHOT_TYPES
+    inputs:  {devNum: bool} for INPUTS
+    """
+    frame = [OP_SNAPSHOT, seq & 0xFF]
+    for devType in SNAPSHOT_TYPES:
+        states = outputs.get(devType, {})
+        frame.append(sum(1 << bit for bit, devNum in enumerate(INDEXES[devType]) if states.get(devNum)))
+    frame.append(sum(1 << bit for bit, devNum in enumerate(INPUTS) if inputs.get(devNum)))
+    return bytes(frame)
+
+
+def decode_snapshot(data):
+    """Return (seq, outputs, inputs) from an OP_SNAPSHOT uplink."""
+    if len(data) != 3 + len(SNAPSHOT_TYPES) or data[0] != OP_SNAPSHOT:
+        raise ValueError("invalid snapshot frame")
+    outputs = {}
+    for devType, bits in zip(SNAPSHOT_TYPES, data[2:]):
+        outputs[devType] = {devNum: bool(bits & (1 << bit)) for bit, devNum in enumerate(INDEXES[devType])}
+    bits = data[-1]
+    inputs = {devNum: bool(bits & (1 << bit)) for bit, devNum in enumerate(INPUTS)}
+    return data[1], outputs, inputs
@@ -4,13 +4,34 @@ import sys
 import serial
 import time
 import logging
+import os
+import queue
+import select
+import threading
+from ebiframe import FrameEncoder, FrameDecoder, bcc
+from metrics import REGISTRY
 
+# handler e livello li sceglie l'applicazione (logsetup.setup_logging)
 logger = logging.getLogger("ebi")
-logger.setLevel(logging.ERROR)
-file_handler = logging.FileHandler("/srv/samba/Acqua_Samba/emb-python/ebi_errors.log")
-formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s", datefmt="%Y-%m-%d %H:%M:%S")
-file_handler.setFormatter(formatter)
-logger.addHandler(file_handler)
+logger.addHandler(logging.NullHandler())
+
+
+class _Answer:
+    """Slot for the frame awaited by a command, filled by the reader thread."""
+    __slots__ = ('event', 'frame')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.frame = None
+
+    def set(self, frame):
+        self.frame = frame
+        self.event.set()
+
+    def wait(self, timeout):
+        self.event.wait(timeout)
+        return self.frame
+
 
 class EBI:
     STATUS = {
@@ -105,38 +126,84 @@ class EBI:
         0x01: 'RX WINDOW',
         0x02: 'TX ONLY',
     }
+    # secondi di attesa della risposta, per opcode del comando
+    TIMEOUT = {
+        0x05: 1,    # reset (il banner di boot ha BOOT_TIMEOUT in più)
+        0x30: 10,   # network stop
+        0x31: 10,   # network start (join)
+        0x50: 10,   # send data (airtime + finestre RX)
+    }
+    DEFAULT_TIMEOUT = 1
+    BOOT_TIMEOUT = 3
+    FRAME_GAP = 0.1     # s di silenzio dopo cui un frame incompleto viene scartato
+    BOOT_STATES = (0x00, 0x01)                      # 0x84 non atteso = reset del modulo
+    JOIN_CHANGES = ('address', 'power', 'channel')  # parametri cambiati dal modulo dopo il join
+    metrics = REGISTRY  # contatori e istogrammi per opcode (metrics.py)
 
-    def __init__(self, dev, debug=False):
+    def __init__(self, dev, debug=False, queue_size=32, cache=True):
         self.debug = debug
+        self.cache = cache
+        self._cache = {}
         if self.debug:
             print("---Start Init")
         self.dev = dev
-        # timeout prudente: molte operazioni fanno round-trip
-        self.ser = serial.Serial(self.dev, baudrate=9600, timeout=0.1)
+        # porta non bloccante: il reader aspetta i dati con select() e i
+        # comandi aspettano la risposta fino alla deadline di TIMEOUT
+        self.ser = serial.Serial(self.dev, baudrate=9600, timeout=0)
+        self._encoder = FrameEncoder()
+        self._decoder = FrameDecoder()
+        # la porta è letta solo dal thread reader: le risposte vanno al
+        # comando in attesa, i frame non sollecitati (0xE0, 0x84...) in coda
+        self._events = queue.Queue(queue_size)
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._tx_lock = threading.RLock()
+        # stato del modulo tenuto aggiornato localmente (vedi current_state)
+        self.state = {'state': None}
+        self._running = True
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        # un byte per ogni frame messo in coda: select()/selectors sul
+        # lettore dei frame non sollecitati (vedi event_fileno)
+        self._event_r, self._event_w = os.pipe()
+        os.set_blocking(self._event_r, False)
+        os.set_blocking(self._event_w, False)
+        self._reader = threading.Thread(target=self._read_loop, name="ebi-reader", daemon=True)
+        self._reader.start()
         # Init state (con protezioni)
         info = self.device_info()
-        state = self.device_state()
+        self.device_state()
         fw = self.firmware_version()
-        self.state = {}
         if isinstance(info, dict):
             self.state.update(info)
-        if isinstance(state, dict):
-            self.state.update(state)
         if isinstance(fw, dict):
             self.state.update(fw)
         if self.debug:
             print("Init End---")
 
+    def close(self):
+        self._running = False
+        reader = getattr(self, '_reader', None)
+        if reader is not None:
+            os.write(self._wakeup_w, b'\0')
+            if reader is not threading.current_thread():
+                reader.join(1)
+            os.close(self._wakeup_r)
+            os.close(self._wakeup_w)
+            os.close(self._event_r)
+            os.close(self._event_w)
+            self._reader = None
+        if getattr(self, 'ser', None):
+            self.ser.close()
+
     def __del__(self):
         try:
-            if getattr(self, 'ser', None):
-                self.ser.close()
+            self.close()
         except Exception:
             pass
 
     # -------------------- Helpers --------------------
     def bcc(self, packet):
-        return sum(packet) & 0xFF
+        return bcc(packet)
 
     def hex(self, arr):
         return ':'.join(map(lambda x: '%02x' % x, arr))
@@ -146,49 +213,187 @@ class EBI:
             return num - (1 << bits)
         return num
 
-    def read(self):
-        try:
-            header = self.ser.read(2)
-            if len(header) != 2:
-                return None
-            length = (header[0] << 8) + header[1]
-            payload = list(self.ser.read(length - 2))
-            ans = [header[0], header[1]] + payload
+    # -------------------- Reader --------------------
+    def _read_loop(self):
+        fds = [self.ser.fileno(), self._wakeup_r]
+        while self._running:
+            try:
+                # un frame arriva senza pause: un frame parziale seguito da
+                # FRAME_GAP s di silenzio è spazzatura (es. dopo un BCC errato)
+                ready, _, _ = select.select(fds, [], [], self.FRAME_GAP if self._decoder.pending else None)
+                if not self._running:
+                    break
+                if not ready:
+                    logger.error(f"read(): incomplete frame dropped ({self._decoder.pending} bytes)")
+                    self.metrics.inc('ebi_dropped_frames_total', reason='incomplete')
+                    self._decoder.reset()
+                    continue
+                chunk = self.ser.read(self.ser.in_waiting or 1)
+            except Exception as e:
+                if self._running:
+                    logger.error(f"read() exception: {e}")
+                    time.sleep(0.1)
+                continue
+            if not chunk:
+                continue
+            self._decoder.feed(chunk)
+            bcc_errors = self._decoder.bcc_errors
+            for frame in self._decoder:
+                if self.debug:
+                    print('   ans <-', self.hex(frame))
+                if not frame:
+                    # frame senza opcode: nessuno lo aspetta
+                    self.metrics.inc('ebi_dropped_frames_total', reason='empty')
+                    continue
+                try:
+                    self._dispatch(frame)
+                except Exception as e:
+                    # il thread del reader deve sopravvivere a qualunque frame
+                    logger.error(f"read(): frame {self.hex(frame)} dropped: {e!r}")
+                    self.metrics.inc('ebi_dropped_frames_total', reason='dispatch')
+            if self._decoder.bcc_errors != bcc_errors:
+                self.metrics.inc('ebi_bcc_errors_total', self._decoder.bcc_errors - bcc_errors)
+
+    def _dispatch(self, frame):
+        with self._pending_lock:
+            answer = self._pending.pop(frame[0], None)
+        if answer is not None:
+            answer.set(frame)
+            return
+        if frame[0] == 0x84 and len(frame) >= 2:
+            # notifica di cambio stato / banner di boot non atteso
+            self._set_state(frame[1])
+            if frame[1] in self.BOOT_STATES:
+                self.invalidate()   # il modulo si è resettato da solo
             if self.debug:
-                print('   ans <-', self.hex(ans))
-            if not ans:
-                return None
-            if ans[-1] != self.bcc(ans[:-1]):
-                logger.error("read(): BCC mismatch")
-                return None
-            return ans[2:-1]
-        except Exception as e:
-            logger.error(f"read() exception: {e}")
+                print('      State   : ', self.state['state'])
+            return
+        if frame[0] != 0xE0:
+            self.metrics.inc('ebi_unexpected_frames_total', opcode=f"0x{frame[0]:02X}")
+        try:
+            self._events.put_nowait(frame)
+        except queue.Full:
+            try:
+                dropped = self._events.get_nowait()
+                logger.error(f"event queue full, dropping frame 0x{dropped[0]:02X}")
+                self.metrics.inc('ebi_dropped_frames_total', reason='queue_full')
+            except queue.Empty:
+                pass
+            self._events.put_nowait(frame)
+        try:
+            os.write(self._event_w, b'\0')
+        except (BlockingIOError, OSError):
+            pass   # pipe piena: il consumatore legge comunque tutta la coda
+
+    def _expect(self, opcode):
+        answer = _Answer()
+        with self._pending_lock:
+            self._pending[opcode] = answer
+        return answer
+
+    def _forget(self, opcode, answer):
+        with self._pending_lock:
+            if self._pending.get(opcode) is answer:
+                del self._pending[opcode]
+
+    def read(self, timeout=None):
+        """Return the next unsolicited frame, or None after timeout seconds."""
+        try:
+            return self._events.get(timeout=timeout)
+        except queue.Empty:
             return None
 
-    def send(self, command):
+    def event_fileno(self):
+        """fd readable when unsolicited frames are queued, for an event loop."""
+        return self._event_r
+
+    def read_pending(self):
+        """Return the queued unsolicited frames without waiting (list)."""
         try:
-            n = len(command) + 3
-            packet = [n >> 8 & 0xFF, n & 0xFF] + command
-            packet += [self.bcc(packet)]
-            if self.debug:
-                print('   cmd ->', self.hex(packet))
-            self.ser.write(bytes(packet))
-            ans = self.read()
-            if ans is None:
-                logger.error("send(): no answer from module")
-                return None
-            # Verifica opcode echo (cmd | 0x80)
-            expected = (command[0] | 0x80) & 0xFF
-            if ans[0] != expected:
-                logger.error(f"send(): unexpected opcode in answer: got 0x{ans[0]:02X}, expected 0x{expected:02X}")
+            while os.read(self._event_r, 4096):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+        frames = []
+        while True:
+            try:
+                frames.append(self._events.get_nowait())
+            except queue.Empty:
+                return frames
+
+    def send(self, command, timeout=None):
+        if timeout is None:
+            timeout = self.TIMEOUT.get(command[0], self.DEFAULT_TIMEOUT)
+        expected = (command[0] | 0x80) & 0xFF
+        opcode = f"0x{command[0]:02X}"
+        self.metrics.inc('ebi_commands_total', opcode=opcode)
+        with self._tx_lock:
+            answer = self._expect(expected)
+            try:
+                start = time.monotonic()
+                deadline = start + timeout
+                packet = self._encoder.encode(command)
+                if self.debug:
+                    print('   cmd ->', self.hex(packet))
+                self.ser.write(packet)
+                ans = answer.wait(max(deadline - time.monotonic(), 0))
+            except Exception as e:
+                logger.error(f"send() exception: {e}")
+                self.metrics.inc('ebi_no_response_total', opcode=opcode, reason='write')
                 return None
-            return ans[1:]
-        except Exception as e:
-            logger.error(f"send() exception: {e}")
+            finally:
+                self._forget(expected, answer)
+        if ans is None:
+            logger.error(f"send(): no answer from module to {opcode}")
+            self.metrics.inc('ebi_no_response_total', opcode=opcode, reason='timeout')
             return None
+        self.metrics.observe('ebi_command_seconds', time.monotonic() - start, opcode=opcode)
+        return ans[1:]
+
+    # -------------------- Cache --------------------
+    # i getter di configurazione memorizzano la risposta per parametro, i
+    # setter la aggiornano (Success) o la invalidano, reset() la svuota
+    def _lookup(self, key, writing):
+        if writing:
+            self._cache.pop(key, None)
+            return None
+        if not self.cache:
+            return None
+        ret = self._cache.get(key)
+        return dict(ret) if ret is not None else None
+
+    def _remember(self, key, ret):
+        if self.cache:
+            self._cache[key] = dict(ret)
+        return ret
+
+    def _written(self, key, ret, value):
+        if ret.get('status') == 'Success':
+            self._remember(key, value)
+        return ret
+
+    def invalidate(self, key=None):
+        """Drop one cached parameter, or all of them."""
+        if key is None:
+            self._cache.clear()
+        else:
+            self._cache.pop(key, None)
 
     # -------------------- Info & Stato --------------------
+    def _set_state(self, code):
+        self.state['state'] = None if code is None else EBI.DEVICE_STATE.get(code, None)
+
+    def current_state(self):
+        """Device state from the local mirror; the module is queried only if it is unknown."""
+        if self.state.get('state') is None:
+            self.refresh()
+        return self.state.get('state')
+
+    def refresh(self):
+        """Re-read the device state from the module and return it."""
+        self.device_state()
+        return self.state.get('state')
+
     def device_info(self):
         if self.debug:
             print('Device Info')
@@ -212,7 +417,9 @@ class EBI:
         ans = self.send([0x04])
         if not ans:
             logger.error("device_state(): no response")
+            self._set_state(None)
             return {'status': 'NoResponse'}
+        self._set_state(ans[0])
         if self.debug:
             print('      Status  : ', EBI.DEVICE_STATE.get(ans[0], None))
         return {'state': EBI.DEVICE_STATE.get(ans[0], None)}
@@ -220,18 +427,25 @@ class EBI:
     def reset(self):
         if self.debug:
             print("---Start Reset")
-        ans = self.send([0x05])
+        self.invalidate()
+        # il banner di boot (0x84) può arrivare subito dopo la risposta:
+        # va atteso prima di inviare il comando
+        with self._tx_lock:
+            boot_answer = self._expect(0x84)
+            try:
+                ans = self.send([0x05])
+                boot = boot_answer.wait(self.BOOT_TIMEOUT) if ans else None
+            finally:
+                self._forget(0x84, boot_answer)
         if not ans:
             logger.error("reset(): no response to reset command")
+            self._set_state(None)
             return {'status': 'NoResponse'}
-        _timeout = self.ser.timeout
-        self.ser.timeout = 3
-        boot = self.read()
-        self.ser.timeout = _timeout
         if not boot or len(boot) < 2 or boot[0] != 0x84:
             logger.error("reset(): invalid/absent boot banner")
+            self._set_state(None)
             return {'status': EBI.STATUS.get(ans[0], ans[0]), 'boot_state': None}
-        self.state['state'] = EBI.DEVICE_STATE.get(boot[1], None)
+        self._set_state(boot[1])
         if self.debug:
             print('      Status  : ', EBI.STATUS.get(ans[0], ans[0]))
             print('      BOOT    : ', EBI.DEVICE_STATE.get(boot[1], None))
@@ -259,15 +473,18 @@ class EBI:
                 req_speed = [int(speed) % 256]
         except Exception:
             req_speed = []
+        cached = self._lookup('speed', req_speed)
+        if cached is not None:
+            return cached
         ans = self.send([0x09] + (req_speed or [0]))
         if not ans:
             logger.error("uart(): no response")
             return {'status': 'NoResponse'}
         if req_speed:
-            return {'status': EBI.STATUS.get(ans[0], ans[0])}
+            return self._written('speed', {'status': EBI.STATUS.get(ans[0], ans[0])}, {'speed': req_speed[0]})
         if self.debug:
             print('      Speed: ', self.hex(ans))
-        return {'speed': ans[0]}
+        return self._remember('speed', {'speed': ans[0]})
 
     def output_power(self, power=None):
         if self.debug:
@@ -278,15 +495,18 @@ class EBI:
                 req_power = [int(power) % 256]
         except Exception:
             req_power = []
+        cached = self._lookup('power', req_power)
+        if cached is not None:
+            return cached
         ans = self.send([0x10] + req_power)
         if not ans:
             logger.error("output_power(): no response")
             return {'status': 'NoResponse'}
         if req_power:
-            return {'status': EBI.STATUS.get(ans[0], ans[0])}
+            return self._written('power', {'status': EBI.STATUS.get(ans[0], ans[0])}, {'power': req_power[0]})
         if self.debug:
             print('      Output Power: ', self.hex(ans))
-        return {'power': ans[0]}
+        return self._remember('power', {'power': ans[0]})
 
     def operating_channel(self, channel=None, spreading_factor=None, bandwidth=None, coding_rate=None):
         if self.debug:
@@ -299,6 +519,9 @@ class EBI:
             req_channel = [channel, spreading_factor, bandwidth, coding_rate]
             if self.debug:
                 print(req_channel)
+        cached = self._lookup('channel', req_channel)
+        if cached is not None:
+            return cached
         ans = self.send([0x11] + req_channel)
         if not ans:
             logger.error("operating_channel(): no response")
@@ -306,8 +529,13 @@ class EBI:
         if self.debug and ans:
             print('      channel:', ans[0])
         if req_channel:
-            return {'status': EBI.STATUS.get(ans[0], ans[0])}
-        return {'channel': ans[0]}
+            return self._written('channel', {'status': EBI.STATUS.get(ans[0], ans[0])},
+                                 {'channel': channel, 'spreading_factor': spreading_factor,
+                                  'bandwidth': bandwidth, 'coding_rate': coding_rate})
+        ret = {'channel': ans[0]}
+        if len(ans) >= 4:
+            ret.update({'spreading_factor': ans[1], 'bandwidth': ans[2], 'coding_rate': ans[3]})
+        return self._remember('channel', ret)
 
     def energy_save(self, policy=None):
         if self.debug:
@@ -315,13 +543,17 @@ class EBI:
         req_policy = []
         if policy in EBI.MODULE_SLEEP_POLICY:
             req_policy = [policy]
+        cached = self._lookup('policy', req_policy)
+        if cached is not None:
+            return cached
         ans = self.send([0x13] + req_policy)
         if not ans:
             logger.error("energy_save(): no response")
             return {'status': 'NoResponse'}
         if req_policy:
-            return {'status': EBI.STATUS.get(ans[0], ans[0])}
-        return {'policy': EBI.MODULE_SLEEP_POLICY.get(ans[0], ans[0])}
+            return self._written('policy', {'status': EBI.STATUS.get(ans[0], ans[0])},
+                                 {'policy': EBI.MODULE_SLEEP_POLICY[policy]})
+        return self._remember('policy', {'policy': EBI.MODULE_SLEEP_POLICY.get(ans[0], ans[0])})
 
     def region(self, region=None):
         if self.debug:
@@ -343,13 +575,16 @@ class EBI:
         req_address = []
         if address and len(address) in [2, 4]:
             req_address = address
+        cached = self._lookup('address', req_address)
+        if cached is not None:
+            return cached
         ans = self.send([0x21] + req_address)
         if not ans:
             logger.error("network_address(): no response")
             return {'status': 'NoResponse'}
         if req_address:
-            return {'status': EBI.STATUS.get(ans[0], ans[0])}
-        return {'address': self.hex(ans)}
+            return self._written('address', {'status': EBI.STATUS.get(ans[0], ans[0])}, {'address': self.hex(req_address)})
+        return self._remember('address', {'address': self.hex(ans)})
 
     def network_identifier(self, identifier=None):
         if self.debug:
@@ -357,13 +592,16 @@ class EBI:
         req_identifier = []
         if identifier and len(identifier) in [2, 4]:
             req_identifier = identifier
+        cached = self._lookup('identifier', req_identifier)
+        if cached is not None:
+            return cached
         ans = self.send([0x22] + req_identifier)
         if not ans:
             logger.error("network_identifier(): no response")
             return {'status': 'NoResponse'}
         if req_identifier:
-            return {'status': EBI.STATUS.get(ans[0], ans[0])}
-        return {'identifier': self.hex(ans)}
+            return self._written('identifier', {'status': EBI.STATUS.get(ans[0], ans[0])}, {'identifier': self.hex(req_identifier)})
+        return self._remember('identifier', {'identifier': self.hex(ans)})
 
     def network_preference(self, protocol=None, auto_join=None, adr=None):
         if self.debug:
@@ -371,41 +609,209 @@ class EBI:
         req_preference = []
         if protocol in [0, 1] and auto_join in [0, 1] and adr in [0, 1]:
             req_preference = [((protocol << 7) & 0x80) + ((auto_join << 6) & 0x40) + ((adr << 5) & 0x20)]
+        cached = self._lookup('preference', req_preference)
+        if cached is not None:
+            return cached
         ans = self.send([0x25] + req_preference)
         if not ans:
             logger.error("network_preference(): no response")
             return {'status': 'NoResponse'}
+        value = req_preference[0] if req_preference else ans[0]
+        ret = {
+            'protocol': (value & 0x80) and "LoRaWAN" or "LoRaEMB",
+            'auto_join': (value & 0x40) != 0,
+            'adr': (value & 0x20) != 0,
+        }
         if req_preference:
-            return {'status': EBI.STATUS.get(ans[0], ans[0])}
-        protocol = (ans[0] & 0x80) and "LoRaWAN" or "LoRaEMB"
-        auto_join = (ans[0] & 0x40) != 0
-        adr = (ans[0] & 0x20) != 0
-        return {'protocol': protocol, 'auto_join': auto_join, 'adr': adr}
+            return self._written('preference', {'status': EBI.STATUS.get(ans[0], ans[0])}, ret)
+        return self._remember('preference', ret)
 
     def network_stop(self):
         if self.debug:
             print("---Stop Network")
-        _timeout = self.ser.timeout
-        self.ser.timeout = 10
         ans = self.send([0x30])
-        self.ser.timeout = _timeout
         if not ans:
             logger.error("network_stop(): no response")
+            self._set_state(None)
             return {'status': 'NoResponse'}
+        self._set_state(0x20 if ans[0] == 0x00 else None)
         return {'status': EBI.STATUS.get(ans[0], ans[0])}
 
     def network_start(self):
         if self.debug:
             print("---Start Network")
-        _timeout = self.ser.timeout
-        self.ser.timeout = 10
         ans = self.send([0x31])
-        self.ser.timeout = _timeout
         if not ans:
             logger.error("network_start(): no response")
+            self._set_state(None)
             return {'status': 'NoResponse'}
+        self._set_state(0x30 if ans[0] == 0x00 else None)
+        if ans[0] == 0x00:
+            # il join OTAA assegna il DevAddr, l'ADR cambia potenza e canale
+            for key in self.JOIN_CHANGES:
+                self.invalidate(key)
         return {'status': EBI.STATUS.get(ans[0], ans[0])}
 
+    # -------------------- Profili --------------------
+    # ordine di scrittura delle voci di un profilo
+    PROFILE_KEYS = (
+        'region', 'power', 'channel', 'energy_save',
+        'preference', 'physical', 'address', 'identifier',
+        'app_key', 'app_Skey', 'nwk_Skey',
+    )
+    # lunghezze in byte accettate dai setter
+    PROFILE_LENGTHS = {
+        'physical': (16,), 'address': (2, 4), 'identifier': (2, 4),
+        'app_key': (16,), 'app_Skey': (16,), 'nwk_Skey': (16,),
+    }
+
+    def _profile_error(self, key, value):
+        """Why value cannot be written to the profile entry key; None if it can."""
+        def byte(v):
+            return isinstance(v, int) and not isinstance(v, bool) and 0 <= v <= 0xFF
+        if key in ('power', 'region'):
+            return None if byte(value) else "%r is not a byte" % (value,)
+        if key == 'energy_save':
+            return None if byte(value) and value in EBI.MODULE_SLEEP_POLICY else "unknown sleep policy %r" % (value,)
+        try:
+            values = list(value)
+        except TypeError:
+            return "%r is not a list of values" % (value,)
+        if key == 'channel':
+            tables = (('channel', EBI.LORA_CHANNEL), ('spreading factor', EBI.LORA_SPREADING_FACTOR),
+                      ('bandwidth', EBI.LORA_BANDWIDTH), ('coding rate', EBI.LORA_CODING_RATE))
+            if len(values) != len(tables):
+                return "expected channel, spreading factor, bandwidth, coding rate"
+            for v, (name, table) in zip(values, tables):
+                if not byte(v) or v not in table:
+                    return "invalid %s %r" % (name, v)
+            return None
+        if key == 'preference':
+            if len(values) != 3 or any(v not in (0, 1) for v in values):
+                return "expected protocol, auto_join, adr (0 or 1)"
+            return None
+        lengths = EBI.PROFILE_LENGTHS[key]
+        if len(values) not in lengths:
+            return "expected %s bytes, got %d" % (' or '.join(map(str, lengths)), len(values))
+        if not all(byte(v) for v in values):
+            return "not a list of bytes"
+        return None
+
+    def _profile_read(self, key):
+        """Current value of a profile entry, in profile form; None if it cannot be read back."""
+        if key == 'power':
+            return self.output_power().get('power')
+        if key == 'channel':
+            ret = self.operating_channel()
+            if 'coding_rate' not in ret:
+                return None
+            return (ret['channel'], ret['spreading_factor'], ret['bandwidth'], ret['coding_rate'])
+        if key == 'energy_save':
+            policy = self.energy_save().get('policy')
+            for code, name in EBI.MODULE_SLEEP_POLICY.items():
+                if name == policy:
+                    return code
+            return None
+        if key == 'address':
+            return self.network_address().get('address')
+        if key == 'identifier':
+            return self.network_identifier().get('identifier')
+        if key == 'physical':
+            return self.physical_address().get('physical_address = AppEui + DevEui')
+        if key == 'preference':
+            ret = self.network_preference()
+            if 'protocol' not in ret:
+                return None
+            return (int(ret['protocol'] == 'LoRaWAN'), int(ret['auto_join']), int(ret['adr']))
+        # region e chiavi non si possono rileggere
+        return None
+
+    def _profile_value(self, key, value):
+        if key in ('address', 'identifier', 'physical'):
+            return self.hex(value)
+        if key in ('channel', 'preference'):
+            return tuple(value)
+        return value
+
+    def _profile_write(self, key, value):
+        if key == 'power':
+            return self.output_power(value)
+        if key == 'channel':
+            return self.operating_channel(*value)
+        if key == 'energy_save':
+            return self.energy_save(value)
+        if key == 'region':
+            return self.region(value)
+        if key == 'address':
+            return self.network_address(value)
+        if key == 'identifier':
+            return self.network_identifier(value)
+        if key == 'physical':
+            return self.physical_address(value)
+        if key == 'preference':
+            return self.network_preference(*value)
+        if key == 'app_key':
+            return self.app_key(value)
+        if key == 'app_Skey':
+            return self.app_Skey(value)
+        if key == 'nwk_Skey':
+            return self.nwk_Skey(value)
+        raise KeyError(key)
+
+    def check_profile(self, profile):
+        """Return the readable profile entries whose value on the module differs."""
+        return [key for key in self.PROFILE_KEYS
+                if key in profile and self._profile_read(key) != self._profile_value(key, profile[key])]
+
+    def apply_profile(self, profile, start=None):
+        """Apply a whole configuration with at most one network stop/start.
+
+        profile: dict with any of PROFILE_KEYS, e.g.
+            {'power': 14, 'channel': (1, 9, 0, 1), 'energy_save': 0,
+             'preference': (1, 1, 1), 'physical': [...16 bytes...], 'app_key': [...]}
+        Readable entries are compared with the module and written only if
+        different; region and keys cannot be read back and are always written.
+        start: None restarts the network only if it was online, True always
+        starts it, False leaves it stopped.
+        Values are checked first: if any is invalid nothing is read or
+        written and {'status': 'InvalidParameter', 'errors': {key: reason}}
+        is returned.
+        """
+        unknown = set(profile) - set(self.PROFILE_KEYS)
+        if unknown:
+            raise KeyError("unknown profile entries: %s" % ', '.join(sorted(unknown)))
+        errors = {}
+        for key, value in profile.items():
+            error = self._profile_error(key, value)
+            if error:
+                errors[key] = error
+        if errors:
+            logger.error(f"apply_profile(): invalid values {errors}")
+            return {'status': 'InvalidParameter', 'errors': errors}
+        result = {}
+        writes = []
+        for key in self.PROFILE_KEYS:
+            if key not in profile:
+                continue
+            value = profile[key]
+            if self._profile_read(key) == self._profile_value(key, value):
+                result[key] = 'Unchanged'
+            else:
+                writes.append((key, value))
+        online = self.current_state() == 'Online'
+        stopped = bool(writes) and online
+        if stopped:
+            result['network_stop'] = self.network_stop().get('status')
+        for key, value in writes:
+            result[key] = self._profile_write(key, value).get('status')
+        if start is None:
+            start = stopped
+        if start and (stopped or not online):
+            result['network_start'] = self.network_start().get('status')
+        if self.debug:
+            print('      Profile : ', result)
+        return result
+
     # -------------------- TX/RX --------------------
     def send_data(self, payload, protocol=0, dst=None, port=1):
         try:
@@ -431,12 +837,12 @@ class EBI:
             }
             if result['status'] == 'Success' and protocol == 1:
                 if len(ans) >= 6:
-                    result['tx_channel_mask'] = ans[4:6]
+                    result['tx_channel_mask'] = list(ans[4:6])
                 if len(ans) >= 8:
                     result['tx_datarate_mask'] = ans[6]
                     result['tx_power'] = ans[7]
                 if len(ans) >= 12:
-                    result['waiting_time'] = ans[8:12]
+                    result['waiting_time'] = list(ans[8:12])
             return result
         except Exception as e:
             logger.error(f"send_data() exception: {e}")
@@ -455,10 +861,7 @@ class EBI:
                 assert port in range(1, 224)
                 options = [0x0D, 0x00]
                 header = options + [port]
-            _timeout = self.ser.timeout
-            self.ser.timeout = 10
             ans = self.send([0x50] + header + payload)
-            self.ser.timeout = _timeout
             if not ans or len(ans) < 4:
                 logger.error("send_dataLW(): no/short response")
                 return {'status': 'NoResponse'}
@@ -474,7 +877,7 @@ class EBI:
                     result['tx_datarate_mask'] = ans[6]
                     result['tx_power'] = ans[7]
                 if len(ans) >= 12:
-                    result['waiting_time'] = ans[8:12]
+                    result['waiting_time'] = list(ans[8:12])
             return result
         except Exception as e:
             logger.error(f"send_dataLW() exception: {e}")
@@ -490,13 +893,17 @@ class EBI:
                 req_mac = mac
             except Exception:
                 req_mac = []
+        cached = self._lookup('ieee_address', req_mac)
+        if cached is not None:
+            return cached
         ans = self.send([0x7E, 0x20] + req_mac)
         if not ans:
             logger.error("ieee_address(): no response")
             return {'status': 'NoResponse'}
         if req_mac:
-            return {'status': EBI.STATUS.get(ans[0], ans[0])}
-        return {'ieee_address': self.hex(ans)}
+            return self._written('ieee_address', {'status': EBI.STATUS.get(ans[0], ans[0])},
+                                 {'ieee_address': self.hex(req_mac)})
+        return self._remember('ieee_address', {'ieee_address': self.hex(ans)})
 
     def physical_address(self, physical=None):
         if self.debug:
@@ -508,24 +915,33 @@ class EBI:
                 req_physical = physical
             except Exception:
                 req_physical = []
+        cached = self._lookup('physical', req_physical)
+        if cached is not None:
+            return cached
         ans = self.send([0x20] + req_physical)
         if not ans:
             logger.error("physical_address(): no response")
             return {'status': 'NoResponse'}
         if req_physical:
-            return {'status': EBI.STATUS.get(ans[0], ans[0])}
+            return self._written('physical', {'status': EBI.STATUS.get(ans[0], ans[0])},
+                                 {'physical_address = AppEui + DevEui': self.hex(req_physical)})
         ans1 = ans[:8]
         ans2 = ans[8:]
         if self.debug:
             print("AppEUI", self.hex(ans1))
             print("DevEUI", self.hex(ans2))
-        return {'physical_address = AppEui + DevEui': self.hex(ans)}
+        return self._remember('physical', {'physical_address = AppEui + DevEui': self.hex(ans)})
 
     def receive(self, protocol=0, timeout=None):
-        _timeout = self.ser.timeout
-        self.ser.timeout = timeout
-        ans = self.read()
-        self.ser.timeout = _timeout
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+            ans = self.read(remaining)
+            if ans is None or ans[0] == 0xE0:
+                return self.parse_received(ans, protocol)
+            logger.error(f"receive(): unexpected header 0x{ans[0]:02X}")
+
+    def parse_received(self, ans, protocol=0):
         if not ans:
             return None, None, None, None
         if ans[0] != 0xE0:
@@ -664,19 +1080,13 @@ class EBI:
 if __name__ == "__main__":
     # Piccolo test manuale: stampa un report e prova un paio di comandi.
     # Esempio: python3 ebi.py /dev/ttyS6
+    from logsetup import setup_logging
+    setup_logging()
     dev = "/dev/ttyS6"
     try:
         dev = sys.argv[1]
     except Exception:
         pass
 
-    # Configurazione logging di base solo se l'app chiamante non ha già handler
-    if not logger.handlers:
-        h = logging.StreamHandler()
-        fmt = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
-        h.setFormatter(fmt)
-        logger.addHandler(h)
-        logger.setLevel(logging.INFO)
-
     e = EBI(dev, debug=False)
     e.device_report()
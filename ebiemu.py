@@ -0,0 +1,289 @@
+#!/usr/bin/python3
+
+"""EMB-LR1276 module emulator on a pseudo-terminal.
+
+EmbitEmulator opens a pty and answers the EBI commands used by ebi.py like
+the real module on /dev/ttyS6, so that ebi.py, aioebi.py and embitshell.py
+can run on a plain Linux box:
+
+    emu = EmbitEmulator(latency=0.005, airtime=0.3)
+    port = emu.start()          # e.g. /dev/pts/5
+    e = EBI(port)
+    ...
+    emu.inject(b'R:1:ON', port=1)   # 0xE0 received data
+    emu.close()
+
+Implemented opcodes: 0x01 device info, 0x04 device state, 0x05 reset (with
+0x84 boot banner), 0x06 firmware version, 0x09-0x26 configuration (get/set),
+0x7E 0x20 IEEE address, 0x30/0x31 network stop/start, 0x50 send data; any
+other opcode is answered 'Unsupported'.
+
+Timing and faults are configurable: latency (s, or (min, max)) before every
+answer, join_time for network start, airtime + airtime_per_byte for send
+data, and the drop_rate / error_rate / bcc_error_rate probabilities of no
+answer, 'Generic error' status and corrupted BCC.
+"""
+
+import os
+import pty
+import random
+import sys
+import threading
+import time
+import tty
+
+from ebiframe import FrameEncoder, FrameDecoder
+
+# stati del modulo (EBI.DEVICE_STATE)
+READY = 0x10
+OFFLINE = 0x20
+ONLINE = 0x30
+
+SUCCESS = 0x00
+GENERIC_ERROR = 0x01
+UNSUPPORTED = 0x05
+CANNOT_SEND = 0x07
+
+
+class EmbitEmulator:
+    def __init__(self, latency=0.0, join_time=0.0, airtime=0.0, airtime_per_byte=0.0,
+                 boot_time=0.05, drop_rate=0.0, error_rate=0.0, bcc_error_rate=0.0,
+                 state=READY, uuid=bytes(range(1, 9)), firmware=bytes([1, 2, 3, 4]), seed=None):
+        self.latency = latency
+        self.join_time = join_time
+        self.airtime = airtime
+        self.airtime_per_byte = airtime_per_byte
+        self.boot_time = boot_time
+        self.drop_rate = drop_rate
+        self.error_rate = error_rate
+        self.bcc_error_rate = bcc_error_rate
+        self.state = state
+        self.uuid = bytes(uuid)
+        self.firmware = bytes(firmware)
+        self.random = random.Random(seed)
+        # configurazione corrente, come la restituiscono i comandi di lettura
+        self.params = {
+            0x09: bytes([0x00]),                    # uart
+            0x10: bytes([14]),                      # output power
+            0x11: bytes([0x01, 0x07, 0x00, 0x01]),  # channel, SF, BW, CR
+            0x13: bytes([0x00]),                    # energy save
+            0x19: bytes([0x00]),                    # region
+            0x20: bytes(16),                        # AppEUI + DevEUI
+            0x21: bytes(4),                         # network address
+            0x22: bytes(4),                         # network identifier
+            0x25: bytes([0x00]),                    # network preference
+        }
+        self.ieee_address = bytes(8)
+        self.keys = {}
+        self.uplinks = []          # (monotonic, port, payload) dei 0x50 accettati
+        self.commands = {}         # opcode -> numero di comandi ricevuti
+        self.dropped = 0
+        self.on_uplink = None      # callback(port, payload)
+        self._downlinks = []       # (port, data) consegnati dopo il prossimo uplink
+        self._encoder = FrameEncoder()
+        self._decoder = FrameDecoder()
+        self._write_lock = threading.Lock()
+        self._master = self._slave = None
+        self._thread = None
+        self.port = None
+
+    # -------------------- pty --------------------
+    def start(self):
+        """Open the pty and start answering; return the device name."""
+        self._master, self._slave = pty.openpty()
+        tty.setraw(self._master)
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self._thread = threading.Thread(target=self._run, name="ebiemu", daemon=True)
+        self._thread.start()
+        return self.port
+
+    def close(self):
+        for fd in (self._master, self._slave):
+            if fd is not None:
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+        self._master = self._slave = None
+        if self._thread is not None:
+            self._thread.join(1)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _run(self):
+        while True:
+            try:
+                data = os.read(self._master, 4096)
+            except (OSError, TypeError):   # TypeError: chiuso da close()
+                return
+            if not data:
+                return
+            self._decoder.feed(data)
+            for command in self._decoder:
+                self._handle(command)
+
+    def _write(self, frame, corrupt=False):
+        with self._write_lock:
+            packet = bytearray(self._encoder.encode(frame))
+            if corrupt:
+                packet[-1] ^= 0xFF
+            try:
+                os.write(self._master, packet)
+            except (OSError, TypeError):
+                pass
+
+    def _answer(self, frame):
+        if self.random.random() < self.drop_rate:
+            self.dropped += 1
+            return
+        self._write(frame, self.random.random() < self.bcc_error_rate)
+
+    def _sleep(self, delay):
+        if isinstance(delay, tuple):
+            delay = self.random.uniform(*delay)
+        if delay > 0:
+            time.sleep(delay)
+
+    def _status(self):
+        return GENERIC_ERROR if self.random.random() < self.error_rate else SUCCESS
+
+    # -------------------- downlink --------------------
+    def inject(self, data, port=1, rssi=-60):
+        """Deliver a LoRaWAN downlink now as a 0xE0 frame."""
+        if isinstance(data, str):
+            data = data.encode('latin-1')
+        rssi &= 0xFFFF
+        self._write([0xE0, 0x00, 0x00, rssi >> 8, rssi & 0xFF, 0x00, port] + list(data))
+
+    def queue_downlink(self, data, port=1):
+        """Deliver a downlink in the RX window of the next uplink (class A)."""
+        self._downlinks.append((data, port))
+
+    # -------------------- comandi --------------------
+    def _handle(self, command):
+        op, params = command[0], command[1:]
+        self.commands[op] = self.commands.get(op, 0) + 1
+        self._sleep(self.latency)
+        handler = {
+            0x01: self._device_info,
+            0x04: self._device_state,
+            0x05: self._reset,
+            0x06: self._firmware,
+            0x26: self._key,
+            0x30: self._network_stop,
+            0x31: self._network_start,
+            0x50: self._send_data,
+            0x7E: self._extended,
+        }.get(op)
+        if handler is None and op in self.params:
+            handler = self._param
+        if handler is None:
+            self._answer([op | 0x80, UNSUPPORTED])
+        else:
+            handler(op, params)
+
+    def _device_info(self, op, params):
+        self._answer([0x81, 0x50, 0x55] + list(self.uuid))
+
+    def _device_state(self, op, params):
+        self._answer([0x84, self.state])
+
+    def _reset(self, op, params):
+        self._answer([0x85, SUCCESS])
+        self._sleep(self.boot_time)
+        self.state = READY
+        self._answer([0x84, self.state])
+
+    def _firmware(self, op, params):
+        self._answer([0x86] + list(self.firmware))
+
+    def _param(self, op, params):
+        # uart() legge con un parametro 0
+        if not params or (op == 0x09 and params == b'\x00'):
+            self._answer([op | 0x80] + list(self.params[op]))
+            return
+        status = self._status()
+        if status == SUCCESS:
+            self.params[op] = bytes(params)
+        self._answer([op | 0x80, status])
+
+    def _key(self, op, params):
+        if not params:
+            self._answer([0xA6, UNSUPPORTED])
+            return
+        status = self._status()
+        if status == SUCCESS and len(params) > 1:
+            self.keys[params[0]] = bytes(params[1:])
+        self._answer([0xA6, status])
+
+    def _extended(self, op, params):
+        if params[:1] != b'\x20':
+            self._answer([0xFE, UNSUPPORTED])
+        elif len(params) > 1:
+            self.ieee_address = bytes(params[1:])
+            self._answer([0xFE, self._status()])
+        else:
+            self._answer([0xFE] + list(self.ieee_address))
+
+    def _network_stop(self, op, params):
+        status = self._status()
+        if status == SUCCESS:
+            self.state = OFFLINE
+        self._answer([0xB0, status])
+
+    def _network_start(self, op, params):
+        self._sleep(self.join_time)
+        status = self._status()
+        if status == SUCCESS:
+            self.state = ONLINE
+        self._answer([0xB1, status])
+
+    def _send_data(self, op, params):
+        # LoRaWAN: options(2) port payload
+        if self.state != ONLINE or len(params) < 3:
+            self._answer([0xD0, CANNOT_SEND, 0x00, 0x00, 0x00])
+            return
+        port, payload = params[2], bytes(params[3:])
+        self._sleep(self.airtime + self.airtime_per_byte * len(payload))
+        status = self._status()
+        if status == SUCCESS:
+            self.uplinks.append((time.monotonic(), port, payload))
+            if self.on_uplink is not None:
+                self.on_uplink(port, payload)
+        rssi = -60 & 0xFFFF
+        # status, retries, RSSI, channel mask, datarate mask, power, waiting time
+        self._answer([0xD0, status, 0x00, rssi >> 8, rssi & 0xFF, 0x00, 0x07, 0x05, 14, 0, 0, 0, 0])
+        if status == SUCCESS and self._downlinks:
+            data, port = self._downlinks.pop(0)
+            self.inject(data, port)
+
+
+if __name__ == "__main__":
+    # Esempio: python3 ebiemu.py [latency] [airtime]
+    # stampa la pty da passare a ebi.py/embitshell.py, poi ogni riga di stdin
+    # "<port> <testo>" viene consegnata come downlink (es. "1 R:1:ON")
+    latency, airtime = 0.01, 0.3
+    try:
+        latency = float(sys.argv[1])
+        airtime = float(sys.argv[2])
+    except Exception:
+        pass
+    emu = EmbitEmulator(latency=latency, airtime=airtime, join_time=1.0)
+    emu.on_uplink = lambda port, payload: print("UPLINK", port, payload)
+    print("EMB-LR1276 emulator on", emu.start())
+    try:
+        for line in sys.stdin:
+            port, _, text = line.strip().partition(' ')
+            try:
+                emu.inject(text, int(port))
+            except ValueError:
+                print("usage: <port> <text>")
+    except KeyboardInterrupt:
+        pass
+    emu.close()
@@ -0,0 +1,179 @@
+#!/usr/bin/python3
+
+"""EBI frame codec.
+
+An EBI frame is laid out as:
+
+    LEN_H LEN_L OPCODE PARAMS... BCC
+
+where LEN is the length of the whole frame (header and BCC included) and
+BCC is the sum of all the previous bytes modulo 256.
+
+FrameEncoder builds frames into a reusable bytearray, FrameDecoder can be
+fed arbitrary chunks coming from the serial port and hands back complete,
+BCC-verified frames (opcode + params, without length and BCC).
+"""
+
+import logging
+
+logger = logging.getLogger("ebi")
+
+HEADER_LEN = 2
+OVERHEAD = HEADER_LEN + 1   # length + BCC
+MIN_FRAME = OVERHEAD + 1    # ogni frame EBI ha almeno l'opcode
+MAX_FRAME = 0xFFFF
+
+
+def bcc(data):
+    return sum(data) & 0xFF
+
+
+class FrameEncoder:
+    def __init__(self, size=64):
+        self._buf = bytearray(size)
+
+    def encode(self, command):
+        """Return a memoryview on the encoded frame.
+
+        The view points into the internal buffer and is only valid until
+        the next call to encode().
+        """
+        n = len(command) + OVERHEAD
+        buf = self._buf
+        if n > len(buf):
+            if n > MAX_FRAME:
+                raise ValueError('Frame too long: %d bytes' % n)
+            buf = self._buf = bytearray(max(n, 2 * len(buf)))
+        buf[0] = n >> 8
+        buf[1] = n & 0xFF
+        buf[HEADER_LEN:n - 1] = command
+        buf[n - 1] = ((n >> 8) + n + sum(command)) & 0xFF
+        return memoryview(buf)[:n]
+
+
+class FrameDecoder:
+    """Incremental EBI frame parser.
+
+    Usage:
+        dec.feed(chunk)
+        for frame in dec:
+            ...
+    """
+
+    def __init__(self):
+        self._buf = bytearray()
+        self._pos = 0
+        self.frames = 0
+        self.bcc_errors = 0
+
+    def feed(self, data):
+        self._buf += data
+
+    def reset(self):
+        del self._buf[:]
+        self._pos = 0
+
+    @property
+    def pending(self):
+        """Bytes received but not yet returned as a frame."""
+        return len(self._buf) - self._pos
+
+    def pop(self):
+        """Return the next complete frame as bytes, or None."""
+        buf = self._buf
+        while len(buf) - self._pos >= HEADER_LEN:
+            start = self._pos
+            n = (buf[start] << 8) + buf[start + 1]
+            if n < MIN_FRAME:
+                # impossible length (no room for the opcode): drop one byte and try to resync
+                logger.error("FrameDecoder: invalid length %d, resync" % n)
+                self._pos += 1
+                continue
+            end = start + n
+            if end > len(buf):
+                break
+            with memoryview(buf) as view:
+                frame = bytes(view[start + HEADER_LEN:end - 1])
+            if (buf[start] + buf[start + 1] + sum(frame)) & 0xFF != buf[end - 1]:
+                # frame completo ma corrotto: lo scarta intero, come il vecchio read()
+                # (saltando un solo byte la lunghezza letta dopo può bloccare fino a 64 KiB)
+                self.bcc_errors += 1
+                logger.error("read(): BCC mismatch")
+                self._pos = end
+                continue
+            self._pos = end
+            self.frames += 1
+            self._compact()
+            return frame
+        self._compact()
+        return None
+
+    def _compact(self):
+        if self._pos and (self._pos == len(self._buf) or self._pos > 4096):
+            del self._buf[:self._pos]
+            self._pos = 0
+
+    def __iter__(self):
+        while True:
+            frame = self.pop()
+            if frame is None:
+                return
+            yield frame
+
+
+if __name__ == "__main__":
+    # Micro-benchmark: codec vs. the list based encode/decode used so far.
+    # Esempio: python3 ebiframe.py [iterations]
+    import sys
+    import timeit
+
+    iterations = 100000
+    try:
+        iterations = int(sys.argv[1])
+    except Exception:
+        pass
+
+    command = [0x50, 0x0D, 0x00, 0x06] + list(b'T:R;N:1;S:ON')
+    encoder = FrameEncoder()
+    frame = bytes(encoder.encode(command))
+    stream = frame * 16
+
+    def legacy_encode():
+        n = len(command) + 3
+        packet = [n >> 8 & 0xFF, n & 0xFF] + command
+        packet += [bcc(packet)]
+        return bytes(packet)
+
+    def legacy_decode():
+        header = frame[:2]
+        length = (header[0] << 8) + header[1]
+        payload = list(frame[2:length])
+        ans = [header[0], header[1]] + payload
+        if ans[-1] != bcc(ans[:-1]):
+            return None
+        return ans[2:-1]
+
+    decoder = FrameDecoder()
+
+    def codec_decode():
+        decoder.feed(frame)
+        return decoder.pop()
+
+    def codec_stream():
+        decoder.feed(stream)
+        for _ in decoder:
+            pass
+
+    assert legacy_encode() == frame
+    assert bytes(legacy_decode()) == codec_decode()
+
+    tests = [
+        ('legacy encode', legacy_encode, 1),
+        ('codec encode', lambda: encoder.encode(command), 1),
+        ('legacy decode', legacy_decode, 1),
+        ('codec decode', codec_decode, 1),
+        ('codec stream (16 frames/chunk)', codec_stream, 16),
+    ]
+    for name, fn, frames in tests:
+        t = timeit.timeit(fn, number=iterations)
+        print('%-32s %8.3f us/frame' % (name, t / (iterations * frames) * 1e6))
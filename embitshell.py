@@ -1,127 +1,66 @@
 #!/usr/bin/env python3
 
-import cmd, sys, readline, shlex
+import cmd, sys, shlex
 from ebi import EBI
+from uplink import UplinkQueue
+from eventloop import EventLoop, ControlChannel
+import binproto
+from metrics import REGISTRY
 
 import time
 from time import localtime, strftime
+from collections import OrderedDict
 
-from colorama import Fore, Style
+try:
+    from colorama import Fore, Style
+except ImportError:     # senza colorama l'output di debug resta in bianco
+    class Fore:
+        RED = GREEN = ''
+    class Style:
+        RESET_ALL = ''
 
 # ============ LOGGING ===============
 import logging
+# configurato in __main__ da logsetup.setup_logging (config.logDir)
 logger = logging.getLogger("embitshell")
-logger.setLevel(logging.ERROR)
-file_handler = logging.FileHandler("/srv/samba/Acqua_Samba/emb-python/embitshell_errors.log")
-formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s", datefmt="%Y-%m-%d %H:%M:%S")
-file_handler.setFormatter(formatter)
-logger.addHandler(file_handler)
+logger.addHandler(logging.NullHandler())
 # ====================================
 
-#=RS485 external program=======
-import subprocess, atexit
+#=Hardware (hal.py)=======
+import atexit
 from pathlib import Path 
+from hal import GpiodGpio, MockGpio, KmtRs485, MockRs485, GpioBank, GPIO_apply
 
-# ================= RS485 runner (KMT_RS485.py) =================
-# Percorso al programma KMT_RS485.py (adatta al tuo path reale)
-RS485_PROG = str(Path(__file__).resolve().parent / "KMT_RS485.py")
 RS485_PORT = "/dev/ttyS4"   # porta RS485
-RS485_ID   = "1"            # ID scheda KMTronic
-
-_rs485 = None  # processo persistente
-
-def _rs485_start():
-    """Avvia KMT_RS485.py in modalità interattiva (stdin aperta)."""
-    global _rs485
-    if _rs485 is None or _rs485.poll() is not None:
-        cmd = ["python3", RS485_PROG, "--port", RS485_PORT, "--id", RS485_ID]
-        _rs485 = subprocess.Popen(
-            cmd,
-            stdin=subprocess.PIPE,
-            stdout=subprocess.DEVNULL,  # no spam on stdout
-            stderr=subprocess.DEVNULL,
-            text=True,
-            bufsize=1
-        )
-
-def _rs485_send(line: str):
-    """Invia una riga di comando a KMT_RS485 (es. 'ON 1')."""
-    try:
-        _rs485_start()
-        _rs485.stdin.write(line.strip() + "\n")
-        _rs485.stdin.flush()
-    except Exception as e:
-        logger.error(f"RS485 error: {e}")
-        print("RS485 error:", e)
-
-def rs485_on(ch: str):
-    """Accende uno o più relè: ch = '1' oppure '1,3,5' oppure 'ALL'."""
-    _rs485_send(f"ON {ch}")
-
-def rs485_off(ch: str):
-    """Spegne uno o più relè."""
-    _rs485_send(f"OFF {ch}")
-
-def rs485_off_all():
-    """Spegne tutti i relè della scheda RS485."""
-    _rs485_send("OFF A")
-
-@atexit.register
-def _rs485_cleanup():
-    """Tenta di chiudere in modo pulito all'uscita."""
-    try:
-        if _rs485 and _rs485.poll() is None:
-            # modo pulito: invia EXIT se supportato, altrimenti termina
-            try:
-                _rs485_send("EXIT")
-            except Exception:
-                pass
-            _rs485.terminate()
-    except Exception:
-        pass
-# ==============================================================
+RS485_IDS  = (1,)           # ID schede KMTronic sul bus (config.rs485Boards)
 
 #GPIO definitions=======
-import gpiod
-chipA=gpiod.Chip('gpiochip0')
-chipB=gpiod.Chip('gpiochip1')
-chipC=gpiod.Chip('gpiochip2')
-chipD=gpiod.Chip('gpiochip3')
-chipE=gpiod.Chip('gpiochip4')
-
-def GPIO_conf(pin_name, chip_name, consumer_name, direction, default_val=0):
-    line = gpiod.find_line(pin_name)
-    if line is None:
-        raise Exception(f"GPIO {pin_name} not found")
-    GPIO_line = chip_name.get_lines([line.offset()])
-    if direction == "out":
-        GPIO_line.request(consumer=consumer_name, type=gpiod.LINE_REQ_DIR_OUT, default_vals=[default_val])
-    elif direction == "in":
-        GPIO_line.request(consumer=consumer_name, type=gpiod.LINE_REQ_DIR_IN)
-    else:
-        raise ValueError("set direction to 'in' or 'out'")
-    return GPIO_line
-
-rel1 = GPIO_conf("pioA13", chipA, "Rel1", "out", 0)
-rel2 = GPIO_conf("pioA14", chipA, "Rel2", "out", 0)
-ledGreen = GPIO_conf("pioD26", chipD, "led_green", "out", 1)
-ledRed = GPIO_conf("pioD14", chipD, "led_red", "out", 1)
-rgbRed = GPIO_conf("pioD19", chipD, "RGB_red", "out", 1)
-rgbGreen = GPIO_conf("pioD31", chipD, "RGB_green", "out", 1)
-rgbBlue = GPIO_conf("pioD30", chipD, "RGB_blue", "out", 1)
-digOut1 = GPIO_conf("pioC13", chipC, "DIG_OUT1", "out", 0)
-digOut2 = GPIO_conf("pioC12", chipC, "DIG_OUT2", "out", 0)
-pcieOn = GPIO_conf("pioC20", chipC, "PCIe_ON", "out", 0)
-digIn1 = GPIO_conf("pioA15", chipA, "DIG_IN1", "in")
-digIn2 = GPIO_conf("pioC14", chipC, "DIG_IN2", "in")
+# uscite: nome -> (pin, gpiochip, valore iniziale), richieste in bulk per gpiochip
+GPIO_OUTPUTS = {
+    'rel1':     ("pioA13", 'gpiochip0', 0),
+    'rel2':     ("pioA14", 'gpiochip0', 0),
+    'ledGreen': ("pioD26", 'gpiochip3', 1),
+    'ledRed':   ("pioD14", 'gpiochip3', 1),
+    'rgbRed':   ("pioD19", 'gpiochip3', 1),
+    'rgbGreen': ("pioD31", 'gpiochip3', 1),
+    'rgbBlue':  ("pioD30", 'gpiochip3', 1),
+    'digOut1':  ("pioC13", 'gpiochip2', 0),
+    'digOut2':  ("pioC12", 'gpiochip2', 0),
+    'pcieOn':   ("pioC20", 'gpiochip2', 0),
+}
+# ingressi: nome -> (pin, gpiochip, consumer), richiesti con gli eventi sui due fronti
+GPIO_INPUTS = {
+    'digIn1': ("pioA15", 'gpiochip0', "DIG_IN1"),
+    'digIn2': ("pioC14", 'gpiochip2', "DIG_IN2"),
+}
 
 # =========================
 # Safe wrapper per send_dataLW
 # =========================
 class SafeEBI(EBI):
-    def safe_send_dataLW(self, payload, dst=None):
+    def safe_send_dataLW(self, payload, dst=None, port=6):
         try:
-            ret = self.send_dataLW(payload=payload, dst=dst)
+            ret = self.send_dataLW(payload=payload, dst=dst, port=port)
             if ret is None:
                 logger.warning("send_dataLW ha restituito None (nessuna risposta dal modulo)")
                 return {"status": "NoResponse"}
@@ -130,9 +69,163 @@ class SafeEBI(EBI):
             logger.error(f"Errore in send_dataLW: {e}")
             return {"status": "Exception", "error": str(e)}
 
+# =========================
+# Hardware della scheda: creato da EmbitShell, non all'import del modulo
+# =========================
+class Hardware:
+    """GPIO, RS485 and EBI port of the shell, behind the hal.py backends.
+
+    Hardware() is the target board (libgpiod, KMTronic bus on RS485_PORT,
+    module on the serial device); Hardware.mock() keeps everything in
+    memory and talks to an ebiemu.EmbitEmulator. The backends are created
+    by open(), i.e. when EmbitShell is constructed.
+    """
+    def __init__(self, gpio=None, rs485=None, ebi=SafeEBI, is_mock=False):
+        self.gpio = gpio          # None = GpiodGpio / MockGpio in open()
+        self.rs485 = rs485        # None = KmtRs485 / MockRs485 in open()
+        self.ebi = ebi            # callable(device) -> SafeEBI
+        self.is_mock = is_mock
+        self.emulator = None      # EmbitEmulator di Hardware.mock()
+        self.lines = {}
+
+    @classmethod
+    def mock(cls, emulator=None, gpio=None, rs485=None):
+        """In memory GPIO and RS485; the EBI port is emulator (started if needed)."""
+        hw = cls(gpio, rs485, is_mock=True)
+        hw.emulator = emulator
+        hw.ebi = hw._emulated_ebi
+        return hw
+
+    def _emulated_ebi(self, device):
+        if self.emulator is None:
+            from ebiemu import EmbitEmulator
+            self.emulator = EmbitEmulator()
+        return SafeEBI(self.emulator.port or self.emulator.start())
+
+    def open(self):
+        """Create the backends and request the GPIO lines; return {name: line}."""
+        if self.lines:
+            return self.lines
+        if self.gpio is None:
+            self.gpio = MockGpio() if self.is_mock else GpiodGpio()
+        if self.rs485 is None:
+            self.rs485 = MockRs485(RS485_IDS) if self.is_mock else KmtRs485(RS485_PORT, RS485_IDS)
+            if not self.is_mock:
+                try:
+                    self.rs485.relay(RS485_IDS[0])  # apre subito la porta, i comandi ritentano se fallisce
+                except Exception as e:
+                    logger.error(f"RS485 open error: {e}")
+        banks = {}
+        lines = {}
+        for name, (pin, chip, default) in GPIO_OUTPUTS.items():
+            if chip not in banks:
+                banks[chip] = GpioBank(self.gpio, chip)
+            lines[name] = banks[chip].add(pin, default)
+        for bank in banks.values():
+            bank.request()
+        for name, (pin, chip, consumer) in GPIO_INPUTS.items():
+            lines[name] = self.gpio.request(chip, [self.gpio.offset(pin)], consumer, "events")
+        self.lines = lines
+        atexit.register(self.close)
+        return lines
+
+    def close(self):
+        """Chiude la porta RS485 (e l'emulatore) all'uscita."""
+        try:
+            if self.rs485 is not None:
+                self.rs485.close()
+            if self.gpio is not None:
+                self.gpio.close()
+        except Exception:
+            pass
+        if self.is_mock and self.emulator is not None:
+            self.emulator.close()
+
+# =========================
+# Handler dei dispositivi: ognuno conosce la propria linea GPIO o il canale
+# RS485 e la polarità; DeviceController li registra per (tipo, indice)
+# =========================
+class GpioOutput:
+    def __init__(self, line, active_low=False, label="GPIO"):
+        self.line = line
+        self.active_low = active_low
+        self.label = label
+
+    def level(self, on):
+        return int(bool(on) != self.active_low)
+
+    def set(self, on):
+        self.line.set_values([self.level(on)])
+        return True
+
+    def get(self):
+        return (self.line.get_values()[0] == 1) != self.active_low
+
+
+class GpioInput:
+    def __init__(self, line):
+        self.line = line
+
+    def get(self):
+        return self.line.get_values()[0] == 1
+
+    def event_fileno(self):
+        """fd readable on every edge, None if the line has no events."""
+        event_fileno = getattr(self.line, 'event_fileno', None)
+        return event_fileno() if event_fileno is not None else None
+
+    def read_event(self):
+        return self.line.read_event() == 1
+
+
+class Rs485Output:
+    """Canale KMTronic (board, channel), channel 'A' = tutti i canali della scheda.
+
+    status è condiviso tra i canali della stessa scheda.
+    """
+    label = "RS485"
+
+    def __init__(self, rs485, board, channel, status):
+        self.rs485 = rs485     # backend hal.KmtRs485 / hal.MockRs485
+        self.board = board
+        self.channel = channel
+        self.status = status   # {1..8: bool} riletto dalla scheda, se il driver non ha cache
+        self.result = None     # risultato dell'ultimo comando
+
+    def set(self, on):
+        self.result = self.rs485.set(self.channel, on, self.board)
+        if 'relays' in self.result:
+            self.status.update(self.result['relays'])
+        return self.result['status'] == 'Success'
+
+    def get(self):
+        status = self.rs485.status(self.board) or self.status
+        if self.channel == 'A':
+            return all(status.values())
+        return status[int(self.channel)]
+
+
+class AllOffOutput:
+    label = "AllOFF"
+    states = (False,)   # accetta solo OFF
+
+    def __init__(self, controller):
+        self.controller = controller
+
+    def set(self, on):
+        self.controller.AllOFF(feedback=False)
+        return True
+
+    def get(self):
+        return None
+
+
 class DeviceController:
-    def __init__(self, shell, rel1, rel2, ledGreen, ledRed, rgbRed, rgbGreen, rgbBlue, digOut1, digOut2, pcieOn, digIn1, digIn2):
+    STATES = {'ON': True, 'OFF': False}
+
+    def __init__(self, shell, rel1, rel2, ledGreen, ledRed, rgbRed, rgbGreen, rgbBlue, digOut1, digOut2, pcieOn, digIn1, digIn2, rs485=None):
         self.shell = shell
+        self.rs485 = rs485 if rs485 is not None else KmtRs485(RS485_PORT, RS485_IDS)
         self.rel1 = rel1
         self.rel2 = rel2
         self.ledGreen = ledGreen
@@ -145,214 +238,436 @@ class DeviceController:
         self.pcieOn = pcieOn
         self.digIn1 = digIn1
         self.digIn2 = digIn2
+        self.snapshot_seq = 0
+
+        # (tipo, indice) -> handler, per tipo nell'ordine di registrazione
+        self.handlers = {}
+        self.types = {}
+        self.register('R', '1', GpioOutput(rel1, label="Relay"))
+        self.register('R', '2', GpioOutput(rel2, label="Relay"))
+        # relè RS485: devNum '3' = canale 3 della prima scheda, '2.3' = scheda 2 canale 3
+        self.relx_status = {}
+        for board in RS485_IDS:
+            self.relx_status[board] = {ch: False for ch in range(1, 9)}
+            for ch in binproto.INDEXES['X'] + ('A',):
+                devNum = ch if board == RS485_IDS[0] else f"{board}.{ch}"
+                self.register('X', devNum, Rs485Output(self.rs485, board, ch, self.relx_status[board]))
+        self.register('L', 'r', GpioOutput(ledRed, active_low=True, label="LED"))
+        self.register('L', 'g', GpioOutput(ledGreen, active_low=True, label="LED"))
+        self.register('L', 'R', GpioOutput(rgbRed, active_low=True, label="LED"))
+        self.register('L', 'G', GpioOutput(rgbGreen, active_low=True, label="LED"))
+        self.register('L', 'B', GpioOutput(rgbBlue, active_low=True, label="LED"))
+        self.register('D', 'P', GpioOutput(pcieOn, label="Digs"))
+        self.register('D', '1', GpioOutput(digOut1, label="Digs"))
+        self.register('D', '2', GpioOutput(digOut2, label="Digs"))
+        self.register('A', 'A', AllOffOutput(self))
+        self.inputs = {'1': GpioInput(digIn1), '2': GpioInput(digIn2)}
+
+    def register(self, devType, devNum, handler):
+        """Add (or replace) the handler of a device; handler.set(on) -> bool."""
+        self.handlers[(devType, devNum)] = handler
+        self.types.setdefault(devType, {})[devNum] = handler
 
     def rel(self, relN, relState='OFF'):
-        state = 1 if relState == 'ON' else 0
-        if(relN=='1'):
-            self.rel1.set_values([state])
-        elif(relN=='2'):
-            self.rel2.set_values([state])
-        else:
-            # se il numero non è valido → spegne entrambi
-            self.rel1.set_values([0])
-            self.rel2.set_values([0])
-            relN = 'ERR'
-            relState = 'INVALID'
+        return self.deviceSet('R', relN, relState)
 
-        # Feedback LoRaWAN uplink
-        self.shell.do_send("T:R;N:" + relN + ";S:" + relState)
-        if self.shell._e.debug:
-            print(Fore.RED + "T:R;N:" + relN + ";S:" + relState)
-            print("Relay end" + Style.RESET_ALL)
-        
-    relxs = ['A', '1', '2', '3', '4', '5', '6', '7', '8']
     def relX(self, relXN, relXState='OFF'):
-        """Gestione dei relè esterni su RS485"""
-        if(relXN not in self.relxs):
-            #print("RelX not recognized")
-            return
-        if(relXState == 'ON'):
-            rs485_on(relXN)
-        elif(relXState == 'OFF'):
-            rs485_off(relXN)
-        # Feedback LoRaWAN uplink
-        self.shell.do_send("T:X;N:" + relXN + ";S:" + relXState)
-        if self.shell._e.debug:
-            print(Fore.RED + "T:X;N:" + relXN + ";S:" + relXState)
-            print("RS485 end" + Style.RESET_ALL)
+        """Gestione dei relè esterni su RS485 (relXN: '3' oppure 'scheda.canale', es. '2.3').
 
-    leds = ['r','g','R','G','B']
-    def led(self, led, ledState='OFF'):
-        state = 0 if ledState == 'ON' else 1 #Active low
-
-        if(led=='g'):
-            self.ledGreen.set_values([state])
-        elif(led=='r'):
-            self.ledRed.set_values([state])
-        elif(led=='R'):
-            self.rgbRed.set_values([state])
-        elif(led=='G'):
-            self.rgbGreen.set_values([state])
-        elif(led=='B'):
-            self.rgbBlue.set_values([state])
-        else:
-            self.ledRed.set_values([1])
-            self.ledGreen.set_values([1])
-            self.rgbRed.set_values([1])
-            self.rgbGreen.set_values([1])
-            self.rgbBlue.set_values([1])
-        self.shell.do_send("T:L;N:" + led + ";S:" + ledState)
-        if self.shell._e.debug:
-            print(Fore.RED + "T:L;N:" + led + ";S:" + ledState)
-            print("LED end" + Style.RESET_ALL)
+        Ritorna il risultato del driver ({'status': ..., 'relays': {...}})
+        oppure None se il comando non è valido.
+        """
+        self.deviceSet('X', relXN, relXState)
+        handler = self.handlers.get(('X', relXN))
+        return handler.result if handler is not None else None
 
+    def led(self, led, ledState='OFF'):
+        return self.deviceSet('L', led, ledState)
 
-    digs = ['P', '1', '2']
-    """Gestione delle uscite digitali"""
     def dig(self, digN, digStatus):
-        state = 1 if digStatus == 'ON' else 0 
-        if(digN=='P'):
-            self.pcieOn.set_values([state])
-        elif(digN=='1'):
-            self.digOut1.set_values([state])
-        elif(digN=='2'):
-            self.digOut2.set_values([state])
-        else:
-            self.pcieOn.set_values([0])
-            self.digOut1.set_values([0])
-            self.digOut2.set_values([0])
-        self.shell.do_send("T:D;N:" + digN + ";S:" + digStatus)
-        if self.shell._e.debug:
-            print(Fore.RED + "T:D;N:" + digN + ";S:" + digStatus)
-            print("Digs end" + Style.RESET_ALL)
+        """Gestione delle uscite digitali"""
+        return self.deviceSet('D', digN, digStatus)
 
-
-    def AllOFF(self):
+    def AllOFF(self, feedback=True):
         """Spegne tutte le periferiche"""
-        self.rel1.set_values([0])
-        self.rel2.set_values([0])
-        self.ledGreen.set_values([1])
-        self.ledRed.set_values([1])
-        self.rgbRed.set_values([1])
-        self.rgbGreen.set_values([1])
-        self.rgbBlue.set_values([1])
-        self.digOut1.set_values([0])
-        self.digOut2.set_values([0])
-        self.pcieOn.set_values([0])
-        self.relX("A", "OFF")
-        self.shell.do_send("T:A;N:A;S:OFF")
+        # tutte le uscite GPIO con un solo set_values() per gpiochip
+        self.scene([(handler, False) for (devType, devNum), handler in self.handlers.items()
+                    if isinstance(handler, GpioOutput)])
+        for devNum, handler in self.types['X'].items():
+            if handler.channel == 'A':
+                self.relX(devNum, "OFF")
+        if feedback:
+            self.shell.feedback("T:A;N:A;S:OFF")
 
         if self.shell._e.debug:
             print(Fore.RED + "T:A;N:A;S:OFF")
             print("AllOFF end" + Style.RESET_ALL)
 
+    def scene(self, outputs):
+        """Set [(GpioOutput, on), ...] together, one kernel call per gpiochip."""
+        GPIO_apply([(handler.line, handler.level(on)) for handler, on in outputs])
+
+    def snapshot(self):
+        """Current state of every output and input, as {type: {num: bool}}."""
+        outputs = {}
+        for devType in binproto.SNAPSHOT_TYPES:
+            outputs[devType] = {devNum: handler.get() for devNum, handler in self.types.get(devType, {}).items()
+                                if devNum != 'A'}
+        inputs = {devNum: handler.get() for devNum, handler in self.inputs.items()}
+        return outputs, inputs
+
+    def snapshot_uplink(self):
+        """Queue a binary snapshot of the whole node state (binproto.OP_SNAPSHOT)."""
+        outputs, inputs = self.snapshot()
+        frame = binproto.encode_snapshot(self.snapshot_seq, outputs, inputs)
+        self.snapshot_seq = (self.snapshot_seq + 1) & 0xFF
+        self.shell.feedback(frame, snapshotFPort)
+        if self.shell._e.debug:
+            print(Fore.RED + "Snapshot: " + self.shell._e.hex(frame) + Style.RESET_ALL)
+
     def deviceSet(self, devType, devNum, devStatus):  
         """
-        Decodifica del comando ricevuto e dispatch alla funzione corretta.
+        Decodifica del comando ricevuto e dispatch al handler registrato.
         device_type: R, X, L, D, A
         device_num: numero o identificativo (es. '1', '2', 'A')
         device_status: ON / OFF
+        Ritorna True se il comando è stato eseguito.
+        """
+        handler, on = self._resolve(devType, devNum, devStatus)
+        if handler is None:
+            return False
+        start = time.monotonic()
+        ok = handler.set(on)
+        REGISTRY.observe('embitshell_actuation_seconds', time.monotonic() - start, type=devType)
+        if not ok:
+            REGISTRY.inc('embitshell_actuation_errors_total', type=devType)
+            self._done(devType, devNum, "ERR", handler)
+            return False
+        self._done(devType, devNum, devStatus, handler)
+        return True
+
+    def deviceSetBatch(self, commands):
+        """Execute a list of (devType, devNum, devStatus) in order.
+
+        Consecutive GPIO and RS485 commands are merged: the GPIO outputs are
+        written together (one set_values() per gpiochip) and the RS485
+        channels of a board with one write per state, before the next
+        command of another kind (AllOFF); feedback keeps the order.
+        Returns {'executed': n, 'failed': [commands not executed]}.
         """
+        failed = []
+        scene = []   # comandi GPIO/RS485 consecutivi non ancora scritti
+        for command in commands:
+            handler, on = self._resolve(*command)
+            if handler is None:
+                failed.append(command)
+                continue
+            if isinstance(handler, (GpioOutput, Rs485Output)):
+                scene.append((command, handler, on))
+                continue
+            failed += self._apply_scene(scene)
+            scene = []
+            start = time.monotonic()
+            ok = handler.set(on)
+            REGISTRY.observe('embitshell_actuation_seconds', time.monotonic() - start, type=command[0])
+            if not ok:
+                REGISTRY.inc('embitshell_actuation_errors_total', type=command[0])
+                self._done(command[0], command[1], "ERR", handler)
+                failed.append(command)
+                continue
+            self._done(*command, handler)
+        failed += self._apply_scene(scene)
+        return {'executed': len(commands) - len(failed), 'failed': failed}
+
+    def _apply_scene(self, scene):
+        """Write [(command, handler, on), ...] of GpioOutput/Rs485Output, then
+        the feedback; return the commands not executed."""
+        if not scene:
+            return []
+        gpio = [(handler, on) for _, handler, on in scene if isinstance(handler, GpioOutput)]
+        if gpio:
+            start = time.monotonic()
+            self.scene(gpio)
+            REGISTRY.observe('embitshell_actuation_seconds', time.monotonic() - start, type='scene')
+        # RS485: stato finale di ogni canale, una scrittura per (scheda, stato)
+        final = {}
+        for _, handler, on in scene:
+            if isinstance(handler, Rs485Output):
+                channels = range(1, 9) if handler.channel == 'A' else [int(handler.channel)]
+                for ch in channels:
+                    final.setdefault(handler.board, {})[ch] = on
+        results = {}   # (board, canale) -> risultato della scrittura
+        for board, states in final.items():
+            for on in (False, True):
+                channels = [ch for ch, state in sorted(states.items()) if state == on]
+                if not channels:
+                    continue
+                start = time.monotonic()
+                result = self.rs485.set(",".join(map(str, channels)), on, board)
+                REGISTRY.observe('embitshell_actuation_seconds', time.monotonic() - start, type='X')
+                if 'relays' in result:
+                    self.relx_status[board].update(result['relays'])
+                for ch in channels:
+                    results[(board, ch)] = result
+        failed = []
+        for command, handler, _ in scene:
+            if isinstance(handler, Rs485Output):
+                channels = range(1, 9) if handler.channel == 'A' else [int(handler.channel)]
+                mine = [results[(handler.board, ch)] for ch in channels]
+                handler.result = mine[-1]
+                if any(result['status'] != 'Success' for result in mine):
+                    REGISTRY.inc('embitshell_actuation_errors_total', type=command[0])
+                    self._done(command[0], command[1], "ERR", handler)
+                    failed.append(command)
+                    continue
+            self._done(*command, handler)
+        return failed
+
+    def _resolve(self, devType, devNum, devStatus):
+        """Return (handler, on) for a command, (None, None) if not valid."""
         if self.shell._e.debug:
                 print(Fore.GREEN + "Parsed data: " )         
                 print(devType, devNum, devStatus + Style.RESET_ALL)
 
-        if devType == 'R':
-            if devNum in ['1', '2']:
-                if devStatus in ['ON', 'OFF']:
-                    self.rel(devNum, devStatus)
-                    """
-                    if(devNum=='1'):
-                        self.led('r',devStatus)
-                    else:
-                        self.led('g',devStatus)
-                    """
-                else:
-                    if self.shell._e.debug:
-                        print("Dev Status not recognized")
-            else:
-                if self.shell._e.debug:
-                    print("Dev Num not recognized") 
-        elif devType == 'X':
-            if devNum in self.relxs:
-                if devStatus in ['ON', 'OFF']:
-                    self.relX(devNum, devStatus)
-                else:
-                    if self.shell._e.debug:
-                        print("Dev Status not recognized")
-            else:
-                if self.shell._e.debug:
-                    print("Dev Num not recognized")
-        elif devType == 'L':
-            if devNum in self.leds:
-                if devStatus in ['ON', 'OFF']:
-                    self.led(devNum, devStatus)
-                else:
-                    if self.shell._e.debug:
-                        print("Dev Status not recognized")
-            else:
-                if self.shell._e.debug:
-                    print("Dev Num not recognized") 
-        elif devType == 'D':
-            if devNum in self.digs:
-                if devStatus in ['ON', 'OFF']:
-                    self.dig(devNum, devStatus)
-                else:
-                    if self.shell._e.debug:
-                        print("Dev Status not recognized")
-            else:
-                if self.shell._e.debug:
-                    print("Dev Num not recognized") 
-        else:
+        handler = self.handlers.get((devType, devNum))
+        if handler is None:
             if self.shell._e.debug:
-                print("Dev Type not recognized")  
+                print("Dev Type not recognized" if devType not in self.types else "Dev Num not recognized")
+            return None, None
+        on = self.STATES.get(devStatus)
+        if on not in getattr(handler, 'states', (True, False)):
+            if self.shell._e.debug:
+                print("Dev Status not recognized")
+            return None, None
+        return handler, on
+
+    def _done(self, devType, devNum, devStatus, handler):
+        # Feedback LoRaWAN uplink
+        message = "T:" + devType + ";N:" + devNum + ";S:" + devStatus
+        self.shell.feedback(message)
+        if self.shell._e.debug:
+            print(Fore.RED + message)
+            print(handler.label + " end" + Style.RESET_ALL)
+
+class RecentCommands:
+    """LRU of the last downlinks executed with a sequence number.
+
+    Key (FPort, seq, payload without seq): a retransmitted or replayed
+    downlink is found here and not executed again. The value is the
+    feedback it queued, [(message, port), ...], sent again on a repeat
+    in case the first uplink was lost.
+    """
+    def __init__(self, size=32):
+        self.size = size
+        self._keys = OrderedDict()
+        self.hits = 0
+
+    def get(self, key):
+        """Feedback recorded for an executed downlink, None if not found."""
+        if key not in self._keys:
+            return None
+        self._keys.move_to_end(key)
+        self.hits += 1
+        return self._keys[key]
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def add(self, key, feedback=()):
+        if self.size <= 0:
+            return
+        self._keys[key] = tuple(feedback)
+        self._keys.move_to_end(key)
+        while len(self._keys) > self.size:
+            self._keys.popitem(last=False)
 
 #rename config.py_TEMPLATE config.py and edit your keys accordingly
-import config
-phyAddr = config.phyAddr
-netProtocol = config.netProtocol 
-autoJoin = config.autoJoin
-adr = config.adr
-appKey = config.appKey
-RXtimeout = config.RXtimeout
+# valori di default, sostituiti da load_config() con quelli di config.py
+phyAddr = [0x00] * 16
+netProtocol = 1
+autoJoin = 1
+adr = 1
+appKey = [0x00] * 16
+RXtimeout = 15
+profiles = {}
+uplinkWindow = 0.5       # s di raccolta feedback per uplink
+uplinkMaxPayload = 51    # byte, 51 = SF12
+binaryFPort = 10         # FPort dei comandi binari (binproto.py)
+snapshotFPort = 11       # FPort dello snapshot di stato binario
+metricsFile = None       # file Prometheus (textfile collector)
+metricsInterval = 15     # s tra due scritture di metricsFile
+metricsPort = None       # porta HTTP locale per /metrics
+logDir = None            # cartella dei file *_errors.log, None = stderr
+logRateInterval = 60     # s tra due errori identici nel log
+snapshotInterval = 0     # s tra due snapshot periodici in modo auto, 0 = solo su richiesta
+inputDebounce = 0.05     # s di stabilità degli ingressi prima dello snapshot
+controlSocket = None     # socket Unix dei comandi locali in modo auto, None = disabilitato
+dedupSize = 32           # downlink con sequenza ricordati per scartare i duplicati, 0 = nessuno
+
+def load_config(required=True):
+    """Read config.py into the settings above (called by EmbitShell, not at import).
+
+    With required=False a missing config.py keeps the defaults (mock hardware).
+    """
+    global phyAddr, netProtocol, autoJoin, adr, appKey, RXtimeout, profiles
+    global uplinkWindow, uplinkMaxPayload, binaryFPort, snapshotFPort, RS485_IDS
+    global metricsFile, metricsInterval, metricsPort, logDir, logRateInterval
+    global snapshotInterval, inputDebounce, controlSocket, dedupSize
+    try:
+        import config
+    except ImportError:
+        if required:
+            raise
+        return
+    phyAddr = config.phyAddr
+    netProtocol = config.netProtocol 
+    autoJoin = config.autoJoin
+    adr = config.adr
+    appKey = config.appKey
+    RXtimeout = config.RXtimeout
+    profiles = getattr(config, 'profiles', profiles)
+    uplinkWindow = getattr(config, 'uplinkWindow', uplinkWindow)
+    uplinkMaxPayload = getattr(config, 'uplinkMaxPayload', uplinkMaxPayload)
+    binaryFPort = getattr(config, 'binaryFPort', binaryFPort)
+    snapshotFPort = getattr(config, 'snapshotFPort', snapshotFPort)
+    RS485_IDS = tuple(getattr(config, 'rs485Boards', RS485_IDS))  # ID schede KMTronic sul bus RS485
+    metricsFile = getattr(config, 'metricsFile', metricsFile)
+    metricsInterval = getattr(config, 'metricsInterval', metricsInterval)
+    metricsPort = getattr(config, 'metricsPort', metricsPort)
+    logDir = getattr(config, 'logDir', logDir)
+    logRateInterval = getattr(config, 'logRateInterval', logRateInterval)
+    snapshotInterval = getattr(config, 'snapshotInterval', snapshotInterval)
+    inputDebounce = getattr(config, 'inputDebounce', inputDebounce)
+    controlSocket = getattr(config, 'controlSocket', controlSocket)
+    dedupSize = getattr(config, 'dedupSize', dedupSize)
+
+#Warm start: fingerprint of the configuration applied at last provisioning
+import json, hashlib
+WARMSTART_FILE = Path(__file__).resolve().parent / "warmstart.json"
+
+UPLINK_CLOSE_TIMEOUT = 15   # s concessi all'uscita per svuotare la coda uplink
 
 class EmbitShell(cmd.Cmd):
     prompt = "EMB> "
 
-    def __init__(self, device, auto=None):
-        self._e = SafeEBI(device)   # <--- uso la classe "sicura"
+    def __init__(self, device, auto=None, warm=False, hardware=None, warmstart_file=None):
+        super().__init__()
+        self.loop = None   # EventLoop del modo auto
+        # hardware: Hardware() della scheda se None, Hardware.mock() per i test
+        self.hardware = hardware if hardware is not None else Hardware()
+        # file del warm start: WARMSTART_FILE sulla scheda, nessuno con Hardware.mock()
+        if warmstart_file is None and not self.hardware.is_mock:
+            warmstart_file = WARMSTART_FILE
+        self.warmstart_file = Path(warmstart_file) if warmstart_file is not None else None
+        load_config(required=not self.hardware.is_mock)
+        lines = self.hardware.open()
+        self._e = self.hardware.ebi(device)   # <--- uso la classe "sicura"
+        self._params = { 'channel': 1, 'sf': 7, 'bw': 0, 'cr': 1 } # 868.100 MHz, 128 Chips/symbol, 125 kHz, 4/5
 
         # passo tutte le risorse hardware al controller
         self.controller = DeviceController(
             self,
-            rel1, rel2,
-            ledGreen, ledRed, rgbRed, rgbGreen, rgbBlue,
-            digOut1, digOut2, pcieOn,
-            digIn1, digIn2
+            lines['rel1'], lines['rel2'],
+            lines['ledGreen'], lines['ledRed'], lines['rgbRed'], lines['rgbGreen'], lines['rgbBlue'],
+            lines['digOut1'], lines['digOut2'], lines['pcieOn'],
+            lines['digIn1'], lines['digIn2'],
+            rs485=self.hardware.rs485
         )
-
-        self._e.reset()
+        # i feedback del controller partono in uplink dal thread della coda
+        self.uplink = UplinkQueue(self._send_uplink, window=uplinkWindow, max_payload=uplinkMaxPayload)
+        # downlink già eseguiti (campo sequenza opzionale), per scartare le ripetizioni
+        self.recent = RecentCommands(dedupSize)
+        # feedback accodati dal downlink in esecuzione (vedi _downlink)
+        self._sent = None
+
+        # warm start: modulo già online con la stessa configurazione
+        # dell'ultimo avvio -> niente reset, provisioning e rejoin
+        self._warm = warm and self._warm_check()
+        if not self._warm:
+            self._warm_forget()
+            self._e.reset()
         state = self._e.state
         self.intro = "EMBIT module {embit_module} - FW {firmware_version}\n".format(**state)
-        if state['state'] == 'Online':
-            self._e.network_stop()
-        self._e.energy_save(0x00) # Always on
-        self._params = { 'channel': 1, 'sf': 7, 'bw': 0, 'cr': 1 } # 868.100 MHz, 128 Chips/symbol, 125 kHz, 4/5
-        self._e.operating_channel(*self._params.values())
-        self._e.network_start()
+        if not self._warm:
+            if state['state'] == 'Online':
+                self._e.network_stop()
+            self._e.energy_save(0x00) # Always on
+            self._e.operating_channel(*self._params.values())
+            self._e.network_start()
         if(auto == 'A'):
             self.do_debug("1")
             self.do_auto()
         if(auto == 'B'):
             self.do_debug("0")
             self.do_auto()
-        super().__init__()
+
+    def _warm_profile(self):
+        """Module configuration applied by a cold start followed by auto mode."""
+        return {
+            'channel': tuple(self._params.values()),
+            'energy_save': 0,
+            'preference': (netProtocol, autoJoin, adr),
+            'physical': list(phyAddr),
+            'app_key': list(appKey),
+        }
+
+    def _warm_fingerprint(self):
+        data = dict(self._warm_profile(), uuid=self._e.state.get('uuid'))
+        return hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+    def _warm_check(self):
+        if self.warmstart_file is None:
+            return False
+        try:
+            saved = json.loads(self.warmstart_file.read_text())
+        except (OSError, ValueError):
+            return False
+        if saved.get('fingerprint') != self._warm_fingerprint():
+            return False
+        if self._e.current_state() != 'Online':
+            return False
+        # le chiavi non si possono rileggere: le copre il fingerprint
+        profile = self._warm_profile()
+        del profile['app_key']
+        return not self._e.check_profile(profile)
+
+    def _warm_save(self):
+        if self.warmstart_file is None or self._e.current_state() != 'Online':
+            return
+        try:
+            self.warmstart_file.write_text(json.dumps({'fingerprint': self._warm_fingerprint()}))
+        except OSError as e:
+            logger.error(f"warm start: cannot save {self.warmstart_file}: {e}")
+
+    def _warm_forget(self):
+        if self.warmstart_file is None:
+            return
+        try:
+            self.warmstart_file.unlink()
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.error(f"warm start: cannot remove {self.warmstart_file}: {e}")
+
+    def feedback(self, message, port=None):
+        """Queue a feedback message; messages close in time share one uplink."""
+        if self._sent is not None:
+            self._sent.append((message, port))
+        self.uplink.put(message, port)
+
+    def _send_uplink(self, payload, port=None):
+        data = payload if isinstance(payload, bytes) else bytes(payload, 'utf8')
+        ret = self._e.safe_send_dataLW(payload=list(data), port=port or 6)
+        if self._e.debug:
+            print(payload, ret)
+        return ret
 
     def default(self, line):
         if line == "EOF":
             if self._e.debug:
                 print("\nBye!")
             self.controller.AllOFF()
+            self.uplink.close(UPLINK_CLOSE_TIMEOUT)
             return True
         return super().default(line)
 
@@ -393,8 +708,7 @@ value: [0-256]"""
                 if self._e.debug:
                     print("Invalid UART value {}".format(arg))
                 return
-        state = self._e.device_state()
-        should_stop = value and state['state'] == 'Online'
+        should_stop = value and self._e.current_state() == 'Online'
         if should_stop:
             self._e.network_stop()
         ret = self._e.uart(value)
@@ -416,8 +730,7 @@ value: [0-256]"""
                 if self._e.debug:
                     print("Invalid power value {}".format(arg))
                 return
-        state = self._e.device_state()
-        should_stop = value and state['state'] == 'Online'
+        should_stop = value and self._e.current_state() == 'Online'
         if should_stop:
             self._e.network_stop()
         ret = self._e.output_power(value)
@@ -473,8 +786,7 @@ cr: 0x01 -> 4/5
             except (ValueError, KeyError):
                 print("Invalid coding rate value {}".format(args[3]))
                 return
-        state = self._e.device_state()
-        should_stop = channel and state['state'] == 'Online'
+        should_stop = channel and self._e.current_state() == 'Online'
         if should_stop:
             self._e.network_stop()
         ret = self._e.operating_channel(channel, spreading_factor, bandwidth, coding_rate)
@@ -501,8 +813,7 @@ value: [0-65535]"""
             except ValueError:
                 print("Invalid address value {}".format(arg))
                 return
-        state = self._e.device_state()
-        should_stop = value and state['state'] == 'Online'
+        should_stop = value and self._e.current_state() == 'Online'
         if should_stop:
             self._e.network_stop()
         ret = self._e.network_address(value)
@@ -517,8 +828,7 @@ Usage: region [value]
 
 value: [0-1-2]"""
         value = None
-        state = self._e.device_state()
-        should_stop = value and state['state'] == 'Online'
+        should_stop = value and self._e.current_state() == 'Online'
         if should_stop:
             self._e.network_stop()
         ret = self._e.region(value)
@@ -540,8 +850,7 @@ value: [0-65535]"""
             except ValueError:
                 print("Invalid network value {}".format(arg))
                 return
-        state = self._e.device_state()
-        should_stop = value and state['state'] == 'Online'
+        should_stop = value and self._e.current_state() == 'Online'
         if should_stop:
             self._e.network_stop()
         ret = self._e.network_identifier(value)
@@ -594,6 +903,37 @@ dest: [0-65535]; specify no dest for broadcast"""
         if self._e.debug:
             print(ret)
 
+    def do_uplink(self, arg):
+        """show the feedback uplink queue: depth, sent uplinks/messages, latency
+Usage: uplink"""
+        print(self.uplink.stats())
+
+    def do_metrics(self, arg):
+        """show command latency (p50/p95) and errors per EBI opcode, actuation and receive timings
+Usage: metrics [prom]    prom = full Prometheus text"""
+        if arg.strip() == 'prom':
+            print(REGISTRY.render(), end='')
+            return
+        ms = lambda v: '-' if v is None else '%.1f' % (v * 1000)
+        print("%-22s %8s %8s %8s %8s" % ("", "count", "p50 ms", "p95 ms", "errors"))
+        for labels, count in sorted(REGISTRY.values('ebi_commands_total').items()):
+            opcode = dict(labels)['opcode']
+            errors = (REGISTRY.get('ebi_no_response_total', opcode=opcode, reason='timeout')
+                      + REGISTRY.get('ebi_no_response_total', opcode=opcode, reason='write'))
+            print("%-22s %8d %8s %8s %8d" % ("opcode " + opcode, count, ms(REGISTRY.quantile('ebi_command_seconds', 0.5, opcode=opcode)),
+                                             ms(REGISTRY.quantile('ebi_command_seconds', 0.95, opcode=opcode)), errors))
+        for name in ('embitshell_actuation_seconds', 'embitshell_receive_seconds'):
+            for labels, h in sorted(REGISTRY.histograms(name).items()):
+                label = name.split('_')[1] + " " + "/".join(str(v) for _, v in labels)
+                print("%-22s %8d %8s %8s" % (label, h.count, ms(h.quantile(0.5)), ms(h.quantile(0.95))))
+        print("BCC errors:", REGISTRY.get('ebi_bcc_errors_total'))
+        print("Duplicate downlinks:", REGISTRY.get('embitshell_duplicate_downlinks_total'))
+
+    def do_snapshot(self, arg):
+        """send a binary snapshot of outputs and inputs on snapshotFPort
+Usage: snapshot"""
+        self.controller.snapshot_uplink()
+
     def do_report(self, arg):
         """print all the setting parameter
 Usage: report"""
@@ -626,19 +966,88 @@ timeout in seconds; specify no timeout to wait forever"""
         else:
             options, RSSI, FPort, data = self._e.receive(0, RXtimeout)
         if RSSI:
-            #self.controller.led('R', 'ON')
-
-            if self._e.debug:
-                print(Fore.GREEN + "Received data: " )
-                print("RSSI:" , RSSI, " - FPort: ", FPort, " - Data: ", data + Style.RESET_ALL)
-            
-            dataSplit=data.split(":")
-            self.controller.deviceSet(dataSplit[0], dataSplit[1], dataSplit[2])
-            #time.sleep(0.5)
-            #self.controller.led('R', 'OFF')
+            self._downlink(FPort, RSSI, data)
         else:
+            self._rx_idle()
+
+    def _downlink(self, FPort, RSSI, data):
+        #self.controller.led('R', 'ON')
+        kind = 'binary' if FPort == binaryFPort else 'text'
+        start = time.monotonic()
+        self._sent = []
+        try:
+            self._handle_downlink(FPort, RSSI, data)
+        finally:
+            self._sent = None
+            REGISTRY.inc('embitshell_downlinks_total', kind=kind)
+            REGISTRY.observe('embitshell_receive_seconds', time.monotonic() - start, kind=kind)
+
+    def _rx_idle(self):
+        # finestra di RXtimeout s senza downlink
+        REGISTRY.inc('embitshell_receive_timeouts_total')
+        if self._e.debug:
+            print ("\r", strftime("%H:%M:%S", localtime()), end='' )
+
+    def _handle_downlink(self, FPort, RSSI, data):
+        """Decodifica ed esegue un downlink (testo o binario su binaryFPort)."""
+        if FPort == binaryFPort:
+            # comandi binari: più comandi per frame (vedi binproto.py)
+            raw = data.encode('latin-1')
             if self._e.debug:
-                print ("\r", strftime("%H:%M:%S", localtime()), end='' )
+                print(Fore.GREEN + "Received binary data: " )
+                print("RSSI:" , RSSI, " - FPort: ", FPort, " - Data: ", self._e.hex(raw) + Style.RESET_ALL)
+            try:
+                seq, frame = binproto.split_seq(raw)
+                commands = None if frame[:1] == bytes([binproto.OP_SNAPSHOT]) else binproto.decode(frame)
+            except ValueError as e:
+                logger.error(f"binary downlink {self._e.hex(raw)}: {e}")
+                return
+            if self._duplicate(FPort, seq, frame):
+                return
+            if commands is None:
+                self.controller.snapshot_uplink()
+                self._executed(FPort, seq, frame)
+                return
+            ret = self.controller.deviceSetBatch(commands)
+            if ret['failed']:
+                logger.error(f"binary downlink {self._e.hex(raw)}: not executed {ret['failed']}")
+            else:
+                self._executed(FPort, seq, frame)
+            return
+
+        if self._e.debug:
+            print(Fore.GREEN + "Received data: " )
+            print("RSSI:" , RSSI, " - FPort: ", FPort, " - Data: ", data + Style.RESET_ALL)
+        
+        # T:N:S oppure T:N:S:SEQ
+        dataSplit=data.split(":")
+        seq = dataSplit[3] if len(dataSplit) > 3 else None
+        command = ":".join(dataSplit[:3])
+        if self._duplicate(FPort, seq, command):
+            return
+        if self.controller.deviceSet(dataSplit[0], dataSplit[1], dataSplit[2]):
+            self._executed(FPort, seq, command)
+        #time.sleep(0.5)
+        #self.controller.led('R', 'OFF')
+
+    def _duplicate(self, FPort, seq, payload):
+        """True if the downlink was already executed: no actuation, its feedback is queued again."""
+        if seq is None:
+            return False
+        sent = self.recent.get((FPort, seq, payload))
+        if sent is None:
+            return False
+        REGISTRY.inc('embitshell_duplicate_downlinks_total')
+        if self._e.debug:
+            print(Fore.RED + f"Duplicate downlink (seq {seq}), already executed" + Style.RESET_ALL)
+        # il primo uplink può essere andato perso: stesso feedback, nessuna attuazione
+        for message, port in sent:
+            self.feedback(message, port)
+        return True
+
+    def _executed(self, FPort, seq, payload):
+        if seq is not None:
+            self.recent.add((FPort, seq, payload), self._sent or ())
 
     def do_abp(self, arg):
         """set lorawan protocol parameters with ABP (NO auto join)
@@ -648,11 +1057,7 @@ value: [0-65535]"""
         value = arg   
         if self._e.debug:
             print("=============================================")
-        state = self._e.device_state()
-        if state['state'] == 'Online':
-            should_stop = True
-        else:
-            should_stop = False
+        should_stop = self._e.current_state() == 'Online'
         if should_stop:
             self._e.network_stop()
         if self._e.debug:
@@ -735,40 +1140,56 @@ value: [0-1-2]"""
                 if self._e.debug:
                     print("Invalid Class {}".format(arg))
                 return  
-        state = self._e.device_state()
-        if state['state'] == 'Online':
-            should_stop = True
-        else:
-            should_stop = False
-        if should_stop:
-            self._e.network_stop()
-
-        ret = self._e.physical_address(phyAddr)
-        if self._e.debug:
-            print(ret)
-        ret = self._e.physical_address()
-        if self._e.debug:
-            print(ret)
-
-        ret = self._e.network_preference(netProtocol,autoJoin,adr)
-        if self._e.debug:
-            print(ret)
-        ret = self._e.network_preference()
+        #Energy save option 00 = Class C - 01 = Class A - 02 = TX Only
+        ret = self._e.apply_profile({
+            'physical': phyAddr,
+            'preference': (netProtocol, autoJoin, adr),
+            'app_key': appKey,
+            'energy_save': value,
+        }, start=True)
         if self._e.debug:
             print(ret)
 
-        ret = self._e.app_key(appKey)
-        if self._e.debug:
-            print(ret)
+    def do_profile(self, arg):
+        """apply a configuration profile with a single network stop/start
+Usage: profile name | key=value [key=value ...]
 
-        #Energy save option 00 = Class C - 01 = Class A - 02 = TX Only
-        ret = self._e.energy_save(value)
+name:  profile defined in config.py (profiles = {'name': {...}})
+key:   power, channel, energy_save, region, address, identifier,
+       preference, physical, app_key, app_Skey, nwk_Skey
+value: number, or comma separated numbers (e.g. channel=1,9,0,1)"""
+        if not arg:
+            print("Please specify a profile name or key=value pairs")
+            return
+        profile = {}
+        for token in arg.split():
+            if '=' not in token:
+                if token not in profiles:
+                    print("Unknown profile {}".format(token))
+                    return
+                invalid = sorted(set(profiles[token]) - set(EBI.PROFILE_KEYS))
+                if invalid:
+                    print("Invalid profile key {} in profile {}".format(', '.join(invalid), token))
+                    return
+                profile.update(profiles[token])
+                continue
+            key, value = token.split('=', 1)
+            if key not in EBI.PROFILE_KEYS:
+                print("Invalid profile key {}".format(key))
+                return
+            try:
+                value = [int(v, 0) for v in value.split(',')]
+            except ValueError:
+                print("Invalid value for {}: {}".format(key, value))
+                return
+            profile[key] = value[0] if len(value) == 1 and key in ('power', 'energy_save', 'region') else value
+        ret = self._e.apply_profile(profile)
+        if ret.get('status') == 'InvalidParameter':
+            for key, error in ret['errors'].items():
+                print("Invalid value for {}: {}".format(key, error))
+            return
         if self._e.debug:
             print(ret)
-        if self._e.debug:
-            print(self._e.energy_save())  
-
-        self._e.network_start()
 
     def do_app_key(self, arg):
         """set device AppKey
@@ -783,8 +1204,7 @@ value: [16 byte]"""
             except ValueError:
                 print("Invalid address value {}".format(arg))
                 return
-        state = self._e.device_state()
-        should_stop = value and state['state'] == 'Online'
+        should_stop = value and self._e.current_state() == 'Online'
         if should_stop:
             self._e.network_stop()
         #ret = self._e.app_key(value)
@@ -810,33 +1230,108 @@ value: [0-65535]"""
         if self._e.debug:
             print(self._e.device_state())
 
-    def do_auto(self):
+    def do_auto(self, arg=None):
         """Put the module in continuos receive
 Usage: auto
 
-value: []"""
-        self.do_lorawan(0)
+value: []
+Downlinks, digital inputs, timers and the control socket (config.controlSocket)
+are served by one event loop; 'quit' on the control socket ends it."""
+        if self._warm:
+            if self._e.debug:
+                print('Warm start: configuration unchanged, skipping provisioning')
+        else:
+            self.do_lorawan(0)
+            self._warm_save()
         if self._e.debug:
             print('RX loop')  
         self.do_send('T:OK;N:OK;S:OK')   
-        while(1):   
-            self.do_receive()
-            
+        self.controller.snapshot_uplink()   # stato completo per il backend
+        self.loop = self._event_loop()
+        try:
+            self.loop.run()
+        finally:
+            if self._control is not None:
+                self._control.close()
+            self.loop.close()
+            self.loop = None
+
+    def _event_loop(self):
+        """EventLoop of the auto mode, with every handler registered."""
+        loop = EventLoop()
+        # downlink: il reader EBI segnala i frame in coda su un fd
+        loop.add_reader(self._e.event_fileno(), self._on_frames)
+        self._rx_seen = False
+        loop.call_every(RXtimeout, self._on_rx_tick)
+        # ingressi digitali: eventi sui fronti, snapshot dopo inputDebounce s
+        self._input_timer = None
+        for num, handler in self.controller.inputs.items():
+            fd = handler.event_fileno()
+            if fd is not None:
+                loop.add_reader(fd, self._on_input, num, handler)
+        if snapshotInterval:
+            loop.call_every(snapshotInterval, self.controller.snapshot_uplink)
+        self._control = None
+        if controlSocket:
+            try:
+                self._control = ControlChannel(loop, controlSocket, self._on_control)
+            except OSError as e:
+                logger.error(f"control socket {controlSocket}: {e}")
+        return loop
+
+    def _on_frames(self):
+        for frame in self._e.read_pending():
+            options, RSSI, FPort, data = self._e.parse_received(frame)
+            if RSSI:
+                self._rx_seen = True
+                self._downlink(FPort, RSSI, data)
+
+    def _on_rx_tick(self):
+        if not self._rx_seen:
+            self._rx_idle()
+        self._rx_seen = False
+
+    def _on_input(self, num, handler):
+        on = handler.read_event()
+        if self._e.debug:
+            print(Fore.GREEN + "Input " + num + (": ON" if on else ": OFF") + Style.RESET_ALL)
+        if self._input_timer is not None:
+            self._input_timer.cancel()
+        self._input_timer = self.loop.call_later(inputDebounce, self.controller.snapshot_uplink)
+
+    def _on_control(self, line):
+        """Comando della shell dal canale di controllo, eseguito nel thread del loop."""
+        command = self.parseline(line)[0]
+        if not command or command == 'auto' or not hasattr(self, 'do_' + command):
+            return "ERR unknown command"
+        if self.onecmd(line):
+            self.loop.stop()
+        return "OK"
+
     def do_quit(self, arg):
             """quit EMB shell
     Usage: quit"""
             if self._e.debug:
                 print("\nBye!")
             self.controller.AllOFF()
+            self.uplink.close(UPLINK_CLOSE_TIMEOUT)
             return True
 
 if __name__ == '__main__':
-    #Avvio processo RS485==============
-    _rs485_start()  # avvio subito all'inizio
-    
+    load_config()
+
+    #Logging non bloccante (logsetup.py)
+    from logsetup import setup_logging
+    setup_logging(logDir, rate_interval=logRateInterval)
+
     device = "/dev/ttyS6"
     auto = None
 
+    # --warm: salta reset e provisioning se il modulo ha già la configurazione
+    warm = '--warm' in sys.argv
+    if warm:
+        sys.argv.remove('--warm')
+
     n = len(sys.argv)
     if n > 1:
         auto = sys.argv[1]
@@ -849,11 +1344,28 @@ if __name__ == '__main__':
     if n > 2:
         device = sys.argv[2]
 
-    shell = EmbitShell(device, auto)
+    #Esportazione metriche (metrics.py)
+    try:
+        if metricsFile:
+            REGISTRY.start_textfile(metricsFile, metricsInterval)
+        if metricsPort:
+            REGISTRY.serve(metricsPort)
+    except Exception as e:
+        logger.error(f"metrics export error: {e}")
+
+    shell = EmbitShell(device, auto, warm)
+    if auto is not None:
+        sys.exit(0)   # il loop di auto è terminato con 'quit' dal canale di controllo
     shell.controller.AllOFF()
 
+    try:
+        import readline   # editing e storia delle righe nella shell interattiva
+    except ImportError:
+        pass
+
     try:
         shell.cmdloop()
     except KeyboardInterrupt:
         print("\nBye!")
-        shell.controller.AllOFF()
\ No newline at end of file
+        shell.controller.AllOFF()
+        shell.uplink.close(UPLINK_CLOSE_TIMEOUT)
\ No newline at end of file
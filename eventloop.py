@@ -0,0 +1,230 @@
+#!/usr/bin/python3
+
+"""Single-threaded event loop on selectors, for embitshell's auto mode.
+
+    loop = EventLoop()
+    loop.add_reader(fd, callback, *args)       # callback(*args) when fd is readable
+    timer = loop.call_later(5, callback, *args)
+    loop.call_every(60, callback)              # periodic, without drift
+    loop.call_soon_threadsafe(callback)        # from another thread
+    loop.run()                                 # until loop.stop()
+
+run() sleeps in select() (epoll on Linux) until an fd is readable or the
+next timer is due, so an idle node uses no CPU. Callbacks run one at a time
+in the loop thread; an exception is logged and the loop goes on.
+
+ControlChannel is a local Unix socket on the loop: every line received is
+passed to a handler whose return value is sent back.
+"""
+
+import heapq
+import logging
+import os
+import selectors
+import socket
+import time
+from collections import deque
+
+logger = logging.getLogger("embitshell")
+
+
+class Timer:
+    __slots__ = ('deadline', 'interval', 'callback', 'args', 'cancelled')
+
+    def __init__(self, deadline, interval, callback, args):
+        self.deadline = deadline
+        self.interval = interval
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def __lt__(self, other):
+        return self.deadline < other.deadline
+
+
+class EventLoop:
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self._timers = []          # heap di Timer, quelli annullati restano fino alla scadenza
+        self._ready = deque()      # callback da call_soon_threadsafe
+        self._running = False
+        # self-pipe: sveglia select() da un altro thread
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        os.set_blocking(self._wakeup_r, False)
+        os.set_blocking(self._wakeup_w, False)
+        self.selector.register(self._wakeup_r, selectors.EVENT_READ, (self._run_ready, ()))
+
+    # -------------------- registrazione --------------------
+    def add_reader(self, fd, callback, *args):
+        self.selector.register(fd, selectors.EVENT_READ, (callback, args))
+
+    def remove_reader(self, fd):
+        try:
+            self.selector.unregister(fd)
+        except (KeyError, ValueError):
+            pass
+
+    def call_at(self, deadline, callback, *args):
+        """Run callback(*args) at time.monotonic() deadline; return the Timer."""
+        timer = Timer(deadline, None, callback, args)
+        heapq.heappush(self._timers, timer)
+        return timer
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(time.monotonic() + delay, callback, *args)
+
+    def call_every(self, interval, callback, *args):
+        """Run callback(*args) every interval s, the first time after interval s."""
+        timer = Timer(time.monotonic() + interval, interval, callback, args)
+        heapq.heappush(self._timers, timer)
+        return timer
+
+    def call_soon_threadsafe(self, callback, *args):
+        self._ready.append((callback, args))
+        self._wakeup()
+
+    def stop(self):
+        """Stop run() after the current callback (from any thread)."""
+        self._running = False
+        self._wakeup()
+
+    # -------------------- ciclo --------------------
+    def run(self):
+        self._running = True
+        while self._running:
+            self._run_timers()
+            if not self._running:
+                break
+            timeout = max(self._timers[0].deadline - time.monotonic(), 0) if self._timers else None
+            for key, _ in self.selector.select(timeout):
+                callback, args = key.data
+                self._call(callback, args)
+                if not self._running:
+                    break
+
+    def _run_timers(self):
+        now = time.monotonic()
+        while self._timers and (self._timers[0].cancelled or self._timers[0].deadline <= now):
+            timer = heapq.heappop(self._timers)
+            if timer.cancelled:
+                continue
+            if timer.interval:
+                timer.deadline += timer.interval
+                if timer.deadline <= now:
+                    # in ritardo di più di un periodo: salta i giri persi
+                    timer.deadline = now + timer.interval
+                heapq.heappush(self._timers, timer)
+            self._call(timer.callback, timer.args)
+            if not self._running:
+                return
+            now = time.monotonic()
+
+    def _call(self, callback, args):
+        try:
+            callback(*args)
+        except Exception as e:
+            logger.error(f"event loop: {getattr(callback, '__name__', callback)} failed: {e!r}")
+
+    def _wakeup(self):
+        try:
+            os.write(self._wakeup_w, b'\0')
+        except (BlockingIOError, OSError):
+            pass   # pipe piena (select si sveglierà comunque) o loop chiuso
+
+    def _run_ready(self):
+        try:
+            while os.read(self._wakeup_r, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        while self._ready:
+            callback, args = self._ready.popleft()
+            self._call(callback, args)
+
+    def close(self):
+        self.selector.close()
+        for fd in (self._wakeup_r, self._wakeup_w):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+
+class ControlChannel:
+    """Line based Unix socket served by an EventLoop.
+
+    handler(line) -> reply str (a newline is added); the socket is created
+    with mode 0600, replacing a stale one left by a previous run.
+    """
+    MAX_LINE = 1024
+
+    def __init__(self, loop, path, handler):
+        self.loop = loop
+        self.path = path
+        self.handler = handler
+        self._buffers = {}    # socket -> bytearray della riga in arrivo
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o177)
+        try:
+            self.server.bind(path)
+        finally:
+            os.umask(old_umask)
+        self.server.listen(4)
+        self.server.setblocking(False)
+        loop.add_reader(self.server.fileno(), self._accept)
+
+    def _accept(self):
+        try:
+            conn, _ = self.server.accept()
+        except (BlockingIOError, OSError):
+            return
+        conn.setblocking(False)
+        self._buffers[conn] = bytearray()
+        self.loop.add_reader(conn.fileno(), self._read, conn)
+
+    def _read(self, conn):
+        try:
+            data = conn.recv(4096)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self._drop(conn)
+            return
+        buffer = self._buffers[conn]
+        buffer += data
+        while b'\n' in buffer:
+            line, _, rest = bytes(buffer).partition(b'\n')
+            buffer[:] = rest
+            reply = self.handler(line.decode('utf8', 'replace').strip())
+            try:
+                conn.sendall((str(reply) + '\n').encode('utf8'))
+            except OSError:
+                self._drop(conn)
+                return
+        if len(buffer) > self.MAX_LINE:
+            logger.error("control channel: line too long, closing connection")
+            self._drop(conn)
+
+    def _drop(self, conn):
+        self.loop.remove_reader(conn.fileno())
+        self._buffers.pop(conn, None)
+        conn.close()
+
+    def close(self):
+        for conn in list(self._buffers):
+            self._drop(conn)
+        self.loop.remove_reader(self.server.fileno())
+        self.server.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
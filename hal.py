@@ -0,0 +1,317 @@
+#!/usr/bin/python3
+
+"""Hardware backends of embitshell: GPIO lines and KMTronic RS485 boards.
+
+Nothing here touches the hardware at import time: embitshell.Hardware asks
+the backends for its lines when EmbitShell is constructed.
+
+    GpiodGpio()            libgpiod v1, gpiochips opened on first request
+    MockGpio()             in memory, every write recorded in .writes
+    KmtRs485(port, boards) KMTronic boards on one RS485 bus (KMT_RS485.py),
+                           port opened on the first command
+    MockRs485(boards)      in memory relays, every write recorded in .writes
+
+A GPIO backend has offset(pin_name) and request(chip, offsets, consumer,
+direction, defaults) -> lines with set_values()/get_values(), like a
+gpiod.LineBulk; direction "events" is an input line that also has
+event_fileno() (readable on every edge) and read_event() -> new level.
+An RS485 backend has set(ch, on, board) -> result dict, status(board) and
+close().
+
+The mock writes are (time.perf_counter(), chip or board, offsets or
+channels, values or on), so a test can check what was written and when.
+"""
+
+import logging
+import os
+import re
+import threading
+import time
+
+logger = logging.getLogger("embitshell")
+
+
+# -------------------- GPIO --------------------
+class GpiodGpio:
+    def __init__(self):
+        import gpiod
+        self.gpiod = gpiod
+        self.chips = {}    # nome -> gpiod.Chip, aperti alla prima richiesta
+
+    def offset(self, pin_name):
+        line = self.gpiod.find_line(pin_name)
+        if line is None:
+            raise Exception(f"GPIO {pin_name} not found")
+        return line.offset()
+
+    def request(self, chip, offsets, consumer, direction, defaults=None):
+        if chip not in self.chips:
+            self.chips[chip] = self.gpiod.Chip(chip)
+        lines = self.chips[chip].get_lines(offsets)
+        if direction == "out":
+            lines.request(consumer=consumer, type=self.gpiod.LINE_REQ_DIR_OUT,
+                          default_vals=defaults or [0] * len(offsets))
+        elif direction == "in":
+            lines.request(consumer=consumer, type=self.gpiod.LINE_REQ_DIR_IN)
+        elif direction == "events":
+            lines.request(consumer=consumer, type=self.gpiod.LINE_REQ_EV_BOTH_EDGES)
+            return GpiodEventLine(self.gpiod, lines)
+        else:
+            raise ValueError("set direction to 'in', 'out' or 'events'")
+        return lines
+
+    def close(self):
+        for chip in self.chips.values():
+            chip.close()
+        self.chips.clear()
+
+
+class GpiodEventLine:
+    """Input line requested for both edges (first line of the bulk)."""
+    def __init__(self, gpiod, lines):
+        self.gpiod = gpiod
+        self.lines = lines
+        self.line = lines.to_list()[0]
+
+    def get_values(self):
+        return self.lines.get_values()
+
+    def event_fileno(self):
+        return self.line.event_get_fd()
+
+    def read_event(self):
+        event = self.line.event_read()
+        return 1 if event.type == self.gpiod.LineEvent.RISING_EDGE else 0
+
+
+class MockLines:
+    def __init__(self, gpio, chip, offsets, output, events=False):
+        self.gpio = gpio
+        self.chip = chip
+        self.offsets = tuple(offsets)
+        self.output = output
+        self._event_r = self._event_w = None
+        if events:
+            self._event_r, self._event_w = os.pipe()
+            os.set_blocking(self._event_r, False)
+
+    def set_values(self, values):
+        if not self.output:
+            raise OSError("line requested as input")
+        self.gpio._write(self.chip, self.offsets, values)
+
+    def get_values(self):
+        return [self.gpio.levels.get((self.chip, offset), 0) for offset in self.offsets]
+
+    def event_fileno(self):
+        return self._event_r
+
+    def read_event(self):
+        try:
+            return os.read(self._event_r, 1)[0]
+        except BlockingIOError:
+            return None
+
+    def _edge(self, value):
+        if self._event_w is not None:
+            os.write(self._event_w, bytes([value]))
+
+    def close(self):
+        for fd in (self._event_r, self._event_w):
+            if fd is not None:
+                os.close(fd)
+        self._event_r = self._event_w = None
+
+
+class MockGpio:
+    """In memory GPIO: pioXnn is offset nn of the chip it is requested on."""
+
+    def __init__(self):
+        self.levels = {}      # (chip, offset) -> 0/1
+        self.requested = {}   # (chip, offset) -> consumer
+        self.inputs = {}      # (chip, offset) -> MockLines richieste con "events"
+        self.writes = []      # (perf_counter, chip, offsets, values)
+        self._lock = threading.Lock()
+
+    def offset(self, pin_name):
+        match = re.search(r'(\d+)$', pin_name)
+        if match is None:
+            raise Exception(f"GPIO {pin_name} not found")
+        return int(match.group(1))
+
+    def request(self, chip, offsets, consumer, direction, defaults=None):
+        if direction not in ("in", "out", "events"):
+            raise ValueError("set direction to 'in', 'out' or 'events'")
+        for offset in offsets:
+            if (chip, offset) in self.requested:
+                raise OSError(f"{chip} line {offset} busy ({self.requested[(chip, offset)]})")
+            self.requested[(chip, offset)] = consumer
+        lines = MockLines(self, chip, offsets, direction == "out", direction == "events")
+        if direction == "out":
+            self._write(chip, lines.offsets, defaults or [0] * len(offsets))
+        elif direction == "events":
+            for offset in offsets:
+                self.inputs[(chip, offset)] = lines
+        return lines
+
+    def _write(self, chip, offsets, values):
+        with self._lock:
+            self.writes.append((time.perf_counter(), chip, offsets, tuple(values)))
+            for offset, value in zip(offsets, values):
+                self.levels[(chip, offset)] = value
+
+    def set_input(self, chip, pin_name, value):
+        """Drive an input line from the test (an edge event if it changes)."""
+        key = (chip, self.offset(pin_name))
+        value = int(bool(value))
+        changed = self.levels.get(key, 0) != value
+        self.levels[key] = value
+        if changed and key in self.inputs:
+            self.inputs[key]._edge(value)
+
+    def close(self):
+        for lines in set(self.inputs.values()):
+            lines.close()
+        self.inputs.clear()
+
+
+class GpioBank:
+    """Uscite di un gpiochip richieste insieme (bulk request).
+
+    Ogni aggiornamento riscrive tutte le linee del chip con un solo
+    set_values(), cioè una sola ioctl: le uscite cambiano insieme.
+    """
+    def __init__(self, gpio, chip, consumer="embitshell"):
+        self.gpio = gpio
+        self.chip = chip
+        self.consumer = consumer
+        self.offsets = []
+        self.values = []     # ultimo valore scritto per ogni linea
+        self.lines = None
+        self.lock = threading.Lock()
+
+    def add(self, pin_name, default_val=0):
+        self.offsets.append(self.gpio.offset(pin_name))
+        self.values.append(default_val)
+        return BankLine(self, len(self.offsets) - 1)
+
+    def request(self):
+        self.lines = self.gpio.request(self.chip, self.offsets, self.consumer, "out", self.values)
+
+    def set(self, changes):
+        """changes: {index: value}; one set_values() for the whole chip."""
+        with self.lock:
+            values = list(self.values)
+            for index, value in changes.items():
+                values[index] = value
+            self.lines.set_values(values)
+            self.values = values
+
+    def get(self):
+        return self.lines.get_values()
+
+
+class BankLine:
+    """Una linea di un GpioBank, con la stessa interfaccia di una linea gpiod."""
+    def __init__(self, bank, index):
+        self.bank = bank
+        self.index = index
+
+    def set_values(self, values):
+        self.bank.set({self.index: values[0]})
+
+    def get_values(self):
+        return [self.bank.get()[self.index]]
+
+
+def GPIO_apply(changes):
+    """Apply [(BankLine, value), ...] with one set_values() per gpiochip."""
+    banks = {}
+    for line, value in changes:
+        banks.setdefault(line.bank, {})[line.index] = value
+    for bank, values in banks.items():
+        bank.set(values)
+
+
+# -------------------- RS485 --------------------
+class KmtRs485:
+    def __init__(self, port="/dev/ttyS4", boards=(1,)):
+        self.port = port
+        self.boards = tuple(boards)
+        self.bus = None      # RS485Bus, aperto al primo comando
+        self.relays = {}     # board_id -> KMTronicRelay sul bus
+
+    def relay(self, board=1):
+        """Apre la porta RS485 alla prima richiesta (o dopo un errore di apertura)."""
+        if self.bus is None:
+            from KMT_RS485 import RS485Bus
+            self.bus = RS485Bus(port=self.port)
+        if board not in self.relays:
+            self.relays[board] = self.bus.board(board)
+        return self.relays[board]
+
+    def set(self, ch, on, board=1):
+        """Comanda i relè di una scheda e ne rilegge lo stato.
+
+        Ritorna {'status': 'Success', 'relays': {1: bool, ... 8: bool}},
+        {'status': 'Mismatch', 'relays': ...} se la scheda non ha eseguito il
+        comando, {'status': 'Exception', 'error': ...} se non risponde.
+        """
+        from KMT_RS485 import parse_channels
+        try:
+            channels = parse_channels(ch)
+            relays = self.relay(board).set_relay(channels, on=on, verify=True)
+        except Exception as e:
+            logger.error(f"RS485 board {board} error: {e}")
+            return {'status': 'Exception', 'error': str(e)}
+        if any(relays[c] != on for c in channels):
+            logger.error(f"RS485: board {board} did not switch {ch} {'ON' if on else 'OFF'}: {relays}")
+            return {'status': 'Mismatch', 'relays': relays}
+        return {'status': 'Success', 'relays': relays}
+
+    def status(self, board=1):
+        """Stato dei relè dalla cache del driver (nessuna lettura sul bus), None se ignoto."""
+        relay = self.relays.get(board)
+        return relay.last_status if relay is not None else None
+
+    def close(self):
+        try:
+            for relay in self.relays.values():
+                relay.close()
+            if self.bus is not None:
+                self.bus.close()
+        except Exception:
+            pass
+        self.relays.clear()
+        self.bus = None
+
+
+class MockRs485:
+    """In memory KMTronic boards; boards in `failing` do not answer."""
+
+    def __init__(self, boards=(1,), failing=()):
+        self.boards = tuple(boards)
+        self.failing = set(failing)
+        self.relays = {board: {ch: False for ch in range(1, 9)} for board in self.boards}
+        self.writes = []     # (perf_counter, board, channels, on)
+
+    def set(self, ch, on, board=1):
+        from KMT_RS485 import parse_channels
+        try:
+            channels = parse_channels(ch)
+        except Exception as e:
+            return {'status': 'Exception', 'error': str(e)}
+        if board in self.failing or board not in self.relays:
+            logger.error(f"RS485 board {board} error: no answer")
+            return {'status': 'Exception', 'error': "no answer"}
+        self.writes.append((time.perf_counter(), board, tuple(channels), on))
+        for c in channels:
+            self.relays[board][c] = on
+        return {'status': 'Success', 'relays': dict(self.relays[board])}
+
+    def status(self, board=1):
+        relays = self.relays.get(board)
+        return dict(relays) if relays is not None else None
+
+    def close(self):
+        pass
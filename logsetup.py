@@ -0,0 +1,131 @@
+#!/usr/bin/python3
+
+"""Logging set up by the application, never at import time.
+
+The libraries (ebi.py, ebiframe.py, aioebi.py, uplink.py) only get their
+logger ("ebi", "embitshell"); the script that runs them calls
+
+    setup_logging(log_dir=config.logDir)
+
+which attaches to each logger a QueueHandler: logger.error() in the serial
+reader or in send() only puts the record on a bounded in-memory queue, and
+a QueueListener thread writes it to <log_dir>/<logger>_errors.log (stderr
+when log_dir is None). If the queue is full the record is dropped and
+counted instead of blocking.
+
+RateLimitFilter lets through the first occurrence of a message and then at
+most one every `interval` seconds, reporting how many were suppressed, so
+an error storm during a radio outage costs a dict lookup per call.
+"""
+
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+
+FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
+DATEFMT = "%Y-%m-%d %H:%M:%S"
+LOGGERS = ("ebi", "embitshell")
+
+
+class RateLimitFilter(logging.Filter):
+    """Pass an identical (logger, level, message) at most once per interval s."""
+
+    def __init__(self, interval=60.0, maxkeys=256):
+        super().__init__()
+        self.interval = interval
+        self.maxkeys = maxkeys
+        self._seen = {}   # key -> [prossimo istante ammesso, soppressi]
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        key = (record.name, record.levelno, record.getMessage())
+        now = time.monotonic()
+        with self._lock:
+            entry = self._seen.get(key)
+            if entry is not None and now < entry[0]:
+                entry[1] += 1
+                return False
+            suppressed = entry[1] if entry is not None else 0
+            if entry is None and len(self._seen) >= self.maxkeys:
+                # scarta le chiavi scadute, poi la più vecchia
+                self._seen = {k: v for k, v in self._seen.items() if v[0] > now}
+                if len(self._seen) >= self.maxkeys:
+                    del self._seen[min(self._seen, key=lambda k: self._seen[k][0])]
+            self._seen[key] = [now + self.interval, 0]
+        if suppressed:
+            record.msg = "%s (repeated %d times in the last %gs)" % (record.getMessage(), suppressed, self.interval)
+            record.args = None
+        return True
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that never blocks: drops the record when the queue is full."""
+
+    def __init__(self, q):
+        super().__init__(q)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_listeners = []
+
+
+def setup_logging(log_dir=None, level=logging.ERROR, rate_interval=60.0, queue_size=1000, loggers=LOGGERS):
+    """Configure the library loggers; return the QueueListener.
+
+    log_dir: directory of <logger>_errors.log files, None = stderr.
+    rate_interval: seconds between two identical messages, 0 = no limit.
+    Calling it again replaces the previous listener, flushing its queue.
+    """
+    formatter = logging.Formatter(FORMAT, datefmt=DATEFMT)
+    q = queue.Queue(queue_size)
+    targets = []
+    for name in loggers:
+        if log_dir is None:
+            handler = logging.StreamHandler()
+        else:
+            handler = logging.FileHandler(os.path.join(log_dir, "%s_errors.log" % name), delay=True)
+        handler.setFormatter(formatter)
+        # il listener smista per nome del logger
+        handler.addFilter(logging.Filter(name))
+        targets.append(handler)
+    listener = logging.handlers.QueueListener(q, *targets, respect_handler_level=True)
+
+    for name in loggers:
+        logger = logging.getLogger(name)
+        for old in [h for h in logger.handlers if isinstance(h, DroppingQueueHandler)]:
+            logger.removeHandler(old)
+        handler = DroppingQueueHandler(q)
+        if rate_interval:
+            handler.addFilter(RateLimitFilter(rate_interval))
+        logger.addHandler(handler)
+        logger.setLevel(level)
+        logger.propagate = False
+
+    # i vecchi handler non ricevono più record: svuota e chiudi il listener precedente
+    _stop_listeners()
+    listener.start()
+    _listeners.append(listener)
+    return listener
+
+
+@atexit.register
+def _stop_listeners():
+    # svuota la coda prima dell'uscita
+    while _listeners:
+        listener = _listeners.pop()
+        try:
+            listener.stop()
+        except Exception:
+            pass
+        for handler in listener.handlers:
+            handler.close()
@@ -0,0 +1,221 @@
+#!/usr/bin/python3
+
+"""Counters and latency histograms in the Prometheus text format.
+
+ebi.py and embitshell.py record into the shared REGISTRY:
+
+    REGISTRY.inc('ebi_commands_total', opcode='0x11')
+    REGISTRY.observe('ebi_command_seconds', 0.012, opcode='0x11')
+
+and the application exposes it with either
+
+    REGISTRY.start_textfile('/var/lib/node_exporter/textfile/embitshell.prom', 15)
+    REGISTRY.serve(9105)            # http://127.0.0.1:9105/metrics
+
+The text file is rewritten atomically every interval, for node_exporter's
+textfile collector. quantile() estimates a percentile from the histogram
+buckets (what Prometheus' histogram_quantile() does) for local display.
+"""
+
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# secondi: dai comandi UART (ms) fino a join/send data (s)
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)   # ultimo = +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        i = 0
+        for bound in self.buckets:
+            if value <= bound:
+                break
+            i += 1
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Linear interpolation inside the bucket holding the q-th observation."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        lower = 0.0
+        for bound, n in zip(self.buckets + (float('inf'),), self.counts):
+            if seen + n >= rank and n:
+                if bound == float('inf'):
+                    return lower
+                return lower + (bound - lower) * (rank - seen) / n
+            seen += n
+            lower = bound
+        return lower
+
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format(name, labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return name
+    return name + '{' + ','.join('%s="%s"' % (k, str(v).replace('"', '\\"')) for k, v in pairs) + '}'
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}      # (name, labels) -> float, counter e gauge
+        self._histograms = {}  # (name, labels) -> Histogram
+        self._kinds = {}       # name -> (kind, help)
+        self._writer = None
+        self._server = None
+
+    def describe(self, name, kind, help=''):
+        self._kinds[name] = (kind, help)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._values[(name, _labels(labels))] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def get(self, name, **labels):
+        with self._lock:
+            return self._values.get((name, _labels(labels)), 0)
+
+    def quantile(self, name, q, **labels):
+        with self._lock:
+            histogram = self._histograms.get((name, _labels(labels)))
+            return histogram.quantile(q) if histogram is not None else None
+
+    def values(self, name):
+        """{labels tuple: value} of a counter or gauge."""
+        with self._lock:
+            return {labels: v for (n, labels), v in self._values.items() if n == name}
+
+    def histograms(self, name):
+        """{labels dict as tuple: Histogram} of a histogram metric."""
+        with self._lock:
+            return {labels: h for (n, labels), h in self._histograms.items() if n == name}
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+            self._histograms.clear()
+
+    # -------------------- esportazione --------------------
+    def render(self):
+        """Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            names = sorted({name for name, _ in self._values} | {name for name, _ in self._histograms})
+            for name in names:
+                kind, help = self._kinds.get(name, ('histogram' if any(n == name for n, _ in self._histograms)
+                                                    else 'counter' if name.endswith('_total') else 'gauge', ''))
+                if help:
+                    lines.append('# HELP %s %s' % (name, help))
+                lines.append('# TYPE %s %s' % (name, kind))
+                for (n, labels), value in sorted(self._values.items()):
+                    if n == name:
+                        lines.append('%s %s' % (_format(name, labels), value))
+                for (n, labels), h in sorted(self._histograms.items(), key=lambda item: item[0]):
+                    if n != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(h.buckets + ('+Inf',), h.counts):
+                        cumulative += count
+                        lines.append('%s %d' % (_format(name + '_bucket', labels, [('le', bound)]), cumulative))
+                    lines.append('%s %s' % (_format(name + '_sum', labels), round(h.sum, 6)))
+                    lines.append('%s %d' % (_format(name + '_count', labels), h.count))
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, path):
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(self.render())
+        os.replace(tmp, path)
+
+    def start_textfile(self, path, interval=15):
+        """Rewrite path every interval seconds from a daemon thread."""
+        if self._writer is not None:
+            return self._writer
+
+        def run():
+            while True:
+                try:
+                    self.write_textfile(path)
+                except OSError:
+                    pass
+                time.sleep(interval)
+
+        self._writer = threading.Thread(target=run, name="metrics-textfile", daemon=True)
+        self._writer.start()
+        return self._writer
+
+    def serve(self, port, addr='127.0.0.1'):
+        """Serve GET /metrics on addr:port from a daemon thread."""
+        if self._server is not None:
+            return self._server
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((addr, port), Handler)
+        threading.Thread(target=self._server.serve_forever, name="metrics-http", daemon=True).start()
+        return self._server
+
+
+REGISTRY = Metrics()
+REGISTRY.describe('ebi_commands_total', 'counter', 'EBI commands sent, by opcode')
+REGISTRY.describe('ebi_command_seconds', 'histogram', 'EBI command round trip time, by opcode')
+REGISTRY.describe('ebi_no_response_total', 'counter', 'EBI commands without answer, by opcode and reason')
+REGISTRY.describe('ebi_bcc_errors_total', 'counter', 'EBI frames received with a wrong BCC')
+REGISTRY.describe('ebi_dropped_frames_total', 'counter', 'EBI frames dropped by the reader, by reason')
+REGISTRY.describe('ebi_unexpected_frames_total', 'counter', 'Unsolicited EBI frames other than received data and state, by opcode')
+REGISTRY.describe('embitshell_downlinks_total', 'counter', 'Downlinks handled by embitshell, by kind (text/binary)')
+REGISTRY.describe('embitshell_duplicate_downlinks_total', 'counter', 'Downlinks with an already executed sequence number, ignored')
+REGISTRY.describe('embitshell_receive_seconds', 'histogram', 'Time from downlink received to commands executed, by kind')
+REGISTRY.describe('embitshell_receive_timeouts_total', 'counter', 'receive windows elapsed without downlink')
+REGISTRY.describe('embitshell_actuation_seconds', 'histogram', 'Time to drive an output, by device type (scene = GPIO batch)')
+REGISTRY.describe('embitshell_actuation_errors_total', 'counter', 'Outputs not driven (e.g. RS485 board not answering), by device type')
+REGISTRY.describe('embitshell_uplinks_total', 'counter', 'Feedback uplinks sent')
+REGISTRY.describe('embitshell_uplink_errors_total', 'counter', 'Feedback uplinks not accepted by the module')
+REGISTRY.describe('embitshell_uplink_dropped_total', 'counter', 'Feedback messages dropped because the queue was full')
+REGISTRY.describe('embitshell_uplink_queue_depth', 'gauge', 'Feedback messages waiting after the last uplink')
+REGISTRY.describe('embitshell_uplink_latency_seconds', 'histogram', 'Feedback message time from queued to sent')
@@ -2,8 +2,10 @@
 
 import sys
 from ebi import EBI
+from logsetup import setup_logging
 
 if __name__ == "__main__":
+    setup_logging()
     device = "/dev/ttyUSB0"
     try:
         device = sys.argv[1]
@@ -2,11 +2,13 @@
 
 import sys, time
 from ebi import EBI
+from logsetup import setup_logging
 import codecs
 
 #print(codecs.decode('1deadbeef4', 'hex'))
 
 if __name__ == "__main__":
+    setup_logging()
     device = "/dev/ttyUSB0"
     try:
         device = sys.argv[1]
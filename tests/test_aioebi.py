@@ -0,0 +1,89 @@
+import asyncio
+import os
+
+from aioebi import AsyncEBI
+from ebi import EBI
+from ebiemu import EmbitEmulator, READY
+
+
+def run(test, queue_size=32, **emulator):
+    """Run test(e, emu) on an opened AsyncEBI connected to the emulator."""
+    async def main(emu):
+        async with AsyncEBI(emu.port, queue_size=queue_size) as e:
+            return await test(e, emu)
+
+    with EmbitEmulator(**emulator) as emu:
+        return asyncio.run(main(emu))
+
+
+def test_answers_matched_by_opcode():
+    async def test(e, emu):
+        # risposte concorrenti e un downlink in mezzo: ognuna al suo comando
+        emu.inject(b'L:g:ON', port=1)
+        power, channel, state = await asyncio.gather(
+            e.output_power(), e.operating_channel(), e.request([0x04]))
+        assert power == {'power': 14}
+        assert channel['channel'] == 1
+        assert list(state) == [0x30]
+        assert (await e.next_event(1))[0] == 0xE0
+
+    run(test, state=0x30)
+
+
+def test_reset_answer_and_boot_banner():
+    async def test(e, emu):
+        ret = await e.reset()
+        assert ret == {'status': 'Success', 'boot_state': EBI.DEVICE_STATE[READY]}
+        assert e.events.empty()           # il banner 0x84 è della reset, non un evento
+
+    run(test, state=0x30)
+
+
+def test_events_overflow_drops_oldest():
+    async def test(e, emu):
+        for i in range(3):
+            emu.inject(b'%d' % i, port=1)
+        await e.request([0x04])           # risposta dopo i tre downlink
+        assert e.events.qsize() == 2
+        frames = [await e.next_event(1) for _ in range(2)]
+        assert [e.parse_received(f)[3] for f in frames] == ['1', '2']
+
+    run(test, queue_size=2)
+
+
+def test_receive_timeout():
+    async def test(e, emu):
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        assert await e.receive(0, 0.05) == (None, None, None, None)
+        assert loop.time() - start < 1
+
+    run(test)
+
+
+def test_partial_frame_then_valid_frame():
+    async def test(e, emu):
+        os.write(emu._master, bytes([0x12]))          # rumore: lunghezza 0x12xx
+        await asyncio.sleep(e.FRAME_GAP * 2)
+        assert e._decoder.pending == 0
+        emu.inject(b'L:g:ON', port=1)
+        options, rssi, port, data = await e.receive(0, 1)
+        assert (port, data) == (1, 'L:g:ON')
+        assert list(await e.request([0x04])) == [READY]
+
+    run(test)
+
+
+def test_port_lost_fails_pending_requests():
+    async def test(e, emu):
+        loop = asyncio.get_running_loop()
+        request = asyncio.ensure_future(e.request([0x31], timeout=5))   # join in corso
+        await asyncio.sleep(0.05)
+        emu.close()
+        start = loop.time()
+        assert await request is None
+        assert loop.time() - start < 1
+        assert await e.request([0x04]) is None
+        assert not e._pending
+
+    run(test, join_time=3)
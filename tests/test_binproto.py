@@ -0,0 +1,65 @@
+import pytest
+
+import binproto
+
+
+def test_set_roundtrip():
+    commands = [('R', '1', 'ON'), ('X', 'A', 'OFF'), ('L', 'g', 'ON'), ('D', 'P', 'OFF')]
+    assert binproto.decode(binproto.encode_set(commands)) == commands
+
+
+def test_set_example():
+    # LED verde ON: tipo L=2, stato ON, indice 1
+    assert binproto.encode_set([('L', 'g', 'ON')]) == bytes([0x01, 0x51])
+
+
+def test_mask_example():
+    frame = binproto.encode_mask({'X': {str(i): 'ON' for i in range(1, 9)},
+                                  'R': {'1': 'ON', '2': 'OFF'}})
+    assert frame == bytes([0x02, 0x01, 0xFF, 0xFF, 0x00, 0x03, 0x01])
+    commands = binproto.decode(frame)
+    assert commands[:8] == [('X', str(i), 'ON') for i in range(1, 9)]
+    assert commands[8:] == [('R', '1', 'ON'), ('R', '2', 'OFF')]
+
+
+def test_split_seq():
+    frame = binproto.encode_set([('L', 'g', 'ON')], seq=0x11)
+    assert frame == bytes([0x81, 0x11, 0x51])
+    assert binproto.split_seq(frame) == (0x11, bytes([0x01, 0x51]))
+    assert binproto.split_seq(bytes([0x01, 0x51])) == (None, bytes([0x01, 0x51]))
+    assert binproto.decode(frame) == [('L', 'g', 'ON')]
+
+
+def test_split_seq_truncated():
+    with pytest.raises(ValueError):
+        binproto.split_seq(bytes([0x81]))
+
+
+@pytest.mark.parametrize('data', [
+    b'',
+    bytes([0x07]),              # opcode sconosciuto
+    bytes([0x01, 0xE0]),        # tipo 7
+    bytes([0x01, 0x05]),        # R ha solo due indici
+    bytes([0x02, 0x01, 0xFF]),  # OP_MASK troncato
+])
+def test_decode_invalid(data):
+    with pytest.raises(ValueError):
+        binproto.decode(data)
+
+
+def test_encode_invalid():
+    with pytest.raises(ValueError):
+        binproto.encode_command('R', '3', 'ON')
+    with pytest.raises(ValueError):
+        binproto.encode_command('Z', '1', 'ON')
+
+
+def test_snapshot_roundtrip():
+    outputs = {'R': {'1': True}, 'X': {'8': True}, 'L': {'B': True}, 'D': {}}
+    data = binproto.encode_snapshot(0x1FF, outputs, {'2': True})
+    assert data == bytes([0x03, 0xFF, 0x01, 0x80, 0x10, 0x00, 0x02])
+    seq, decoded, inputs = binproto.decode_snapshot(data)
+    assert seq == 0xFF
+    assert decoded['R'] == {'1': True, '2': False}
+    assert decoded['X']['8'] and not decoded['X']['1']
+    assert inputs == {'1': False, '2': True}
@@ -0,0 +1,121 @@
+import os
+import time
+
+import pytest
+
+from ebi import EBI
+from ebiemu import EmbitEmulator
+
+
+@pytest.fixture
+def ebi():
+    with EmbitEmulator(state=0x30) as emu:
+        e = EBI(emu.port)
+        e.emulator = emu
+        yield e
+        e.close()
+
+
+def test_send_roundtrip(ebi):
+    ans = ebi.send([0x04])
+    assert list(ans) == [0x30]     # risposta senza opcode: stato Online
+
+
+def test_unsolicited_frame(ebi):
+    ebi.emulator.inject(b'L:g:ON:3', port=1)
+    options, RSSI, FPort, data = ebi.receive(0, 2)
+    assert (FPort, data) == (1, 'L:g:ON:3')
+    assert RSSI
+
+
+def test_cache_hits(ebi):
+    first = ebi.output_power()
+    assert ebi.output_power() == first == {'power': 14}
+    assert ebi.emulator.commands[0x10] == 1
+
+
+def test_cache_set_and_reset(ebi):
+    assert ebi.output_power(10)['status'] == 'Success'
+    assert ebi.output_power() == {'power': 10}     # dal setter, nessuna lettura
+    assert ebi.emulator.commands[0x10] == 1
+    ebi.reset()
+    assert ebi.output_power() == {'power': 10}
+    assert ebi.emulator.commands[0x10] == 2
+
+
+def test_cache_after_join(ebi):
+    commands = ebi.emulator.commands
+    ebi.output_power()
+    ebi.network_identifier()
+    assert ebi.network_start()['status'] == 'Success'
+    ebi.output_power()                             # JOIN_CHANGES: riletta
+    ebi.network_identifier()                       # invariata: dalla cache
+    assert commands[0x10] == 2
+    assert commands[0x22] == 1
+
+
+def test_cache_after_unexpected_boot(ebi):
+    ebi.output_power()
+    ebi.emulator._answer([0x84, 0x00])             # il modulo si è riavviato da solo
+    deadline = time.monotonic() + 2
+    while ebi.state['state'] != EBI.DEVICE_STATE[0x00] and time.monotonic() < deadline:
+        time.sleep(0.005)
+    ebi.output_power()
+    assert ebi.emulator.commands[0x10] == 2
+
+
+def test_reader_survives_empty_frame(ebi):
+    os.write(ebi.emulator._master, bytes([0x00, 0x03, 0x03]))
+    time.sleep(EBI.FRAME_GAP * 2)
+    assert list(ebi.send([0x04])) == [0x30]
+
+
+def test_reader_survives_dispatch_error(ebi, monkeypatch, caplog):
+    def broken(code):
+        raise ValueError("broken")
+
+    monkeypatch.setattr(ebi, '_set_state', broken)
+    ebi.emulator._answer([0x84, 0x00])
+    deadline = time.monotonic() + 2
+    while 'dropped' not in caplog.text and time.monotonic() < deadline:
+        time.sleep(0.005)
+    assert 'broken' in caplog.text
+    assert list(ebi.send([0x04])) == [0x30]
+
+
+@pytest.mark.parametrize('profile', [
+    {'channel': (1, 99, 0, 1)},
+    {'energy_save': 7},
+    {'preference': (1, 1, 2)},
+    {'app_key': [0x11] * 15},
+    {'power': 10, 'address': [0x01, 0x02, 0x03]},
+])
+def test_apply_profile_rejects_invalid_values(ebi, profile):
+    before = dict(ebi.emulator.commands)
+    ret = ebi.apply_profile(profile)
+    assert ret['status'] == 'InvalidParameter'
+    assert set(ret['errors']) <= set(profile)
+    assert ebi.emulator.commands == before      # modulo mai interrogato
+    assert ebi.emulator.state == 0x30
+
+
+def test_apply_profile_unknown_key(ebi):
+    before = dict(ebi.emulator.commands)
+    with pytest.raises(KeyError):
+        ebi.apply_profile({'bogus': 1})
+    assert ebi.emulator.commands == before
+
+
+def test_apply_profile_writes_only_changes(ebi):
+    ret = ebi.apply_profile({'power': 10, 'channel': (1, 7, 0, 1), 'energy_save': 0})
+    assert ret == {'channel': 'Unchanged', 'energy_save': 'Unchanged',
+                   'network_stop': 'Success', 'power': 'Success', 'network_start': 'Success'}
+    emu = ebi.emulator
+    assert emu.params[0x10] == bytes([10])
+    assert emu.commands.get(0x30) == 1 and emu.commands.get(0x31) == 1
+
+
+def test_apply_profile_unchanged_keeps_network(ebi):
+    ret = ebi.apply_profile({'power': 14, 'channel': (1, 7, 0, 1)})
+    assert ret == {'power': 'Unchanged', 'channel': 'Unchanged'}
+    assert 0x30 not in ebi.emulator.commands and 0x31 not in ebi.emulator.commands
@@ -0,0 +1,74 @@
+from ebiframe import FrameEncoder, FrameDecoder, bcc
+
+COMMAND = [0x50, 0x0D, 0x00, 0x06] + list(b'T:R;N:1;S:ON')
+
+
+def frame(command):
+    return bytes(FrameEncoder().encode(command))
+
+
+def test_encode_layout():
+    data = frame([0x04])
+    assert data == bytes([0x00, 0x04, 0x04, bcc([0x00, 0x04, 0x04])])
+
+
+def test_encode_grows_buffer():
+    encoder = FrameEncoder(size=4)
+    data = bytes(encoder.encode(COMMAND))
+    assert len(data) == len(COMMAND) + 3
+    assert data[2:-1] == bytes(COMMAND)
+
+
+def test_decode_roundtrip():
+    decoder = FrameDecoder()
+    decoder.feed(frame(COMMAND))
+    assert decoder.pop() == bytes(COMMAND)
+    assert decoder.pop() is None
+    assert decoder.pending == 0
+    assert decoder.frames == 1
+
+
+def test_decode_byte_by_byte():
+    decoder = FrameDecoder()
+    data = frame(COMMAND) + frame([0x04])
+    frames = []
+    for b in data:
+        decoder.feed(bytes([b]))
+        frames += list(decoder)
+    assert frames == [bytes(COMMAND), bytes([0x04])]
+
+
+def test_resync_after_bcc_error():
+    decoder = FrameDecoder()
+    bad = bytearray(frame(COMMAND))
+    bad[-1] ^= 0xFF
+    decoder.feed(bytes(bad) + frame([0x04]))
+    assert list(decoder) == [bytes([0x04])]
+    assert decoder.bcc_errors == 1
+    assert decoder.pending == 0
+
+
+def test_resync_after_invalid_length():
+    decoder = FrameDecoder()
+    decoder.feed(bytes([0x00, 0x00]) + frame([0x06]))
+    assert list(decoder) == [bytes([0x06])]
+
+
+def test_frame_without_opcode_is_rejected():
+    decoder = FrameDecoder()
+    decoder.feed(bytes([0x00, 0x03, 0x03]))
+    assert decoder.pop() is None
+    assert decoder.frames == 0
+    # scartato un byte come per una lunghezza impossibile; il resto lo
+    # elimina il reader dopo FRAME_GAP s di silenzio
+    assert decoder.pending == 2
+
+
+def test_partial_frame_is_kept():
+    decoder = FrameDecoder()
+    data = frame(COMMAND)
+    decoder.feed(data[:5])
+    assert decoder.pop() is None
+    assert decoder.pending == 5
+    decoder.feed(data[5:])
+    assert decoder.pop() == bytes(COMMAND)
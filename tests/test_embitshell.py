@@ -0,0 +1,195 @@
+import pytest
+
+import binproto
+import embitshell
+from ebiemu import EmbitEmulator
+from embitshell import RecentCommands
+
+
+def test_recent_commands_lru():
+    recent = RecentCommands(size=2)
+    recent.add((1, '1', 'L:g:ON'))
+    recent.add((1, '2', 'L:g:OFF'))
+    assert (1, '1', 'L:g:ON') in recent       # ora è il più recente
+    recent.add((1, '3', 'L:r:ON'))
+    assert (1, '2', 'L:g:OFF') not in recent
+    assert (1, '1', 'L:g:ON') in recent
+    assert recent.hits == 2
+
+
+def test_recent_commands_disabled():
+    recent = RecentCommands(size=0)
+    recent.add((1, '1', 'L:g:ON'))
+    assert (1, '1', 'L:g:ON') not in recent
+
+
+@pytest.fixture(scope='module')
+def emulator():
+    with EmbitEmulator() as emu:
+        yield emu
+
+
+@pytest.fixture
+def shell(emulator):
+    shell = embitshell.EmbitShell(emulator.port, hardware=embitshell.Hardware.mock(emulator))
+    shell.feedbacks = []
+    shell.uplink.put = lambda message, port=None: shell.feedbacks.append((message, port))
+    yield shell
+    shell.uplink.close(5)
+    shell._e.close()
+
+
+def receive(shell, emulator, data, port=1):
+    emulator.inject(data, port)
+    shell.do_receive('')
+
+
+def test_text_downlink(shell, emulator):
+    gpio = shell.hardware.gpio
+    writes = len(gpio.writes)
+    receive(shell, emulator, b'L:g:ON')
+    assert len(gpio.writes) == writes + 1
+    assert len(shell.feedbacks) == 1
+
+
+def test_text_duplicate_not_executed(shell, emulator):
+    gpio = shell.hardware.gpio
+    receive(shell, emulator, b'L:g:ON:7')
+    writes = len(gpio.writes)
+    receive(shell, emulator, b'L:g:ON:7')
+    assert len(gpio.writes) == writes
+    # il feedback della prima esecuzione viene rimesso in coda
+    assert shell.feedbacks == [('T:L;N:g;S:ON', None)] * 2
+    # stessa sequenza, comando diverso: eseguito
+    receive(shell, emulator, b'L:g:OFF:7')
+    assert len(gpio.writes) == writes + 1
+    assert shell.feedbacks[-1] == ('T:L;N:g;S:OFF', None)
+
+
+def test_binary_duplicate_not_executed(shell, emulator):
+    rs485 = shell.hardware.rs485
+    frame = binproto.encode_set([('X', '1', 'ON'), ('X', '2', 'ON')], seq=0x21)
+    receive(shell, emulator, frame, embitshell.binaryFPort)
+    writes = list(rs485.writes)
+    feedbacks = list(shell.feedbacks)
+    assert len(feedbacks) == 2
+    receive(shell, emulator, frame, embitshell.binaryFPort)
+    assert rs485.writes == writes
+    assert shell.feedbacks == feedbacks * 2
+
+
+def test_batch_keeps_order(shell):
+    ret = shell.controller.deviceSetBatch([('A', 'A', 'OFF'), ('R', '1', 'ON')])
+    assert ret['failed'] == []
+    assert shell.controller.rel1.get_values() == [1]
+
+
+def test_batch_coalesces_rs485_channels(shell):
+    rs485 = shell.hardware.rs485
+    ret = shell.controller.deviceSetBatch([('X', str(ch), 'ON') for ch in (1, 2, 3)] + [('X', '2', 'OFF')])
+    assert ret['failed'] == []
+    assert sorted(w[1:] for w in rs485.writes) == [(1, (1, 3), True), (1, (2,), False)]
+    assert len(shell.feedbacks) == 4
+
+
+def test_batch_failing_board(emulator):
+    hardware = embitshell.Hardware.mock(emulator, rs485=embitshell.MockRs485((1,), failing=(1,)))
+    shell = embitshell.EmbitShell(emulator.port, hardware=hardware)
+    shell.uplink.put = lambda message, port=None: None
+    try:
+        ret = shell.controller.deviceSetBatch([('X', '1', 'ON'), ('L', 'g', 'ON')])
+        assert ret['failed'] == [('X', '1', 'ON')]
+    finally:
+        shell.uplink.close(5)
+        shell._e.close()
+
+
+def test_profile_invalid_value_not_applied(shell, emulator, capsys):
+    before = dict(emulator.commands)
+    shell.do_profile('power=10 channel=1,99,0,1')
+    assert 'Invalid value for channel' in capsys.readouterr().out
+    assert emulator.commands == before
+    assert emulator.params[0x10] == bytes([14])
+
+
+def warm_shell(emu, path, warm):
+    shell = embitshell.EmbitShell(emu.port, warm=warm, hardware=embitshell.Hardware.mock(emu),
+                                  warmstart_file=path)
+    shell.uplink.close(5)
+    shell._e.close()
+    return shell
+
+
+@pytest.fixture
+def provisioned(tmp_path):
+    # avvio a freddo + provisioning come in do_auto(): salva il fingerprint
+    path = tmp_path / 'warmstart.json'
+    with EmbitEmulator() as emu:
+        shell = embitshell.EmbitShell(emu.port, hardware=embitshell.Hardware.mock(emu),
+                                      warmstart_file=path)
+        shell._e.apply_profile(shell._warm_profile(), start=True)
+        shell._warm_save()
+        shell.uplink.close(5)
+        shell._e.close()
+        assert path.exists() and emu.state == 0x30
+        emu.commands.clear()
+        yield emu, path
+
+
+def test_warm_start_skips_reset_and_join(provisioned):
+    emu, path = provisioned
+    shell = warm_shell(emu, path, warm=True)
+    assert shell._warm
+    assert 0x05 not in emu.commands and 0x31 not in emu.commands
+    assert path.exists()
+
+
+def test_warm_start_fingerprint_mismatch_is_cold(provisioned):
+    emu, path = provisioned
+    path.write_text('{"fingerprint": "other"}')
+    shell = warm_shell(emu, path, warm=True)
+    assert not shell._warm
+    assert emu.commands.get(0x05) == 1 and emu.commands.get(0x31) == 1
+    assert not path.exists()
+
+
+def test_cold_start_without_warm_flag(provisioned):
+    emu, path = provisioned
+    shell = warm_shell(emu, path, warm=False)
+    assert not shell._warm
+    assert emu.commands.get(0x05) == 1 and emu.commands.get(0x31) == 1
+    assert not path.exists()
+
+
+def test_warm_start_module_changed_is_cold(provisioned):
+    emu, path = provisioned
+    emu.params[0x11] = bytes([0x01, 0x09, 0x00, 0x01])   # SF cambiato sul modulo
+    shell = warm_shell(emu, path, warm=True)
+    assert not shell._warm
+    assert emu.commands.get(0x05) == 1
+
+
+def test_log_dir_defaults_to_stderr(monkeypatch):
+    import types, sys
+    config = types.ModuleType('config')
+    config.phyAddr, config.appKey = [0] * 16, [0] * 16
+    config.netProtocol, config.autoJoin, config.adr, config.RXtimeout = 1, 1, 1, 15
+    monkeypatch.setitem(sys.modules, 'config', config)
+    for name in ('phyAddr', 'netProtocol', 'autoJoin', 'adr', 'appKey', 'RXtimeout', 'RS485_IDS', 'logDir'):
+        monkeypatch.setattr(embitshell, name, getattr(embitshell, name))
+    embitshell.load_config()
+    assert embitshell.logDir is None
+    config.logDir = '/tmp/logs'
+    embitshell.load_config()
+    assert embitshell.logDir == '/tmp/logs'
+
+
+def test_duplicate_snapshot_request_resends_snapshot(shell, emulator):
+    request = bytes([binproto.OP_SNAPSHOT | binproto.FLAG_SEQ, 0x42])
+    receive(shell, emulator, request, embitshell.binaryFPort)
+    assert len(shell.feedbacks) == 1
+    snapshot, port = shell.feedbacks[0]
+    assert port == embitshell.snapshotFPort
+    receive(shell, emulator, request, embitshell.binaryFPort)
+    assert shell.feedbacks == [(snapshot, port)] * 2
+    assert shell.controller.snapshot_seq == 1      # nessun nuovo snapshot
@@ -0,0 +1,123 @@
+import os
+import socket
+import threading
+import time
+
+import pytest
+
+import eventloop
+from eventloop import ControlChannel, EventLoop
+
+
+@pytest.fixture
+def loop():
+    loop = EventLoop()
+    yield loop
+    loop.close()
+
+
+def test_timers_in_deadline_order(loop):
+    calls = []
+    loop.call_later(0.02, calls.append, 'b')
+    loop.call_later(0.01, calls.append, 'a')
+    loop.call_later(0.015, calls.append, 'x').cancel()
+    loop.call_later(0.03, loop.stop)
+    loop.run()
+    assert calls == ['a', 'b']
+
+
+def test_call_every_without_drift(loop, monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(eventloop.time, 'monotonic', lambda: now[0])
+    calls = []
+    timer = loop.call_every(10, calls.append, 1)
+    loop._running = True
+    now[0] = 110.004
+    loop._run_timers()
+    assert timer.deadline == 120          # interval dalla scadenza, non da "ora"
+    now[0] = 125
+    loop._run_timers()
+    assert timer.deadline == 130
+    now[0] = 161                          # tre periodi persi
+    loop._run_timers()
+    assert calls == [1, 1, 1]             # un solo recupero
+    assert timer.deadline == 171
+
+
+def test_reader_and_threadsafe_wakeup(loop):
+    r, w = os.pipe()
+    got = []
+    try:
+        loop.add_reader(r, lambda: got.append(os.read(r, 16)))
+        threading.Timer(0.01, os.write, (w, b'x')).start()
+        threading.Timer(0.05, loop.call_soon_threadsafe, (loop.stop,)).start()
+        loop.run()
+        loop.remove_reader(r)
+    finally:
+        os.close(r)
+        os.close(w)
+    assert got == [b'x']
+
+
+def test_callback_exception_does_not_stop_the_loop(loop, caplog):
+    calls = []
+    loop.call_later(0, lambda: 1 / 0)
+    loop.call_later(0.01, calls.append, 'after')
+    loop.call_later(0.02, loop.stop)
+    loop.run()
+    assert calls == ['after']
+    assert 'failed' in caplog.text
+
+
+def client(path, chunks, lines):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(path)
+        for chunk in chunks:
+            s.sendall(chunk)
+            time.sleep(0.01)
+        reply = b''
+        while reply.count(b'\n') < lines:
+            chunk = s.recv(1024)
+            if not chunk:
+                break
+            reply += chunk
+        return reply
+
+
+def serve(loop, fn):
+    result = []
+
+    def run():
+        try:
+            result.append(fn())
+        finally:
+            loop.call_soon_threadsafe(loop.stop)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    loop.run()
+    thread.join(5)
+    return result[0]
+
+
+def test_control_channel_lines(loop, tmp_path):
+    path = str(tmp_path / 'control.sock')
+    channel = ControlChannel(loop, path, lambda line: 'got ' + line)
+    try:
+        assert os.stat(path).st_mode & 0o777 == 0o600
+        # due righe, la seconda spezzata in due pacchetti
+        reply = serve(loop, lambda: client(path, [b'status\nrelay', b' 1 on\n'], 2))
+    finally:
+        channel.close()
+    assert reply == b'got status\ngot relay 1 on\n'
+    assert not os.path.exists(path)
+
+
+def test_control_channel_line_too_long(loop, tmp_path):
+    path = str(tmp_path / 'control.sock')
+    channel = ControlChannel(loop, path, lambda line: 'got ' + line)
+    try:
+        reply = serve(loop, lambda: client(path, [b'x' * 2000], 1))
+    finally:
+        channel.close()
+    assert reply == b''
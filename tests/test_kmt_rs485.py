@@ -0,0 +1,309 @@
+import os
+import threading
+import time
+import tty
+import types
+
+import pytest
+
+import KMT_RS485
+from KMT_RS485 import AutoOffScheduler, KMTronicRelay, RS485Bus
+
+
+class FakeBoards:
+    """Schede KMTronic su un pty: relè FF (n-1)*8+ch 00/01, stato FF A0+n 00."""
+
+    def __init__(self, boards=(1,)):
+        self.relays = {board: [0] * 8 for board in boards}
+        self.frames = []             # (board, ch, 0/1) o (board, 'status'), in ordine di arrivo
+        self.hold = threading.Event()   # clear() = le letture di stato aspettano
+        self.hold.set()
+        self.master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        buf = b''
+        while True:
+            try:
+                data = os.read(self.master, 64)
+            except OSError:
+                return
+            if not data:
+                return
+            buf += data
+            while len(buf) >= 3:
+                if buf[0] != 0xFF:
+                    buf = buf[1:]
+                    continue
+                frame, buf = buf[:3], buf[3:]
+                if frame[1] > 0xA0:
+                    board = frame[1] - 0xA0
+                    self.frames.append((board, 'status'))
+                    self.hold.wait(5)
+                    os.write(self.master, bytes(self.relays.get(board, [0] * 8)))
+                else:
+                    board, ch = divmod(frame[1] - 1, 8)
+                    self.frames.append((board + 1, ch + 1, frame[2]))
+                    self.relays[board + 1][ch] = frame[2]
+
+    def close(self):
+        self.hold.set()
+        os.close(self._slave)
+        os.close(self.master)
+
+
+class Relay:
+    def __init__(self):
+        self.offs = []
+        self.done = threading.Event()
+
+    def _auto_off(self, due):
+        self.offs.append(sorted(ch for ch, _, _ in due))
+        self.done.set()
+
+
+@pytest.fixture
+def boards():
+    boards = FakeBoards((1, 2))
+    yield boards
+    boards.close()
+
+
+def test_set_relay_verify(boards):
+    relay = KMTronicRelay(port=boards.port)
+    try:
+        st = relay.set_relay([1, 3], on=True, verify=True)
+    finally:
+        relay.close()
+    assert boards.frames == [(1, 1, 1), (1, 3, 1), (1, 'status')]
+    assert st == {1: True, 2: False, 3: True, 4: False, 5: False, 6: False, 7: False, 8: False}
+
+
+def test_scheduler_heap_order_and_cancel():
+    scheduler = AutoOffScheduler(Relay(), slack=0)
+    scheduler._running = False       # nessun thread: _due() chiamato dal test
+    scheduler._thread = object()
+    scheduler.schedule(1, 0.3)
+    scheduler.schedule(2, 0)
+    scheduler.schedule(3, 0)
+    scheduler.schedule(2, 10)        # riprogrammato: la prima voce è superata
+    scheduler.cancel(3)
+    assert scheduler._due() == []
+    assert set(scheduler.pending()) == {1, 2}
+    scheduler.slack = 1              # il canale 1 scade entro slack s
+    assert [ch for ch, _, _ in scheduler._due()] == [1]
+    assert set(scheduler.pending()) == {2}
+
+
+def test_scheduler_coalesces_channels_due_together():
+    relay = Relay()
+    scheduler = AutoOffScheduler(relay, slack=0.05)
+    try:
+        scheduler.schedule(1, 0.1)      # oltre slack: nessuno scade subito
+        scheduler.schedule(2, 0.12)
+        assert relay.done.wait(2)
+        scheduler.join()
+    finally:
+        scheduler.stop()
+    assert relay.offs == [[1, 2]]
+
+
+def test_auto_off(boards):
+    relay = KMTronicRelay(port=boards.port)
+    calls = []
+    try:
+        relay.set_relay([1, 2], on=True, duration=0.1,
+                        status_callback=lambda st, auto_off: calls.append(st))
+        relay.scheduler.join()
+    finally:
+        relay.close()
+    assert boards.relays[1][:2] == [0, 0]
+    assert boards.frames[:4] == [(1, 1, 1), (1, 2, 1), (1, 1, 0), (1, 2, 0)]
+    assert relay.auto_off_channels == {1, 2}
+    assert calls and not calls[0][1]
+
+
+def wait_for(predicate, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.005)
+    return True
+
+
+def test_status_cache(boards):
+    boards.relays[1][4] = 1
+    relay = KMTronicRelay(port=boards.port)
+    try:
+        assert relay.status()[5]
+        assert relay.status()[5]                 # dalla cache, nessuna lettura
+        assert boards.frames == [(1, 'status')]
+        relay.set_relay(2, on=True)
+        assert relay.status()[2]                 # aggiornata dal comando
+        assert wait_for(lambda: len(boards.frames) == 2)
+        assert boards.frames == [(1, 'status'), (1, 2, 1)]
+        boards.relays[1][4] = 0
+        assert not relay.status(max_age=0)[5]
+        assert boards.frames[-1] == (1, 'status')
+    finally:
+        relay.close()
+
+
+def test_subscribers(boards):
+    relay = KMTronicRelay(port=boards.port)
+    events = []
+    relay.subscribe(lambda st, changed, source: events.append((changed, source)))
+    try:
+        relay.get_status()
+        relay.set_relay(3, on=True)
+        relay.get_status()                       # nessun cambiamento, nessun evento
+    finally:
+        relay.close()
+    assert events == [(set(range(1, 9)), 'read'), ({3}, 'write')]
+
+
+def test_poller_backoff(boards):
+    relay = KMTronicRelay(port=boards.port)
+    events = []
+    relay.subscribe(lambda st, changed, source: events.append((changed, source)))
+    try:
+        poller = relay.start_poller(min_interval=0.02, max_interval=0.08)
+        assert wait_for(lambda: poller.interval == 0.08)
+        assert poller.polls >= 2
+        boards.relays[1][0] = 1
+        assert wait_for(lambda: ({1}, 'poll') in events)
+        poller.activity()
+        assert poller.interval == 0.02
+    finally:
+        relay.close()
+
+
+def test_board_addressing(boards):
+    bus = RS485Bus(boards.port)
+    try:
+        relay = bus.board(2)
+        relay.set_relay([1, 8], on=True)      # relè 9 e 16 del bus
+        st = relay.get_status()               # FF A2 00
+    finally:
+        bus.close()
+    assert boards.frames == [(2, 1, 1), (2, 8, 1), (2, 'status')]
+    assert boards.relays[1] == [0] * 8
+    assert st[1] and st[8] and not st[2]
+
+
+def test_bus_round_robin(boards):
+    bus = RS485Bus(boards.port)
+    try:
+        boards.hold.clear()
+        first = bus.submit(1, bytes([0xFF, 0xA1, 0x00]), 8)
+        assert wait_for(lambda: boards.frames == [(1, 'status')])
+        # tre comandi della scheda 1 in coda prima di quello della scheda 2
+        futures = [bus.submit(1, bytes([0xFF, ch, 0x01])) for ch in (1, 2, 3)]
+        futures.append(bus.submit(2, bytes([0xFF, 9, 0x01])))
+        boards.hold.set()
+        assert len(first.result(2)) == 8
+        for future in futures:
+            future.result(2)
+        assert wait_for(lambda: len(boards.frames) == 5)
+    finally:
+        bus.close()
+    assert boards.frames[1:] == [(1, 1, 1), (2, 1, 1), (1, 2, 1), (1, 3, 1)]
+    assert bus.requests == {1: 4, 2: 1}
+
+
+def test_stale_auto_off_does_not_overwrite_manual_command(boards):
+    relay = KMTronicRelay(port=boards.port)
+    scheduler = relay.scheduler
+    try:
+        scheduler._running = False   # nessun thread: lo spegnimento lo esegue il test
+        scheduler._thread = object()
+        relay.set_relay(1, on=True, duration=0)
+        with scheduler._cond:
+            due = scheduler._due()
+        relay.set_relay(1, on=True)  # arriva tra la scadenza e la write
+        relay.bus._auto_off(due)
+        time.sleep(0.05)             # un OFF sbagliato arriverebbe qui
+    finally:
+        scheduler._thread = None
+        relay.close()
+    assert boards.relays[1][0] == 1
+    assert boards.frames == [(1, 1, 1), (1, 1, 1)]
+
+
+def test_boards_share_one_scheduler(boards):
+    bus = RS485Bus(boards.port)
+    calls = []
+    try:
+        first, second = bus.board(1), bus.board(2)
+        assert bus.board(1) is first
+        assert first.scheduler is second.scheduler is bus.scheduler
+        first.set_relay(1, on=True, duration=0.1)
+        second.set_relay(1, on=True, duration=0.1,
+                         status_callback=lambda st, auto_off: calls.append(st))
+        assert set(bus.scheduler.pending()) == {(1, 1), (2, 1)}
+        bus.scheduler.join()
+        assert wait_for(lambda: len(boards.frames) == 5)
+    finally:
+        bus.close()
+    # stessa scadenza, due schede: un OFF per scheda, poi lo stato della seconda
+    assert sorted(boards.frames[2:4]) == [(1, 1, 0), (2, 1, 0)]
+    assert boards.frames[4] == (2, 'status')
+    assert first.auto_off_channels == second.auto_off_channels == {1}
+    assert calls and calls[0][1] is False
+
+
+def test_close_cancels_only_own_auto_offs(boards):
+    bus = RS485Bus(boards.port)
+    try:
+        first, second = bus.board(1), bus.board(2)
+        first.set_relay(1, on=True, duration=10)
+        second.set_relay(2, on=True, duration=10)
+        first.close()
+        assert set(bus.scheduler.pending()) == {(2, 2)}
+    finally:
+        bus.close()
+
+
+def fake_clock(monkeypatch):
+    now = [0.0]
+    sleeps = []
+
+    def sleep(delay):
+        sleeps.append(delay)
+        now[0] += delay
+    # solo il modulo KMT_RS485 vede l'orologio finto, non pyserial
+    monkeypatch.setattr(KMT_RS485, 'time', types.SimpleNamespace(monotonic=lambda: now[0], sleep=sleep))
+    return sleeps
+
+
+def test_wait_status_backs_off(boards, monkeypatch):
+    relay = KMTronicRelay(port=boards.port)
+    try:
+        reads = []
+        # la scheda commuta solo alla sesta lettura
+        relay._read_status = lambda: reads.append(1) or {ch: len(reads) >= 6 for ch in range(1, 9)}
+        sleeps = fake_clock(monkeypatch)
+        st = relay.wait_status([1], True, timeout=1)
+    finally:
+        monkeypatch.undo()
+        relay.close()
+    assert st[1] and len(reads) == 6
+    assert sleeps == pytest.approx([30 / 9600, 60 / 9600, 120 / 9600, 240 / 9600, 0.05])
+
+
+def test_wait_status_timeout(boards, monkeypatch):
+    relay = KMTronicRelay(port=boards.port)
+    try:
+        relay._read_status = lambda: {ch: False for ch in range(1, 9)}
+        sleeps = fake_clock(monkeypatch)
+        st = relay.wait_status([1], True, timeout=0.1)
+    finally:
+        monkeypatch.undo()
+        relay.close()
+    assert not st[1]
+    assert max(sleeps) <= 0.05 and sum(sleeps) == pytest.approx(0.1)
+    assert relay.last_status == st
@@ -0,0 +1,61 @@
+import logging
+import queue
+
+import logsetup
+from logsetup import DroppingQueueHandler, RateLimitFilter
+
+
+def record(msg, name='ebi', level=logging.ERROR):
+    return logging.LogRecord(name, level, __file__, 1, msg, None, None)
+
+
+def test_rate_limit(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(logsetup.time, 'monotonic', lambda: now[0])
+    f = RateLimitFilter(interval=60)
+    assert f.filter(record('no answer'))
+    assert not f.filter(record('no answer'))
+    assert not f.filter(record('no answer'))
+    assert f.filter(record('other'))
+    assert f.filter(record('no answer', level=logging.WARNING))
+    assert f.filter(record('no answer', name='embitshell'))
+    now[0] += 60
+    r = record('no answer')
+    assert f.filter(r)
+    assert r.getMessage() == 'no answer (repeated 2 times in the last 60s)'
+    assert not f.filter(record('no answer'))
+
+
+def test_rate_limit_maxkeys(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(logsetup.time, 'monotonic', lambda: now[0])
+    f = RateLimitFilter(interval=60, maxkeys=2)
+    for msg in ('a', 'b', 'c'):
+        assert f.filter(record(msg))
+        now[0] += 1
+    assert len(f._seen) == 2
+    assert f.filter(record('a'))       # la chiave più vecchia è stata scartata
+    assert not f.filter(record('c'))
+
+
+def test_dropping_queue_handler():
+    q = queue.Queue(1)
+    handler = DroppingQueueHandler(q)
+    handler.emit(record('a'))
+    handler.emit(record('b'))
+    assert handler.dropped == 1
+    assert q.get_nowait().getMessage() == 'a'
+
+
+def test_setup_logging_twice(tmp_path):
+    first = logsetup.setup_logging(str(tmp_path), rate_interval=0, loggers=('test_logsetup',))
+    logging.getLogger('test_logsetup').error('first')
+    second = logsetup.setup_logging(str(tmp_path), rate_interval=0, loggers=('test_logsetup',))
+    assert first._thread is None                 # listener precedente fermato
+    assert logsetup._listeners == [second]
+    logger = logging.getLogger('test_logsetup')
+    assert sum(isinstance(h, DroppingQueueHandler) for h in logger.handlers) == 1
+    logger.error('second')
+    logsetup._stop_listeners()
+    lines = (tmp_path / 'test_logsetup_errors.log').read_text().splitlines()
+    assert [line.rsplit(' - ', 1)[1] for line in lines] == ['first', 'second']
@@ -0,0 +1,55 @@
+from metrics import Histogram, Metrics
+
+
+def test_histogram_quantile():
+    h = Histogram(buckets=(1, 2, 4))
+    for value in (0.5, 1.5, 1.5, 3):
+        h.observe(value)
+    assert h.counts == [1, 2, 1, 0]
+    assert h.quantile(0.5) == 1.5      # 2a osservazione: metà del bucket (1, 2]
+    assert h.quantile(1) == 4
+    assert Histogram().quantile(0.5) is None
+
+
+def test_histogram_overflow_bucket():
+    h = Histogram(buckets=(1,))
+    h.observe(5)
+    assert h.counts == [0, 1]
+    assert h.quantile(0.99) == 1       # oltre l'ultimo limite: il limite stesso
+
+
+def test_render():
+    m = Metrics()
+    m.describe('ebi_commands_total', 'counter', 'EBI commands sent')
+    m.inc('ebi_commands_total', opcode='0x11')
+    m.inc('ebi_commands_total', opcode='0x11')
+    m.set('embitshell_uplink_queue_depth', 3)
+    m.observe('ebi_command_seconds', 0.003, opcode='0x11')
+    lines = m.render().splitlines()
+    assert lines.index('# HELP ebi_commands_total EBI commands sent') < \
+        lines.index('# TYPE ebi_commands_total counter') < \
+        lines.index('ebi_commands_total{opcode="0x11"} 2')
+    assert '# TYPE embitshell_uplink_queue_depth gauge' in lines
+    assert 'embitshell_uplink_queue_depth 3' in lines
+    assert '# TYPE ebi_command_seconds histogram' in lines
+    assert 'ebi_command_seconds_bucket{opcode="0x11",le="0.0025"} 0' in lines
+    assert 'ebi_command_seconds_bucket{opcode="0x11",le="0.005"} 1' in lines
+    assert 'ebi_command_seconds_bucket{opcode="0x11",le="+Inf"} 1' in lines
+    assert 'ebi_command_seconds_sum{opcode="0x11"} 0.003' in lines
+    assert 'ebi_command_seconds_count{opcode="0x11"} 1' in lines
+    assert 0.0025 < m.quantile('ebi_command_seconds', 0.5, opcode='0x11') <= 0.005
+
+
+def test_label_escaping():
+    m = Metrics()
+    m.inc('errors_total', error='say "hi"')
+    assert 'errors_total{error="say \\"hi\\""} 1' in m.render().splitlines()
+
+
+def test_write_textfile(tmp_path):
+    m = Metrics()
+    m.inc('ebi_commands_total')
+    path = tmp_path / 'embitshell.prom'
+    m.write_textfile(str(path))
+    assert path.read_text() == m.render()
+    assert [p.name for p in tmp_path.iterdir()] == ['embitshell.prom']
@@ -0,0 +1,87 @@
+import threading
+
+from metrics import REGISTRY
+from uplink import UplinkQueue
+
+
+class Sender:
+    def __init__(self):
+        self.sent = []
+        self.release = threading.Event()
+        self.release.set()
+
+    def __call__(self, payload, port):
+        self.release.wait(5)
+        self.sent.append((payload, port))
+        return {'status': 'Success'}
+
+
+def test_messages_in_window_share_an_uplink():
+    send = Sender()
+    queue = UplinkQueue(send, window=0.05, max_payload=51)
+    try:
+        for message in ('T:L;N:g;S:ON', 'T:R;N:1;S:ON', 'T:R;N:2;S:OFF'):
+            queue.put(message)
+        assert queue.flush(5)
+    finally:
+        queue.close(5)
+    assert send.sent == [('T:L;N:g;S:ON|T:R;N:1;S:ON|T:R;N:2;S:OFF', None)]
+    assert queue.stats()['messages'] == 3
+
+
+def test_batch_split_by_payload_port_and_bytes():
+    send = Sender()
+    send.release.clear()
+    queue = UplinkQueue(send, window=0, max_payload=12)
+    try:
+        queue.put('first')          # in invio, il worker aspetta release
+        while queue.depth:
+            pass
+        for message, port in (('aaaaa', None), ('bbbbb', None), ('ccccc', None),
+                              ('ddddd', 11), (b'\x03\x01', None), ('eeeee', None)):
+            queue.put(message, port)
+        send.release.set()
+        assert queue.flush(5)
+    finally:
+        queue.close(5)
+    assert send.sent == [('first', None), ('aaaaa|bbbbb', None), ('ccccc', None),
+                         ('ddddd', 11), (b'\x03\x01', None), ('eeeee', None)]
+    assert queue.stats()['uplinks'] == 6
+
+
+def test_queue_full_drops_oldest():
+    send = Sender()
+    send.release.clear()
+    queue = UplinkQueue(send, window=0, maxsize=2)
+    try:
+        queue.put('first')
+        while queue.depth:
+            pass
+        for message in ('a', 'b', 'c'):
+            queue.put(message)
+        assert queue.dropped == 1
+        send.release.set()
+        assert queue.flush(5)
+    finally:
+        queue.close(5)
+    assert send.sent == [('first', None), ('b|c', None)]
+
+
+def test_queue_depth_gauge():
+    send = Sender()
+    send.release.clear()
+    queue = UplinkQueue(send, window=0)
+    try:
+        queue.put(b'\x01')
+        while queue.depth:
+            pass
+        # il worker è fermo nell'invio: il gauge segue le put()
+        queue.put(b'\x02')
+        queue.put(b'\x03')
+        assert REGISTRY.get('embitshell_uplink_queue_depth') == 2
+        send.release.set()
+        assert queue.flush(5)
+        assert REGISTRY.get('embitshell_uplink_queue_depth') == 0
+    finally:
+        send.release.set()
+        queue.close(5)
@@ -0,0 +1,147 @@
+#!/usr/bin/python3
+
+"""Asynchronous, coalescing uplink queue.
+
+Feedback messages are queued by put() and sent by a worker thread, so the
+caller never waits for the LoRaWAN airtime. Messages queued within `window`
+seconds of the first pending one are joined with `separator` into a single
+uplink, as long as the result fits in `max_payload` bytes (51 = EU868 SF12).
+Binary (bytes) messages and messages for another FPort are sent on their own.
+"""
+
+import time
+import threading
+import logging
+from collections import deque
+
+from metrics import REGISTRY
+
+logger = logging.getLogger("embitshell")
+
+
+class UplinkQueue:
+    def __init__(self, send, window=0.5, max_payload=51, separator='|', maxsize=64):
+        """send: callable(payload, port) -> result dict of EBI.send_dataLW"""
+        self._send = send
+        self.window = window
+        self.max_payload = max_payload
+        self.separator = separator
+        self._queue = deque()
+        self._maxsize = maxsize
+        self._cond = threading.Condition()
+        self._busy = False
+        self._running = True
+        self.uplinks = 0
+        self.messages = 0
+        self.dropped = 0
+        self.errors = 0
+        self.latency_last = 0.0
+        self.latency_max = 0.0
+        self._latency_sum = 0.0
+        self._worker = threading.Thread(target=self._run, name="uplink", daemon=True)
+        self._worker.start()
+
+    @property
+    def depth(self):
+        return len(self._queue)
+
+    def put(self, message, port=None):
+        """Queue a str (joinable) or bytes message; port None = default FPort."""
+        with self._cond:
+            if len(self._queue) >= self._maxsize:
+                old = self._queue.popleft()[0]
+                self.dropped += 1
+                logger.error(f"uplink queue full, dropping {old!r}")
+                REGISTRY.inc('embitshell_uplink_dropped_total')
+            self._queue.append((message, port, time.monotonic()))
+            REGISTRY.set('embitshell_uplink_queue_depth', len(self._queue))
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {
+                'depth': len(self._queue),
+                'uplinks': self.uplinks,
+                'messages': self.messages,
+                'dropped': self.dropped,
+                'errors': self.errors,
+                'latency_last': round(self.latency_last, 3),
+                'latency_max': round(self.latency_max, 3),
+                'latency_avg': round(self._latency_sum / self.messages, 3) if self.messages else 0.0,
+            }
+
+    def flush(self, timeout=None):
+        """Wait until every queued message has been sent; False on timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._queue or self._busy:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def close(self, timeout=None):
+        self.flush(timeout)
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        self._worker.join(1)
+
+    def _batch(self):
+        """Pop the messages that fit in one uplink (called with the lock held)."""
+        batch = [self._queue.popleft()]
+        first, port, _ = batch[0]
+        if isinstance(first, bytes):
+            return batch
+        size = len(first.encode('utf8'))
+        while self._queue:
+            message, next_port, _ = self._queue[0]
+            if isinstance(message, bytes) or next_port != port:
+                break
+            size += len(self.separator) + len(message.encode('utf8'))
+            if size > self.max_payload:
+                break
+            batch.append(self._queue.popleft())
+        return batch
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._running and not self._queue:
+                    self._cond.wait()
+                if not self._running:
+                    return
+                # attende la fine della finestra aperta dal primo messaggio
+                first = self._queue[0][2]
+                while self._running and time.monotonic() < first + self.window:
+                    self._cond.wait(first + self.window - time.monotonic())
+                batch = self._batch()
+                REGISTRY.set('embitshell_uplink_queue_depth', len(self._queue))
+                self._busy = True
+            port = batch[0][1]
+            if len(batch) == 1:
+                payload = batch[0][0]
+            else:
+                payload = self.separator.join(message for message, _, _ in batch)
+            try:
+                ret = self._send(payload, port)
+            except Exception as e:
+                ret = {'status': 'Exception', 'error': str(e)}
+            now = time.monotonic()
+            with self._cond:
+                self._busy = False
+                self.uplinks += 1
+                if not isinstance(ret, dict) or ret.get('status') != 'Success':
+                    self.errors += 1
+                    logger.error(f"uplink {payload!r} failed: {ret}")
+                    REGISTRY.inc('embitshell_uplink_errors_total')
+                REGISTRY.inc('embitshell_uplinks_total')
+                for _, _, queued in batch:
+                    latency = now - queued
+                    REGISTRY.observe('embitshell_uplink_latency_seconds', latency)
+                    self.messages += 1
+                    self._latency_sum += latency
+                    self.latency_last = latency
+                    self.latency_max = max(self.latency_max, latency)
+                self._cond.notify_all()